@@ -1,5 +1,6 @@
+import gc
 import os
-from celery import Celery
+from celery import Celery, signals
 from flask import Flask
 # from flask_bcrypt import Bcrypt
 from flask_debugtoolbar import DebugToolbarExtension
@@ -47,13 +48,57 @@ from app.logger_setup import logger
 #     return User.query.filter(User.email == email).first()
 
 
+# Tasks which mostly wait on the network run on the 'io' queues, served by a
+# green thread pool at high concurrency. Those which mostly compute, with
+# spaCy or HeidelTime, run on the 'cpu' queues, served by a pool of processes.
+# Each kind has a queue per priority class, see priorities.py, tasks enqueued
+# without a priority go to the 'normal' one
+TASK_QUEUES = {
+    'io': [
+        'app.tasks.captions.youtube_captions_from_video',
+        'app.tasks.wikitext.wikipedia_events_from_dates',
+        'app.tasks.wikitext.resolve_match_link_topics',
+        'app.tasks.requests.*',
+        'app.tasks.release_video_flight',
+    ],
+    'cpu': [
+        'app.tasks.captions.annotate_events_in_captions',
+        'app.tasks.wikitext.wikipedia_events_from_index',
+        'app.tasks.captions.event_dates_from_timeml_annotated_captions',
+        'app.tasks.wikitext.event_entities_from_wikitext',
+        'app.tasks.wikitext.match_event_via_entities',
+        'app.tasks.wikitext.match_event_via_vector_sim',
+        'app.tasks.wikitext.score_related_events',
+        'app.tasks.wikitext.rematch_stored_extract',
+        'app.tasks.wikitext.merge_rematch_results',
+    ],
+}
+
+
 # Setup the celery task definitions
 def make_celery(app):
     # create the celery instance and configure it
+    # task modules are imported by the workers only, the web process enqueues
+    # tasks by name so it never loads them or the models they use
     celery = Celery(app.import_name,
                     backend=app.config['CELERY_RESULT_BACKEND'],
-                    broker=app.config['CELERY_BROKER_URL'])
+                    broker=app.config['CELERY_BROKER_URL'],
+                    include=TASK_MODULES)
     celery.conf.update(app.config)
+    celery.conf.update(
+        CELERY_ROUTES=dict((name, {'queue': kind + '.normal'})
+                           for (kind, names) in TASK_QUEUES.items() for name in names),
+        CELERY_DEFAULT_QUEUE='cpu.normal',
+        # take one task at a time so a worker does not sit on a batch of bulk
+        # tasks while interactive ones wait
+        CELERYD_PREFETCH_MULTIPLIER=1,
+        # log lines carry the trace id of the run they were written for, see
+        # tracing.py
+        CELERYD_LOG_FORMAT='[%(asctime)s: %(levelname)s/%(processName)s] [%(trace_id)s] '
+                           '%(message)s',
+        CELERYD_TASK_LOG_FORMAT='[%(asctime)s: %(levelname)s/%(processName)s] [%(trace_id)s] '
+                                '%(task_name)s[%(task_id)s]: %(message)s',
+    )
 
     # setup the base class for celery tasks
     TaskBase = celery.Task
@@ -67,14 +112,38 @@ def make_celery(app):
     return celery
 
 
+TASK_MODULES = ['app.tasks', 'app.tasks.captions', 'app.tasks.requests', 'app.tasks.wikitext']
 celery = make_celery(app)
-from app import tasks
+
+
+@signals.worker_init.connect
+def preload_models(**kwargs):
+    """Loads the NLP model in the worker before it forks its pool, so the
+    children share its pages copy-on-write instead of each loading it."""
+    if not app.config.get('WORKER_PRELOAD_MODELS'):
+        return
+    from app import lib
+    lib.get_nlp()
+    # keep the collector from touching, and so copying, the preloaded objects
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+# Expose the metrics of the web process, workers can send theirs to statsd
+from app import metrics
+# Log records get the trace id of their thread before any worker logs
+from app import tracing
+app.add_url_rule('/metrics', 'metrics', metrics.prometheus_view)
 
 
 # Setup the API interface
-from app.api import TaskResult, WikidataExtract, YoutubeInput
+from app.api import Rematch, TaskProfile, TaskResult, TimelineExport, WikidataExtract, YoutubeInput
 api = Api(app, prefix='/api/v1')
 api.add_resource(YoutubeInput, '/in/yt', endpoint='yt_in')
 api.add_resource(WikidataExtract, '/in/wd', endpoint='wd_in')
 api.add_resource(TaskResult, '/tasks/<string:task_id>', endpoint='task_result')
+api.add_resource(TaskProfile, '/tasks/<string:task_id>/profile', endpoint='task_profile')
+api.add_resource(TimelineExport, '/timelines/<string:video_id>', endpoint='timeline')
+api.add_resource(Rematch, '/rematch', endpoint='rematch')
 
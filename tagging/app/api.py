@@ -4,13 +4,16 @@ module for processing API
 import logging
 from urllib import parse
 
-from celery import chain
+from celery import chain, chord
 from celery.result import AsyncResult
-from flask import Response, jsonify
-from flask_restful import abort, fields, marshal_with, Resource
+from celery.utils import uuid
+from flask import Response, json, jsonify, request
+from flask_restful import abort, fields, inputs, marshal_with, Resource
 from flask_restful.reqparse import RequestParser
 
-from app import app, celery, tasks
+from app import app, celery, metrics, priorities, profiling, tracing
+from app.lib import compact, extractfile, resultcache, singleflight, timeline
+from app.lib import matchparams as mp
 
 
 class YoutubeInput(Resource):
@@ -19,15 +22,59 @@ class YoutubeInput(Resource):
         'url': fields.String,
         'video_id': fields.String,
         'task_id': fields.String,
+        'joined': fields.Boolean,
+        'trace_id': fields.String,
     }
 
-    @marshal_with(fields, envelope='in')
     def post(self):
-        """Adds in a new youtube video for processing."""
+        """Adds in a new youtube video for processing, at the priority
+        'interactive', 'normal' or 'bulk'. Responds with a 429 and a
+        Retry-After when the queues of the priority are too deep. The run
+        gets a new trace, its id is returned with the task id."""
         parser = RequestParser()
         parser.add_argument('url', required=True)
+        parser.add_argument('profile', type=inputs.boolean, default=False)
+        parser.add_argument('memory', type=inputs.boolean, default=False)
+        parser.add_argument('budget', type=inputs.positive,
+                            default=app.config['PIPELINE_DEADLINE_SECS'])
+        parser.add_argument('priority', choices=priorities.PRIORITIES,
+                            default=priorities.DEFAULT_PRIORITY)
         args = parser.parse_args()
 
+        try:
+            with tracing.trace_context(tracing.new_trace_id()), \
+                    tracing.span('enqueue', kind='SERVER', priority=args['priority']) as span:
+                retry_after = priorities.admission_retry_after(args['priority'])
+                if retry_after is None:
+                    return self._enqueue(args, span)
+                span.tag('rejected', True)
+        finally:
+            tracing.flush()
+
+        metrics.inc('admission_rejected_total', priority=args['priority'])
+        response = jsonify({'message': 'Too many {} videos queued, retry in {} seconds'.format(
+            args['priority'], retry_after), 'retry_after': retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @marshal_with(fields, envelope='in')
+    def _enqueue(self, args, span):
+        """Enqueues the chain processing the video of the url, its tasks
+        traced as children of span. A video which is already being processed
+        by the same version of the pipeline at the same priority joins that
+        run: the task and trace ids of the run in flight are returned with
+        'joined'. Runs which are profiled, or whose memory is traced, always
+        start their own run."""
+        # the run has to complete within its budget of seconds from when its
+        # first stage starts, stages which start after the deadline are skipped
+        meta = {'budget': args['budget'],
+                'trace': {'trace_id': span.trace_id, 'parent_id': span.span_id}}
+        if args['profile']:
+            meta['profile'] = True
+        if args['memory']:
+            meta['trace_memory'] = True
+
         logging.info('Enqueing {url:s}', args)
         # parse youtube url in the form of http://youtube.com/watch?v=<VIDEO_ID>
         # parse the extracted query to get the first available 'v' param
@@ -39,22 +86,43 @@ class YoutubeInput(Resource):
                 video_id, args['url'])
             logging.warn(msg)
             return abort(400, message=msg)
+        span.tag('video_id', video_id)
 
-        res = chain(
-            tasks.captions.youtube_captions_from_video.s(video_id),
-            tasks.captions.annotate_events_in_captions.s(video_id),
-            tasks.captions.event_dates_from_timeml_annotated_captions.s(),
-            tasks.wikitext.wikipedia_events_from_dates.s(),
-            tasks.wikitext.event_entities_from_wikitext.s(),
-            tasks.wikitext.match_event_via_entities.s(),
-            tasks.wikitext.resolve_match_link_topics.s(),
-            # tasks.requests.send_url_payload(app.config['WIKITEXT_PAYLOAD_DEST_URL']),
-        ).apply_async()
+        task_id = uuid()
+        token = singleflight.flight_token(task_id, span.trace_id)
+        ttl = args['budget'] + app.config['SINGLE_FLIGHT_GRACE_SECS']
+        claimed = False
+        if not (args['profile'] or args['memory']):
+            holder, claimed = singleflight.claim(video_id, token, ttl, args['priority'])
+            if not claimed:
+                joined_id, joined_trace = singleflight.parse_flight_token(holder)
+                logging.info('Video %s is already in flight as task %s', video_id, joined_id)
+                metrics.inc('singleflight_joined_total')
+                span.tag('joined', True)
+                return {'url': args['url'], 'video_id': video_id, 'task_id': joined_id,
+                        'joined': True, 'trace_id': joined_trace}
+
+        options = {'task_id': task_id}
+        if claimed:
+            # the chain releases the flight when it finishes or fails
+            release = celery.signature('app.tasks.release_video_flight',
+                                       args=(video_id, token, args['priority']), immutable=True)
+            release = priorities.with_priority([release], args['priority'])[0]
+            options.update(link=release, link_error=release)
+
+        try:
+            res = _pipeline_chain(video_id, meta, args['priority']).apply_async(**options)
+        except Exception:
+            if claimed:
+                singleflight.release(video_id, token, args['priority'])
+            raise
 
         return {
             'url': args['url'],
             'video_id': video_id,
-            'task_id': res.id
+            'task_id': res.id,
+            'joined': False,
+            'trace_id': span.trace_id,
         }
 
 
@@ -77,7 +145,7 @@ class WikidataExtract(Resource):
         logging.info('Enqueing relevance scoring for video %s', video_id)
 
         res = chain(
-            tasks.wikitext.score_related_events.s(extract)
+            _task('wikitext.score_related_events', extract)
         ).apply_async()
 
         return {
@@ -86,21 +154,213 @@ class WikidataExtract(Resource):
         }
 
 
+class Rematch(Resource):
+    """Resource which represents matching the stored extracts again with
+    other match parameters, without running the rest of the pipeline."""
+    fields = {
+        'task_id': fields.String,
+        'videos': fields.Integer,
+        'params': fields.Integer,
+    }
+
+    @marshal_with(fields, envelope='in')
+    def post(self):
+        """Evaluates a list of params, dicts of item_threshold,
+        window_threshold and entity_blacklist, over the stored extracts of
+        video_ids, default all of them, in one pass per extract. The result
+        of the task has the match counts of each params over the corpus and
+        per video."""
+        parser = RequestParser()
+        parser.add_argument('params', type=list, location='json', default=[{}])
+        parser.add_argument('video_ids', type=list, location='json', default=None)
+        args = parser.parse_args()
+        try:
+            params_list = [dict(mp.match_params(p)._asdict()) for p in args['params']]
+        except (ValueError, TypeError, AttributeError) as e:
+            return abort(400, message='Bad match params: {}'.format(e))
+
+        video_ids = args['video_ids'] or extractfile.stored_video_ids()
+        logging.info('Rematching %d videos with %d params', len(video_ids), len(params_list))
+        header = priorities.with_priority(
+            [_task('wikitext.rematch_stored_extract', v, params_list) for v in video_ids], 'bulk')
+        body = priorities.with_priority(
+            [_task('wikitext.merge_rematch_results', params_list=params_list)], 'bulk')[0]
+        res = chord(header, body).apply_async()
+        return {'task_id': res.id, 'videos': len(video_ids), 'params': len(params_list)}
+
+
 class TaskResult(Resource):
     """Resource which represents the result of task enqueued."""
 
     def get(self, task_id):
-        """Fetches the result of a task."""
+        """Fetches the result of a task. Extracts are sent in their compact
+        form, serialized with msgpack, to clients which accept it.
+
+        Results of finished tasks are serialized once and cached with a
+        strong ETag: a request with a matching If-None-Match gets a 304, and
+        the body is gzip or brotli encoded when the client accepts it."""
+        accept = compact.MIMETYPE if _accepts_compact() else 'application/json'
+        return _cached_response(task_id, accept, lambda: _task_result(task_id))
+
+
+class TimelineExport(Resource):
+    """Resource which represents the timeline of a stored extract, the
+    matched events of the video, their timestamps and topics, paginated by
+    time."""
+
+    def get(self, video_id):
+        """Fetches a page of the timeline of the newest extract of a video,
+        with the sentences from start up to end seconds, at most limit."""
+        parser = RequestParser()
+        parser.add_argument('start', type=float, default=0, location='args')
+        parser.add_argument('end', type=float, default=None, location='args')
+        parser.add_argument('limit', type=inputs.positive,
+                            default=app.config['TIMELINE_PAGE_SIZE'], location='args')
+        args = parser.parse_args()
+
+        version, stored = timeline.stored_timeline(video_id)
+        if stored is None:
+            return abort(404, message='No extract of video {}'.format(video_id))
+        key = 'timeline:{}:{}:{start}:{end}:{limit}'.format(video_id, version, **args)
+        return _cached_response(key, 'application/json',
+                                lambda: timeline.page(stored, **args))
+
+
+def _task_result(task_id):
+    """Returns the result of a finished task, or a response with its status
+    when it has no result to cache."""
+    result = AsyncResult(id=task_id, app=celery)
+    if result.status not in ['SUCCESS', 'FAILURE']:
+        return jsonify({'id': task_id, 'status': result.status})
+    try:
+        return result.get()
+    except Exception as e:
+        logging.info(e)
+        return jsonify({'id': task_id, 'status': result.status, 'err': repr(e)})
+
+
+def _cached_response(key, accept, fetch):
+    """Returns the response for the value under key, serialized for accept
+    and cached with a strong ETag. fetch is called for the value on a cache
+    miss and may return a Response instead, which is sent as is."""
+    cache = resultcache.result_cache()
+    identity = cache.get(key, accept)
+    if identity is not None:
+        metrics.inc('result_cache_requests_total', outcome='hit')
+    else:
+        value = fetch()
+        if isinstance(value, Response):
+            return value
+        metrics.inc('result_cache_requests_total', outcome='miss')
+        identity = cache.put(key, accept, *_serialize(value, accept))
+
+    encoding = _best_encoding(identity.body)
+    if _not_modified(identity.etag):
+        return _not_modified_response(identity.etag, encoding)
+    entry = identity
+    if encoding != 'identity':
+        # bodies too large to cache are compressed on every request
+        entry = cache.encoded(key, accept, encoding) or resultcache.Entry(
+            identity.etag, identity.mimetype, resultcache.encode(identity.body, encoding))
+    return _result_response(entry, encoding)
+
+
+def _serialize(value, accept):
+    """Returns the mimetype and the bytes of a task result."""
+    if accept == compact.MIMETYPE and isinstance(value, dict) and 'events' in value:
+        return compact.MIMETYPE, compact.dumps(compact.pack(value))
+    return 'application/json', json.dumps(value).encode('utf-8')
+
+
+def _best_encoding(body):
+    """Returns the content coding the body is sent in, bodies smaller than
+    RESULT_COMPRESS_MIN_BYTES are not worth compressing."""
+    if len(body) < app.config['RESULT_COMPRESS_MIN_BYTES']:
+        return 'identity'
+    return request.accept_encodings.best_match(resultcache.ENCODINGS) or 'identity'
+
+
+def _not_modified(etag):
+    """Whether the If-None-Match of the request matches the result in any of
+    its encodings."""
+    return any(request.if_none_match.contains(resultcache.encoded_etag(etag, encoding))
+               for encoding in resultcache.ENCODINGS + ('identity',))
+
+
+def _not_modified_response(etag, encoding):
+    response = Response(status=304)
+    response.set_etag(resultcache.encoded_etag(etag, encoding))
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+
+def _result_response(entry, encoding):
+    response = Response(entry.body, mimetype=entry.mimetype)
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.set_etag(resultcache.encoded_etag(entry.etag, encoding))
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+
+def _pipeline_chain(video_id, meta, priority):
+    """Returns the chain of tasks processing a video at the priority, which
+    carry the trace of the run in their headers."""
+    return chain(*tracing.with_trace(priorities.with_priority([
+        _task('captions.youtube_captions_from_video', video_id, meta=meta),
+        _task('captions.annotate_events_in_captions', video_id, meta=meta),
+        _task('captions.event_dates_from_timeml_annotated_captions'),
+        _task('wikitext.wikipedia_events_from_dates'),
+        *_candidate_tasks(),
+        *_match_tasks(app.config['MATCH_STRATEGY']),
+        _task('wikitext.resolve_match_link_topics'),
+        # tasks.requests.send_url_payload(app.config['WIKITEXT_PAYLOAD_DEST_URL']),
+    ], priority), meta.get('trace')))
+
+
+def _candidate_tasks():
+    """Returns the tasks adding candidates to the events without a usable
+    date, when the event index is used."""
+    return [_task('wikitext.wikipedia_events_from_index')] if app.config['ANN_TOP_K'] else []
+
+
+def _match_tasks(strategy):
+    """Returns the tasks matching events with the strategy: 'entities' by the
+    overlap of entities, 'vectors' by the similarity of embeddings, 'blend'
+    by both."""
+    tasks = []
+    if strategy in ('entities', 'blend'):
+        tasks += [_task('wikitext.event_entities_from_wikitext'),
+                  _task('wikitext.match_event_via_entities')]
+    if strategy in ('vectors', 'blend'):
+        tasks += [_task('wikitext.match_event_via_vector_sim', strategy=strategy)]
+    if not tasks:
+        raise ValueError('Don\'t understand match strategy %s' % (strategy))
+    return tasks
+
+
+def _task(name, *args, **kwargs):
+    """Returns a signature for the task app.tasks.<name>, by name so the web
+    process does not import the task modules."""
+    return celery.signature('app.tasks.' + name, args=args, kwargs=kwargs)
+
+
+def _accepts_compact():
+    best = request.accept_mimetypes.best_match(['application/json', compact.MIMETYPE])
+    return best == compact.MIMETYPE
+
+
+class TaskProfile(Resource):
+    """Resource which represents the profile of a task run with profiling."""
+
+    def get(self, task_id):
+        """Fetches the profile of a task as collapsed stacks."""
         result = AsyncResult(id=task_id, app=celery)
-        if result.status in ['SUCCESS', 'FAILURE']:
-            try:
-                response = jsonify(result.get())
-            except Exception as e:
-                logging.info(e)
-                response = jsonify({'id': task_id, 'status': result.status, 'err': repr(e)})
-        else:
-            response = jsonify({'id': task_id, 'status': result.status})
-
-        response.status_code = 200
-        return response
+        if result.status != 'SUCCESS':
+            return abort(404, message='Task {} has no result, status {}'.format(
+                task_id, result.status))
 
+        profiles = (result.get().get('meta') or {}).get('profiles')
+        if not profiles:
+            return abort(404, message='Task {} was not run with profiling'.format(task_id))
+        return Response(profiling.collapsed_profiles(profiles), mimetype='text/plain')
@@ -31,3 +31,129 @@ HEIDELTIME_TMPINPUT_DIR = '/tmp'
 CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
 CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 CELERY_REDIS_MAX_CONNECTIONS = 2
+
+# Seconds either side of a caption sentence from which context entities are
+# taken when matching events. None uses a window of one sentence either side.
+CONTEXT_WINDOW_SECS = None
+
+# Date values spanning more years than this (decades, centuries) are not
+# looked up on wikipedia, there would be too many candidate events to score
+WIKI_PLAN_MAX_YEARS = 2
+
+# Number of wikipedia pages fetched concurrently for the events of a video
+WIKI_FETCH_WORKERS = 8
+
+# Wikipedia pages are fetched from the 'url' or read through a local 'cache'.
+# Cached pages are never fetched again and miss the events added to them
+# later, use the cache for backfills and rematching rather than live runs.
+# The year pages of the current year are always fetched.
+ARTICLE_FETCH_STRATEGY = os.environ.get('ARTICLE_FETCH_STRATEGY', 'url')
+# The cache is a 'pack' file with an offset index or a sharded 'dir'ectory,
+# a relative path is from the tagging directory
+ARTICLE_STORE = os.environ.get('ARTICLE_STORE', 'pack')
+ARTICLE_STORE_PATH = os.environ.get('ARTICLE_STORE_PATH', 'data/articles/wikipedia')
+
+# Workers send their metrics to statsd when a host is set, the web process
+# also exposes its own on /metrics
+METRICS_STATSD_HOST = os.environ.get('STATSD_HOST')
+METRICS_STATSD_PORT = int(os.environ.get('STATSD_PORT', 8125))
+METRICS_STATSD_PREFIX = 'timelines'
+
+# Seconds between stack samples of a stage when a run asks for a profile
+PROFILE_INTERVAL_SECS = 0.005
+
+# Redis used to coordinate the workers, e.g. for the shared rate limits
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+
+# Requests a second and burst allowed to each upstream host, shared by all the
+# workers through 'redis' or limited per process with 'local'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'redis')
+RATE_LIMITS = {
+    'en.wikipedia.org': (20, 40),
+    'video.google.com': (5, 10),
+}
+# Failed requests are retried with jittered exponential backoff, or after the
+# Retry-After of the response when it is no longer than HTTP_RETRY_AFTER_MAX
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30
+HTTP_RETRY_AFTER_MAX = 60
+# Requests time out after these many seconds, or sooner at the deadline
+HTTP_CONNECT_TIMEOUT_SECS = 5
+HTTP_READ_TIMEOUT_SECS = 30
+# GETs taking longer than this quantile of the recent latencies of their host
+# are sent again, once HTTP_HEDGE_MIN_SAMPLES have been seen. None turns this off
+HTTP_HEDGE_QUANTILE = 0.95
+HTTP_HEDGE_MIN_SAMPLES = 20
+HTTP_HEDGE_WORKERS = 64
+
+# Workers load the NLP model before forking their pool so the children share it
+WORKER_PRELOAD_MODELS = os.environ.get('WORKER_PRELOAD_MODELS', '1') == '1'
+
+# Events are matched to candidates by the overlap of their 'entities', the
+# similarity of their embeddings, 'vectors', or a 'blend' of both
+MATCH_STRATEGY = os.environ.get('MATCH_STRATEGY', 'entities')
+VECTOR_MATCH_THRESHOLD = 0.8
+BLEND_VECTOR_WEIGHT = 0.5
+BLEND_MATCH_THRESHOLD = 0.5
+# Candidate embeddings are cached here, a relative path is from the tagging
+# directory
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', 'data/embeddings')
+
+# Events without a usable date get the ANN_TOP_K nearest wikipedia events to
+# their sentence as candidates, from the index built by
+# `manage.py build_event_index`. 0 turns this off
+EVENT_INDEX_PATH = os.environ.get('EVENT_INDEX_PATH', 'data/event_index')
+ANN_TOP_K = 20
+ANN_NPROBE = 8
+
+# The web process keeps up to this many bytes of serialized task results, and
+# compresses those of at least RESULT_COMPRESS_MIN_BYTES for clients which
+# accept gzip or brotli
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESULT_COMPRESS_MIN_BYTES = 1024
+
+# Stored extracts the timelines are exported from, written by backfills or
+# sessions, a relative path is from the tagging directory
+EXTRACTS_PATH = os.environ.get('EXTRACTS_PATH', 'data')
+TIMELINE_PAGE_SIZE = 200
+
+# Extracts are saved as .json, .ndjson, or either gzipped, see lib/extractfile.py
+EXTRACT_SUFFIX = os.environ.get('EXTRACT_SUFFIX', '.ndjson.gz')
+
+# Seconds a video enqueued through the API has to complete in, counted from
+# when its first stage starts. Its stages skip or cut short their work once
+# the deadline has passed
+PIPELINE_DEADLINE_SECS = 300
+
+# Runs of a priority are refused, with a Retry-After, while more than this
+# many tasks wait on its queues
+ADMISSION_MAX_QUEUE_DEPTH = {
+    'interactive': 50,
+    'normal': 1000,
+    'bulk': 10000,
+}
+ADMISSION_RETRY_AFTER_SECS = 30
+
+# Runs are deduplicated per video and PIPELINE_VERSION, bump it when a change
+# makes earlier runs' extracts stale. A run's claim expires this many seconds
+# after its deadline in case its release is lost
+PIPELINE_VERSION = '1'
+SINGLE_FLIGHT_GRACE_SECS = 60
+
+# Spans of pipeline runs are exported as zipkin v2 json, appended to
+# TRACE_FILE with 'file' or posted to the collector at TRACE_ZIPKIN_URL with
+# 'zipkin'. Unset records no spans, runs still get a trace id for their logs
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT') or None
+TRACE_FILE = os.environ.get('TRACE_FILE', 'data/traces.ndjson')
+TRACE_ZIPKIN_URL = os.environ.get('TRACE_ZIPKIN_URL', 'http://localhost:9411/api/v2/spans')
+TRACE_SERVICE_NAME = 'timelines'
+TRACE_EXPORT_TIMEOUT_SECS = 2
+TRACE_MAX_BUFFERED_SPANS = 1000
+
+# Captions of a video are parsed and annotated in segments when parsing them
+# at once is estimated, at NLP_BYTES_PER_CHAR of text, to take more memory
+# than the ceiling. Calibrate the estimate from the peaks of runs enqueued
+# with memory=true. 0 parses every video at once
+VIDEO_MEMORY_CEILING_BYTES = int(os.environ.get('VIDEO_MEMORY_CEILING_BYTES', 512 * 1024 * 1024))
+NLP_BYTES_PER_CHAR = 400
@@ -3,14 +3,20 @@ __init__.py
 
 library module for the app
 """
-import json
+import functools as ft
 import os
 import tempfile
 
-import en_core_web_sm
-nlp = en_core_web_sm.load()
+from app import app, metrics, tracing
+from app.lib import extractfile
 
-from app import app
+
+@ft.lru_cache(maxsize=None)
+def get_nlp():
+    """Returns the spaCy model, loaded on first use so that processes which
+    only enqueue tasks never load it. Workers preload it before forking."""
+    import en_core_web_sm
+    return en_core_web_sm.load()
 
 
 def nlp_over_lines_as_blob(lines, *extractors):
@@ -20,7 +26,9 @@ def nlp_over_lines_as_blob(lines, *extractors):
     Yields a tuple for each sentence containing the results of each extractor
     """
     blob = ' '.join(lines)
-    doc = nlp(blob)
+    with metrics.timer('spacy_seconds', stage=metrics.current_stage()), \
+            tracing.span('spacy', chars=len(blob)):
+        doc = get_nlp()(blob)
     for sent in doc.sents:
         extracted = [ext(sent) for ext in extractors]
         yield tuple(extracted)
@@ -32,7 +40,9 @@ def nlp_over_lines(lines, *extractors):
     Yields a tuple for each line containing the results of each extractor
     """
     for line in lines:
-        doc = nlp(line)
+        with metrics.timer('spacy_seconds', stage=metrics.current_stage()), \
+                tracing.span('spacy', chars=len(line)):
+            doc = get_nlp()(line)
         extracted = [ext(doc) for ext in extractors]
         yield tuple(extracted)
 
@@ -88,11 +98,18 @@ def save_to_tempfile_as_json(data, **kwargs):
     If no dir is specified, file is created in the app root."""
     kwargs.update({'suffix': '.json'})
     fout, filename = get_tempfile_for_write(**kwargs)
-    fout.write(json.dumps(data, indent=2))
-    fout.close()
+    with fout:
+        extractfile.write_extract(data, fout)
     return filename
 
 
+def save_as_json_atomically(data, filename):
+    """Saves data as JSON to filename, via a temporary file in the same
+    directory which is renamed over it, so readers never see a partial file.
+    The format follows the suffix of filename, see `extractfile`."""
+    return extractfile.save_extract(data, filename)
+
+
 def save_to_tempfile_as_lines(lines, **kwargs):
     """Saves lines to a .txt tempfile and returns the filename. Appends a
     newline at the end of each line."""
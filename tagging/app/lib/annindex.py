@@ -0,0 +1,212 @@
+"""
+annindex.py
+
+approximate nearest neighbour index over the embeddings of wikipedia events,
+an inverted file of the events clustered around k-means centroids which is
+built offline and memory mapped for searching
+
+An index directory holds:
+    index.json         model, dimension and counts of the index
+    centroids.npy      nlist x dim centroids of the clusters
+    list_offsets.npy   nlist + 1 offsets of the clusters into the vectors
+    vectors.npy        count x dim event embeddings, grouped by cluster
+    events.jsonl       the event of each vector, one JSON object per line
+    event_offsets.npy  count + 1 byte offsets of the lines of events.jsonl
+"""
+import functools as ft
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from app import app, metrics
+from app.lib import embeddings
+
+
+KMEANS_ITERATIONS = 10
+TRAIN_POINTS_PER_LIST = 256
+CHUNK_ROWS = 65536
+
+
+class EventIndex(object):
+    """A built index, searched with unit length query embeddings."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as fin:
+            self.info = json.load(fin)
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.list_offsets = np.load(os.path.join(path, 'list_offsets.npy'))
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.event_offsets = np.load(os.path.join(path, 'event_offsets.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'events.jsonl'), 'rb') as fin:
+            self.events = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def event(self, i):
+        """Returns the event of vector i."""
+        start, end = self.event_offsets[i], self.event_offsets[i+1]
+        return json.loads(self.events[start:end].decode('utf-8'))
+
+    def search(self, queries, k=10, nprobe=8):
+        """Returns the k nearest events of each query, as a list of (vector
+        id, similarity) pairs in order of similarity, searching the nprobe
+        clusters with the nearest centroids."""
+        with metrics.timer('ann_search_seconds'):
+            probes = np.argsort(-queries.dot(self.centroids.T), axis=1)[:, :nprobe]
+            return [self._search_lists(q, lists, k) for (q, lists) in zip(queries, probes)]
+
+    def _search_lists(self, query, lists, k):
+        offsets = self.list_offsets
+        ids = np.concatenate([np.arange(offsets[l], offsets[l+1]) for l in lists])
+        if not len(ids):
+            return []
+        sims = np.concatenate([self.vectors[self.list_offsets[l]:self.list_offsets[l+1]].dot(query)
+                               for l in lists])
+        top = np.argpartition(-sims, k - 1)[:k] if len(sims) > k else np.arange(len(sims))
+        top = top[np.argsort(-sims[top])]
+        return [(int(ids[t]), float(sims[t])) for t in top]
+
+
+def build_index(path, events, nlist=None, batch_size=1000):
+    """Builds an index at path over events, an iterable of event dicts with a
+    'text', embedding the texts in batches. The index replaces any existing
+    one at path once it is complete.
+
+    Returns the number of events indexed."""
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix='.tmp-index-')
+    try:
+        count, dim, raw_offsets = _write_embeddings(tmpdir, events, batch_size)
+        if not count:
+            raise ValueError('No events to index')
+        raw = np.memmap(os.path.join(tmpdir, 'raw.f32'), dtype=np.float32, mode='r',
+                        shape=(count, dim))
+        nlist = nlist or max(1, min(count, int(4 * np.sqrt(count))))
+        centroids = kmeans(raw, nlist)
+        assign = nearest(raw, centroids)
+        order = np.argsort(assign, kind='mergesort')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        _write_index(tmpdir, raw, raw_offsets, order, centroids, list_offsets)
+        del raw
+        os.unlink(os.path.join(tmpdir, 'raw.f32'))
+        os.unlink(os.path.join(tmpdir, 'raw.jsonl'))
+        with open(os.path.join(tmpdir, 'index.json'), 'w') as fout:
+            json.dump({'model': embeddings.model_name(), 'dim': dim,
+                       'count': count, 'nlist': nlist}, fout)
+
+        if os.path.exists(path):
+            old = path + '.old'
+            os.rename(path, old)
+            os.rename(tmpdir, path)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmpdir, path)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return count
+
+
+def _write_embeddings(tmpdir, events, batch_size):
+    """Embeds the events in batches, appending the raw float32 rows to
+    raw.f32 and the events to raw.jsonl. Returns the count, the dimension and
+    the byte offsets of the events."""
+    dim, offsets = None, [0]
+    with open(os.path.join(tmpdir, 'raw.f32'), 'wb') as fvec, \
+            open(os.path.join(tmpdir, 'raw.jsonl'), 'wb') as fevents:
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) == batch_size:
+                dim = _write_batch(batch, fvec, fevents, offsets)
+                batch = []
+        if batch:
+            dim = _write_batch(batch, fvec, fevents, offsets)
+    logging.info('Embedded %d events', len(offsets) - 1)
+    return len(offsets) - 1, dim, offsets
+
+
+def _write_batch(batch, fvec, fevents, offsets):
+    vectors = embeddings.embed_texts([e['text'] for e in batch])
+    fvec.write(vectors.astype(np.float32).tobytes())
+    for event in batch:
+        line = (json.dumps(event) + '\n').encode('utf-8')
+        fevents.write(line)
+        offsets.append(offsets[-1] + len(line))
+    return vectors.shape[1]
+
+
+def _write_index(tmpdir, raw, raw_offsets, order, centroids, list_offsets):
+    """Writes the vectors and the events grouped by cluster, in order."""
+    np.save(os.path.join(tmpdir, 'centroids.npy'), centroids)
+    np.save(os.path.join(tmpdir, 'list_offsets.npy'), list_offsets.astype(np.int64))
+
+    vectors = np.lib.format.open_memmap(os.path.join(tmpdir, 'vectors.npy'), mode='w+',
+                                        dtype=np.float32, shape=raw.shape)
+    for i in range(0, len(order), CHUNK_ROWS):
+        vectors[i:i+CHUNK_ROWS] = raw[order[i:i+CHUNK_ROWS]]
+    vectors.flush()
+    del vectors
+
+    offsets = [0]
+    with open(os.path.join(tmpdir, 'raw.jsonl'), 'rb') as fin, \
+            open(os.path.join(tmpdir, 'events.jsonl'), 'wb') as fout:
+        lines = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        for i in order:
+            line = lines[raw_offsets[i]:raw_offsets[i+1]]
+            fout.write(line)
+            offsets.append(offsets[-1] + len(line))
+        lines.close()
+    np.save(os.path.join(tmpdir, 'event_offsets.npy'), np.array(offsets, dtype=np.int64))
+
+
+def kmeans(points, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means of unit length points, trained on a sample of up to
+    TRAIN_POINTS_PER_LIST points per cluster. Returns the k unit length
+    centroids."""
+    rng = np.random.RandomState(seed)
+    sample_size = min(len(points), k * TRAIN_POINTS_PER_LIST)
+    sample = np.asarray(points[np.sort(rng.choice(len(points), sample_size, replace=False))])
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = nearest(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=k) == 0
+        # reseed the empty clusters with random points
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = embeddings.normalize(sums)
+    return centroids
+
+
+def nearest(points, centroids, chunk_rows=8192):
+    """Returns the index of the nearest centroid of each point, a chunk of
+    points at a time to bound the size of the similarity matrix."""
+    return np.concatenate([np.argmax(np.asarray(points[i:i+chunk_rows]).dot(centroids.T), axis=1)
+                           for i in range(0, len(points), chunk_rows)])
+
+
+@ft.lru_cache(maxsize=None)
+def event_index():
+    """Returns the index at EVENT_INDEX_PATH, relative paths are from the
+    tagging directory, or None if it has not been built or was built with
+    another model."""
+    path = os.path.join(os.path.dirname(app.root_path), app.config['EVENT_INDEX_PATH'])
+    if not os.path.exists(os.path.join(path, 'index.json')):
+        logging.info('No event index at %s', path)
+        return None
+
+    index = EventIndex(path)
+    if index.info['model'] != embeddings.model_name():
+        logging.warn('Event index at %s was built with %s, not %s', path,
+                     index.info['model'], embeddings.model_name())
+        return None
+    return index
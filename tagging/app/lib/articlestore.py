@@ -0,0 +1,255 @@
+"""
+articlestore.py
+
+local storage of fetched wikipedia articles keyed by url
+"""
+import bisect
+import fcntl
+import hashlib
+import mmap
+import os
+from os import path
+import struct
+import threading
+import zlib
+
+
+INDEX_MAGIC = b'TLIDX001'
+# magic, number of records at the start of the index which are sorted
+INDEX_HEADER = struct.Struct('<8sQ')
+# url digest, offset and length of the compressed article in the pack
+INDEX_RECORD = struct.Struct('<16sQI')
+COMPRESS_LEVEL = 6
+
+
+class ArticleStore(object):
+    """Base class of the article stores, a mapping of url to article html."""
+
+    def get(self, url):
+        """Returns the article stored for the url or None."""
+        raise NotImplementedError
+
+    def put(self, url, html):
+        """Stores the article for the url."""
+        raise NotImplementedError
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def close(self):
+        pass
+
+
+class DirectoryStore(ArticleStore):
+    """Stores each article as a compressed file in a directory tree sharded
+    by the digest of its url, eg. root/3f/a2/3fa2...c9.z"""
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, url):
+        try:
+            with open(self._path(url), 'rb') as fin:
+                return zlib.decompress(fin.read()).decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, html):
+        filename = self._path(url)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        # write to a temporary file and rename so readers never see a partial article
+        tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpname, 'wb') as fout:
+            fout.write(zlib.compress(html.encode('utf-8'), COMPRESS_LEVEL))
+        os.rename(tmpname, filename)
+
+    def _path(self, url):
+        digest = url_digest(url).hex()
+        return path.join(self.root, digest[:2], digest[2:4], digest + '.z')
+
+
+class PackStore(ArticleStore):
+    """Stores articles compressed in a single append-only pack file with a
+    fixed width offset index, both of which are memory mapped.
+
+    The index starts with a run of records sorted by url digest which is
+    binary searched in place, followed by the records appended since the
+    last compaction which are held in a dict. Reads decompress straight out
+    of the mapped pack without copying it. Appends from several processes
+    are serialised with a lock on the pack file, and the threads of a process
+    share the index and the maps under a lock of the store.
+    """
+    def __init__(self, prefix):
+        self.pack_path = prefix + '.pack'
+        self.index_path = prefix + '.idx'
+        os.makedirs(path.dirname(path.abspath(prefix)), exist_ok=True)
+        with _locked(self.pack_path):
+            if not path.exists(self.index_path):
+                _write_index(self.index_path, [])
+        self._lock = threading.Lock()
+        self._pack_map = None
+        self._open_index()
+
+    def get(self, url):
+        with self._lock:
+            return self._get(url)
+
+    def _get(self, url):
+        digest = url_digest(url)
+        loc = self._locate(digest)
+        if loc is None:
+            # the index may have been appended to by another process
+            self._refresh_index()
+            loc = self._locate(digest)
+        if loc is None:
+            return None
+
+        offset, length = loc
+        if self._pack_map is None or offset + length > len(self._pack_map):
+            self._map_pack()
+        with memoryview(self._pack_map) as view, view[offset:offset+length] as data:
+            return zlib.decompress(data).decode('utf-8')
+
+    def put(self, url, html):
+        digest = url_digest(url)
+        data = zlib.compress(html.encode('utf-8'), COMPRESS_LEVEL)
+        with self._lock, _locked(self.pack_path) as fpack:
+            self._refresh_index()
+            if self._locate(digest) is not None:
+                return
+            offset = os.fstat(fpack.fileno()).st_size
+            fpack.write(data)
+            fpack.flush()
+            with open(self.index_path, 'ab') as findex:
+                findex.write(INDEX_RECORD.pack(digest, offset, len(data)))
+            self._tail[digest] = (offset, len(data))
+
+    def compact(self):
+        """Rewrites the index with all the records sorted."""
+        with self._lock, _locked(self.pack_path):
+            self._refresh_index()
+            records = dict(self._sorted_records())
+            records.update(self._tail)
+            _write_index(self.index_path, sorted(records.items()))
+            self._index_map.close()
+            self._open_index()
+
+    def close(self):
+        with self._lock:
+            for mapped in (self._pack_map, self._index_map):
+                if mapped is not None:
+                    mapped.close()
+            self._pack_map = self._index_map = None
+
+    def __len__(self):
+        with self._lock:
+            self._refresh_index()
+            return self._num_sorted + len(self._tail)
+
+    def _open_index(self):
+        """Maps the index and reads the records after the sorted run."""
+        with open(self.index_path, 'rb') as findex:
+            self._index_stat = os.fstat(findex.fileno())
+            self._index_map = mmap.mmap(findex.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._num_sorted = INDEX_HEADER.unpack_from(self._index_map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{} is not an article index'.format(self.index_path))
+        self._tail = {}
+        self._index_size = INDEX_HEADER.size + self._num_sorted * INDEX_RECORD.size
+        self._read_tail()
+
+    def _refresh_index(self):
+        """Picks up records appended or an index compacted by another process."""
+        stat = os.stat(self.index_path)
+        if stat.st_ino != self._index_stat.st_ino:
+            self._index_map.close()
+            self._open_index()
+        elif stat.st_size > self._index_size:
+            with open(self.index_path, 'rb') as findex:
+                findex.seek(self._index_size)
+                self._read_tail(findex.read(stat.st_size - self._index_size))
+
+    def _read_tail(self, data=None):
+        if data is None:
+            data = self._index_map[self._index_size:]
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        for digest, offset, length in INDEX_RECORD.iter_unpack(data[:usable]):
+            self._tail[digest] = (offset, length)
+        self._index_size += usable
+
+    def _locate(self, digest):
+        loc = self._tail.get(digest)
+        if loc is not None:
+            return loc
+
+        idx = bisect.bisect_left(_SortedDigests(self), digest)
+        if idx < self._num_sorted:
+            found, offset, length = self._record(idx)
+            if found == digest:
+                return offset, length
+        return None
+
+    def _record(self, idx):
+        return INDEX_RECORD.unpack_from(self._index_map,
+                                        INDEX_HEADER.size + idx * INDEX_RECORD.size)
+
+    def _sorted_records(self):
+        for idx in range(self._num_sorted):
+            digest, offset, length = self._record(idx)
+            yield digest, (offset, length)
+
+    def _map_pack(self):
+        if self._pack_map is not None:
+            self._pack_map.close()
+        with open(self.pack_path, 'rb') as fpack:
+            self._pack_map = mmap.mmap(fpack.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _SortedDigests(object):
+    """Sequence view of the digests in the sorted run of a pack index."""
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store._num_sorted
+
+    def __getitem__(self, idx):
+        return self.store._record(idx)[0]
+
+
+def store_from_config(kind, location):
+    """Returns the article store of a kind ('dir' or 'pack') at a location."""
+    if kind == 'dir':
+        return DirectoryStore(location)
+    elif kind == 'pack':
+        return PackStore(location)
+    raise ValueError('Don\'t understand article store %s' % (kind))
+
+
+def url_digest(url):
+    return hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+
+
+class _locked(object):
+    """Opens a file for appending and holds an exclusive lock on it. The file
+    is opened afresh each time so forked processes do not share the lock."""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        self.fout = open(self.filename, 'ab')
+        fcntl.flock(self.fout.fileno(), fcntl.LOCK_EX)
+        return self.fout
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fout.fileno(), fcntl.LOCK_UN)
+        self.fout.close()
+
+
+def _write_index(index_path, records):
+    """Writes an index of sorted (digest, (offset, length)) records."""
+    tmpname = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmpname, 'wb') as fout:
+        fout.write(INDEX_HEADER.pack(INDEX_MAGIC, len(records)))
+        for digest, (offset, length) in records:
+            fout.write(INDEX_RECORD.pack(digest, offset, length))
+    os.rename(tmpname, index_path)
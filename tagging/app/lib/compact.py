@@ -0,0 +1,377 @@
+"""
+compact.py
+
+compact columnar representation of a video extract. Strings are interned in
+a vocabulary, entities are (text, label) id pairs, per sentence and per event
+lists are flat arrays with offsets, context windows are ranges over the
+caption entities and wiki candidates shared by events are stored once.
+
+pack and unpack convert losslessly between an extract, in the JSON shape the
+pipeline produces, and its compact form; dumps and loads serialize the
+compact form with msgpack.
+"""
+from array import array
+import json
+import sys
+
+import msgpack
+
+
+VERSION = 1
+MIMETYPE = 'application/x-msgpack'
+
+# flags of the optional keys of an event
+HAS_ENTS, HAS_WIKI, HAS_MATCH, HAS_SCORES = 1, 2, 4, 8
+EVENT_KEYS = ('text', 'date', 'ents', 'wiki', 'match', 'scores')
+CANDIDATE_KEYS = ('text', 'links', 'ents')
+TOPIC_KEYS = ('href', 'title', 'wbid')
+WINDOW_KEYS = ('item', 'before', 'after')
+EXTRACT_KEYS = ('video_id', 'captions', 'heidel', 'events')
+
+# typecodes of the array columns
+ARRAYS = {
+    'ents': 'I',
+    'timestamps': 'd',
+    'sent_ents': 'I', 'sent_offsets': 'I',
+    'event_offsets': 'I', 'event_text': 'I', 'event_date': 'I', 'event_flags': 'B',
+    'event_windows': 'i',
+    'event_wiki': 'I', 'event_wiki_offsets': 'I',
+    'cand_text': 'I', 'cand_flags': 'B',
+    'cand_links': 'I', 'cand_link_offsets': 'I',
+    'cand_ents': 'I', 'cand_ent_offsets': 'I',
+    'match_idx': 'i', 'match_score': 'd',
+    'match_topics': 'i', 'match_topic_offsets': 'I',
+    'scores': 'd', 'score_offsets': 'I',
+}
+
+
+class _Packer(object):
+    """Interns the strings, entities and wiki candidates of an extract."""
+    def __init__(self):
+        self.strings, self.string_ids = [], {}
+        self.c = dict((name, array(code)) for (name, code) in ARRAYS.items())
+        self.ents, self.ent_ids = self.c['ents'], {}
+        self.cand_keys, self.cand_ids = [], {}
+        for name in ('sent_offsets', 'event_offsets', 'event_wiki_offsets', 'cand_link_offsets',
+                     'cand_ent_offsets', 'match_topic_offsets', 'score_offsets'):
+            self.c[name].append(0)
+        self.cand_extra = []
+
+    def sid(self, string):
+        sid = self.string_ids.get(string)
+        if sid is None:
+            sid = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return sid
+
+    def eid(self, ent):
+        key = (self.sid(ent[0]), self.sid(ent[1]))
+        eid = self.ent_ids.get(key)
+        if eid is None:
+            eid = self.ent_ids[key] = len(self.ent_ids)
+            self.ents.extend(key)
+        return eid
+
+    def cand_key(self, cand):
+        """Returns the interned form of a candidate, which identifies it."""
+        ents = cand.get('ents')
+        extra = dict((k, v) for (k, v) in cand.items() if k not in CANDIDATE_KEYS)
+        return (self.sid(cand['text']),
+                tuple(self.sid(l) for l in cand['links']),
+                None if ents is None else tuple(self.eid(e) for e in ents),
+                json.dumps(extra, sort_keys=True) if extra else None)
+
+    def cid(self, cand):
+        key = self.cand_key(cand)
+        cid = self.cand_ids.get(key)
+        if cid is None:
+            c = self.c
+            cid = self.cand_ids[key] = len(self.cand_keys)
+            self.cand_keys.append(key)
+            text, links, ents, extra = key
+            c['cand_text'].append(text)
+            c['cand_links'].extend(links)
+            c['cand_link_offsets'].append(len(c['cand_links']))
+            c['cand_flags'].append(0 if ents is None else HAS_ENTS)
+            c['cand_ents'].extend(ents or ())
+            c['cand_ent_offsets'].append(len(c['cand_ents']))
+            if extra:
+                self.cand_extra.append([cid, json.loads(extra)])
+        return cid
+
+
+def pack(video_extract):
+    """Returns the compact form of a video extract."""
+    p = _Packer()
+    c = p.c
+    captions = video_extract['captions']
+
+    sent_offsets = c['sent_offsets']
+    for ents in captions['ents']:
+        c['sent_ents'].extend(p.eid(e) for e in ents)
+        sent_offsets.append(len(c['sent_ents']))
+
+    # timestamps are the start attributes of the captions, kept as floats
+    # with the text of those which don't read back the same
+    timestamps, timestamp_text = captions.get('timestamps'), []
+    as_floats = timestamps is not None and all(isinstance(ts, float) for ts in timestamps)
+    if timestamps is not None:
+        for i, ts in enumerate(timestamps):
+            value = _float_or_nan(ts)
+            c['timestamps'].append(value)
+            if not as_floats and ts != repr(value):
+                timestamp_text.append([i, ts])
+
+    event_extra = []
+    idx = 0
+    for i, sent in enumerate(video_extract['events']):
+        for event in sent:
+            extra = _pack_event(p, event, i, idx)
+            if extra:
+                event_extra.append([idx, extra])
+            idx += 1
+        c['event_offsets'].append(idx)
+
+    compact = {
+        'version': VERSION,
+        'byteorder': sys.byteorder,
+        'video_id': video_extract['video_id'],
+        'strings': p.strings,
+        'sents': list(captions['sents']),
+        'has_timestamps': timestamps is not None,
+        'timestamps_as_floats': as_floats,
+        'timestamp_text': timestamp_text,
+        'caption_extra': dict((k, v) for (k, v) in captions.items()
+                              if k not in ('sents', 'ents', 'timestamps')),
+        'heidel': video_extract['heidel'],
+        'event_extra': event_extra,
+        'cand_extra': p.cand_extra,
+        'extra': dict((k, v) for (k, v) in video_extract.items() if k not in EXTRACT_KEYS),
+    }
+    compact.update(c)
+    return compact
+
+
+def _pack_event(p, event, sent_idx, idx):
+    """Appends an event to the event columns, returns the keys of the event
+    which don't fit the columns."""
+    c = p.c
+    extra = dict((k, v) for (k, v) in event.items() if k not in EVENT_KEYS)
+    flags = 0
+    c['event_text'].append(p.sid(event['text']))
+    c['event_date'].append(p.sid(event['date']))
+
+    ranges = [-1] * 6
+    if 'ents' in event:
+        flags |= HAS_ENTS
+        ranges = _window_ranges(p, event['ents'], sent_idx)
+        if ranges is None:
+            extra['ents'] = event['ents']
+            ranges = [-1] * 6
+    c['event_windows'].extend(ranges)
+
+    cids = []
+    if 'wiki' in event:
+        flags |= HAS_WIKI
+        cids = [p.cid(cand) for cand in event['wiki']]
+        c['event_wiki'].extend(cids)
+    c['event_wiki_offsets'].append(len(c['event_wiki']))
+
+    match_idx, match_score, topics = -1, 0.0, None
+    if 'match' in event:
+        flags |= HAS_MATCH
+        match = event['match']
+        if match is not None:
+            packed = _packed_match(p, match, cids)
+            if packed is None:
+                extra['match'] = match
+            else:
+                match_idx, match_score, topics = packed
+    c['match_idx'].append(match_idx)
+    c['match_score'].append(match_score)
+    if topics is not None:
+        c['match_topics'].append(len(topics))
+        for topic in topics:
+            c['match_topics'].extend(topic)
+    else:
+        c['match_topics'].append(-1)
+    c['match_topic_offsets'].append(len(c['match_topics']))
+
+    if 'scores' in event:
+        flags |= HAS_SCORES
+        if all(len(pair) == 2 for pair in event['scores']):
+            for pair in event['scores']:
+                c['scores'].extend(pair)
+        else:
+            extra['scores'] = event['scores']
+    c['score_offsets'].append(len(c['scores']))
+
+    c['event_flags'].append(flags)
+    return extra
+
+
+def _window_ranges(p, ents, sent_idx):
+    """Returns the context windows of an event as ranges over the flat
+    caption entities, the item and after windows start at the event's
+    sentence and the before window ends there. None if they don't."""
+    flat, offsets = p.c['sent_ents'], p.c['sent_offsets']
+    if not isinstance(ents, dict) or set(ents) != set(WINDOW_KEYS) or sent_idx >= len(offsets) - 1:
+        return None
+
+    start = offsets[sent_idx]
+    ranges = []
+    for key in WINDOW_KEYS:
+        ids = [p.eid(e) for e in ents[key]]
+        lo = start - len(ids) if key == 'before' else start
+        hi = lo + len(ids)
+        if lo < 0 or hi > len(flat) or list(flat[lo:hi]) != ids:
+            return None
+        ranges.extend((lo, hi))
+    return ranges
+
+
+def _packed_match(p, match, cids):
+    """Returns the candidate index, score and link topics of a match if it is
+    the candidate at its idx with a score and topics added, otherwise None."""
+    idx, score = match.get('idx'), match.get('score')
+    if not isinstance(idx, int) or not 0 <= idx < len(cids) or not isinstance(score, float):
+        return None
+
+    cand = dict((k, v) for (k, v) in match.items() if k not in ('idx', 'score', 'wptopics'))
+    if p.cand_key(cand) != p.cand_keys[cids[idx]]:
+        return None
+
+    topics = match.get('wptopics')
+    if topics is None:
+        return (idx, score, None) if 'wptopics' not in match else None
+    packed = []
+    for topic in topics:
+        if not isinstance(topic, dict) or set(topic) != set(TOPIC_KEYS):
+            return None
+        wbid = -1 if topic['wbid'] is None else p.sid(topic['wbid'])
+        packed.append((p.sid(topic['href']), p.sid(topic['title']), wbid))
+    return idx, score, packed
+
+
+def unpack(compact):
+    """Returns the video extract in the JSON shape given its compact form."""
+    strings = compact['strings']
+    ents = compact['ents']
+    ent_list = [[strings[ents[k]], strings[ents[k+1]]] for k in range(0, len(ents), 2)]
+
+    flat = [ent_list[e] for e in compact['sent_ents']]
+    sent_offsets = compact['sent_offsets']
+    captions = {
+        'sents': list(compact['sents']),
+        'ents': [[list(e) for e in flat[sent_offsets[i]:sent_offsets[i+1]]]
+                 for i in range(len(sent_offsets) - 1)],
+    }
+    if compact['has_timestamps']:
+        timestamps = list(compact['timestamps'])
+        if not compact['timestamps_as_floats']:
+            timestamps = [repr(ts) for ts in timestamps]
+        for i, text in compact['timestamp_text']:
+            timestamps[i] = text
+        captions['timestamps'] = timestamps
+    captions.update(compact['caption_extra'])
+
+    cand_extra = dict((cid, extra) for (cid, extra) in compact['cand_extra'])
+    event_extra = dict((idx, extra) for (idx, extra) in compact['event_extra'])
+    event_offsets = compact['event_offsets']
+    events = []
+    for i in range(len(event_offsets) - 1):
+        events.append([_event(compact, strings, flat, ent_list, cand_extra,
+                              event_extra.get(idx, {}), idx)
+                       for idx in range(event_offsets[i], event_offsets[i+1])])
+
+    video_extract = {
+        'video_id': compact['video_id'],
+        'captions': captions,
+        'heidel': compact['heidel'],
+        'events': events,
+    }
+    video_extract.update(compact['extra'])
+    return video_extract
+
+
+def _event(c, strings, flat, ent_list, cand_extra, extra, idx):
+    flags = c['event_flags'][idx]
+    event = {'text': strings[c['event_text'][idx]], 'date': strings[c['event_date'][idx]]}
+
+    if flags & HAS_ENTS:
+        ranges = c['event_windows'][6*idx:6*idx+6]
+        if ranges[0] >= 0:
+            event['ents'] = dict((key, [list(e) for e in flat[ranges[2*k]:ranges[2*k+1]]])
+                                 for (k, key) in enumerate(WINDOW_KEYS))
+
+    wiki_offsets = c['event_wiki_offsets']
+    cids = c['event_wiki'][wiki_offsets[idx]:wiki_offsets[idx+1]]
+    if flags & HAS_WIKI:
+        event['wiki'] = [_candidate(strings, c, cid, cand_extra, ent_list) for cid in cids]
+
+    if flags & HAS_MATCH:
+        match_idx = c['match_idx'][idx]
+        if match_idx < 0:
+            event['match'] = None
+        else:
+            match = _candidate(strings, c, cids[match_idx], cand_extra, ent_list)
+            match.update({'idx': match_idx, 'score': c['match_score'][idx]})
+            topic_offsets = c['match_topic_offsets']
+            topics = c['match_topics'][topic_offsets[idx]:topic_offsets[idx+1]]
+            if topics[0] >= 0:
+                match['wptopics'] = [
+                    {'href': strings[topics[k]], 'title': strings[topics[k+1]],
+                     'wbid': None if topics[k+2] < 0 else strings[topics[k+2]]}
+                    for k in range(1, len(topics), 3)]
+            event['match'] = match
+
+    if flags & HAS_SCORES:
+        scores = c['scores'][c['score_offsets'][idx]:c['score_offsets'][idx+1]]
+        event['scores'] = [[scores[k], scores[k+1]] for k in range(0, len(scores), 2)]
+
+    event.update(extra)
+    return dict((k, event[k]) for k in _event_key_order(event))
+
+
+def _event_key_order(event):
+    return [k for k in EVENT_KEYS if k in event] + [k for k in event if k not in EVENT_KEYS]
+
+
+def _candidate(strings, c, cid, cand_extra, ent_list):
+    links = c['cand_links'][c['cand_link_offsets'][cid]:c['cand_link_offsets'][cid+1]]
+    cand = {'text': strings[c['cand_text'][cid]], 'links': [strings[l] for l in links]}
+    if c['cand_flags'][cid] & HAS_ENTS:
+        ents = c['cand_ents'][c['cand_ent_offsets'][cid]:c['cand_ent_offsets'][cid+1]]
+        cand['ents'] = [list(ent_list[e]) for e in ents]
+    cand.update(cand_extra.get(cid, {}))
+    return cand
+
+
+def dumps(compact):
+    """Serializes a compact extract with msgpack, array columns are written
+    as raw bytes."""
+    data = dict(compact)
+    for name in ARRAYS:
+        data[name] = data[name].tobytes()
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def loads(data):
+    """Deserializes a compact extract written by dumps."""
+    compact = msgpack.unpackb(data, raw=False)
+    swap = compact['byteorder'] != sys.byteorder
+    for (name, code) in ARRAYS.items():
+        column = array(code)
+        column.frombytes(compact[name])
+        if swap:
+            column.byteswap()
+        compact[name] = column
+    compact['byteorder'] = sys.byteorder
+    return compact
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
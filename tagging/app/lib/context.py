@@ -0,0 +1,78 @@
+"""
+context.py
+
+entity context windows around the sentences of a transcript
+"""
+import bisect
+import itertools
+import logging
+
+
+class EntityContext(object):
+    """Entities of a transcript arranged for constant time context windows.
+
+    The entities of all the sentences are kept in a single flat list along
+    with the offset at which each sentence begins, so the entities of any
+    run of sentences is one slice of the flat list. Windows can be measured
+    in sentences or, when the sentences have timestamps, in seconds.
+    """
+    def __init__(self, sent_ents, timestamps=None):
+        self.sent_ents = sent_ents
+        self.flat = [e for ents in sent_ents for e in ents]
+        self.offsets = [0] + list(itertools.accumulate(len(ents) for ents in sent_ents))
+        self.times = _times_for_sents(timestamps, len(sent_ents))
+
+    def __len__(self):
+        return len(self.sent_ents)
+
+    def bounds_by_sents(self, i, bef=1, aft=1):
+        """Returns the (lo, hi) sentence range of a window of bef sentences
+        before and aft sentences after sentence i."""
+        return max(0, i-bef), min(i+aft+1, len(self))
+
+    def bounds_by_secs(self, i, secs):
+        """Returns the (lo, hi) sentence range of the sentences starting
+        within secs seconds of sentence i. Sentence i is always included."""
+        if self.times is None:
+            raise ValueError('Sentences do not have timestamps')
+        ts = self.times[i]
+        lo = bisect.bisect_left(self.times, ts - secs, 0, i)
+        hi = bisect.bisect_right(self.times, ts + secs, i+1)
+        return lo, hi
+
+    def window(self, i, lo, hi):
+        """Returns the context window of sentence i for the sentence range
+        [lo, hi). The window after includes the sentence itself."""
+        return {
+            'item': list(self.sent_ents[i]),
+            'before': self.flat[self.offsets[lo]:self.offsets[i]],
+            'after': self.flat[self.offsets[i]:self.offsets[hi]],
+        }
+
+    def windows(self, secs=None, bef=1, aft=1):
+        """Yields the context window for each sentence. Windows span secs
+        seconds either side when given and the sentences have timestamps,
+        otherwise bef and aft sentences."""
+        if secs is not None and self.times is None:
+            logging.info('No usable timestamps, using windows of sentences')
+            secs = None
+
+        for i in range(len(self)):
+            if secs is None:
+                lo, hi = self.bounds_by_sents(i, bef, aft)
+            else:
+                lo, hi = self.bounds_by_secs(i, secs)
+            yield self.window(i, lo, hi)
+
+
+def _times_for_sents(timestamps, num_sents):
+    """Returns the timestamps as floats if there is one for each sentence and
+    they are in order, None otherwise."""
+    if not timestamps or len(timestamps) != num_sents:
+        return None
+
+    times = [float(ts) for ts in timestamps]
+    if any(t1 < t0 for (t0, t1) in zip(times, times[1:])):
+        logging.warn('Timestamps are not in order')
+        return None
+    return times
@@ -0,0 +1,216 @@
+"""
+datevalue.py
+
+parses HeidelTime date values into date ranges and plans which wikipedia
+pages and sections to fetch for a date
+"""
+import calendar
+import collections
+import datetime
+import functools
+import logging
+import re
+
+
+# start and end are inclusive (year, month, day) tuples, BC years are negative
+DateRange = collections.namedtuple('DateRange', 'start end grain')
+# sections: ((year_title, month_name), ...) sections of year pages to fetch
+# day_pages: ((year_title, month_name, day), ...) date pages to fetch
+# days: frozenset of (year, month, day) the events must fall on, or None
+FetchPlan = collections.namedtuple('FetchPlan', 'sections day_pages days')
+
+
+MONTH_NAMES = [
+    None, 'January', 'February', 'March', 'April', 'May', 'June', 'July',
+    'August', 'September', 'October', 'November', 'December'
+]
+MONTHS_BY_NAME = dict((name, idx) for (idx, name) in enumerate(MONTH_NAMES) if name)
+# months of a season, winter runs from the december of the year
+SEASON_MONTHS = {
+    'SP': (3, 5),
+    'SU': (6, 8),
+    'AU': (9, 11),
+    'FA': (9, 11),
+    'WI': (12, 14),
+}
+VALUE_REGEX = r"""
+    (?P<bc>BC)?
+    (?:
+        (?P<year>\d{4})
+        (?:
+            -(?P<month>\d{2})(?:-(?P<day>\d{2}))?
+          | -W(?P<week>\d{2})(?:-(?P<wday>[1-7]|WE))?
+          | -(?P<season>SP|SU|AU|FA|WI)
+          | -Q(?P<quarter>[1-4])
+          | -H(?P<half>[12])
+        )?
+      | (?P<decade>\d{3})X?
+      | (?P<century>\d{2})(?:XX)?
+    )
+"""
+VALUE_MATCH = re.compile(VALUE_REGEX, re.VERBOSE)
+# Leading date of a year page bullet, eg. 'March 15 - ' or 'March 15-17 - ',
+# days are one or two digits so 'March 15 - 2011 protests' is a single day
+BULLET_DATE_REGEX = r"""
+    \s*(?P<month>{})\s+
+    (?P<first>\d{{1,2}})(?!\d)
+    (?:\s*[-–]\s*(?P<last>\d{{1,2}})(?!\d))?
+""".format('|'.join(MONTH_NAMES[1:]))
+BULLET_DATE_MATCH = re.compile(BULLET_DATE_REGEX, re.VERBOSE)
+
+
+@functools.lru_cache(maxsize=4096)
+def date_range(value):
+    """Given a HeidelTime date value, returns the DateRange it covers or None
+    if the value does not refer to a known year.
+
+    The following values are understood, anything following them such as a
+    time of day is ignored. BC may prefix any of them.
+    YYYY-MM-DD -> day
+    YYYY-Www-D -> day of an ISO week
+    YYYY-Www-WE -> weekend of an ISO week
+    YYYY-Www   -> ISO week
+    YYYY-MM    -> month
+    YYYY-SN    -> season (SP, SU, AU or FA, WI)
+    YYYY-Qn    -> quarter
+    YYYY-Hn    -> half year
+    YYYY       -> year
+    YYY, YYYX  -> decade
+    YY, YYXX   -> century
+    """
+    match = VALUE_MATCH.match(value)
+    if not match:
+        return None
+
+    m = match.groupdict()
+    sign = -1 if m['bc'] else 1
+    try:
+        if m['decade']:
+            first = int(m['decade']) * 10
+            return _year_range(sign, first, first + 9, 'decade')
+        if m['century']:
+            first = int(m['century']) * 100
+            return _year_range(sign, first, first + 99, 'century')
+
+        year = int(m['year'])
+        if m['day']:
+            month, day = int(m['month']), int(m['day'])
+            _check_day(year, month, day)
+            return DateRange((sign*year, month, day), (sign*year, month, day), 'day')
+        if m['month']:
+            month = int(m['month'])
+            if not 1 <= month <= 12:
+                raise ValueError('month {} out of range'.format(month))
+            return _month_range(sign*year, month, month, 'month')
+        if m['week'] and sign > 0:
+            return _week_range(year, int(m['week']), m['wday'])
+        if m['season']:
+            first, last = SEASON_MONTHS[m['season']]
+            return _month_range(sign*year, first, last, 'season')
+        if m['quarter']:
+            last = int(m['quarter']) * 3
+            return _month_range(sign*year, last - 2, last, 'quarter')
+        if m['half']:
+            last = int(m['half']) * 6
+            return _month_range(sign*year, last - 5, last, 'half')
+        return _year_range(sign, year, year, 'year')
+    except ValueError as e:
+        logging.info('Invalid date value %s: %s', value, e)
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def fetch_plan(value, max_years=2):
+    """Given a HeidelTime date value, returns a FetchPlan of the wikipedia
+    year page sections and date pages which hold the events of that date.
+
+    Returns None when the value has no known year or spans more than
+    max_years years, since there would be too many candidates to score.
+    """
+    drange = date_range(value)
+    if drange is None:
+        return None
+
+    (y0, m0, d0), (y1, m1, _) = drange.start, drange.end
+    if y1 - y0 + 1 > max_years:
+        logging.info('Date value %s spans more than %d years', value, max_years)
+        return None
+
+    sections = []
+    for year in range(y0, y1 + 1):
+        first = m0 if year == y0 else 1
+        last = m1 if year == y1 else 12
+        sections.extend((year_title(year), MONTH_NAMES[m]) for m in range(first, last + 1))
+
+    day_pages, days = (), None
+    if drange.grain == 'day':
+        day_pages = ((year_title(y0), MONTH_NAMES[m0], str(d0)),)
+    if drange.grain in ('day', 'week') and y0 > 0:
+        days = frozenset(_days_in_range(drange))
+
+    return FetchPlan(sections=tuple(sections), day_pages=day_pages, days=days)
+
+
+def year_title(year):
+    """Returns the title of the wikipedia page for a year."""
+    return '{}_BC'.format(-year) if year < 0 else str(year)
+
+
+def bullet_in_days(year, text, days):
+    """Given the text of a year page bullet, returns whether the event falls
+    on one of the days. Bullets without a leading date are kept."""
+    match = BULLET_DATE_MATCH.match(text)
+    if not match:
+        return True
+
+    month = MONTHS_BY_NAME[match.group('month')]
+    first = int(match.group('first'))
+    last = int(match.group('last') or first)
+    return any((year, month, day) in days for day in range(first, last + 1))
+
+
+def _year_range(sign, first, last, grain):
+    if sign < 0:
+        first, last = last, first
+    return DateRange((sign*first, 1, 1), (sign*last, 12, 31), grain)
+
+
+def _month_range(year, first, last, grain):
+    """Returns the range of the months first to last of a year, months past
+    12 run into the following year."""
+    if not 1 <= first <= last:
+        raise ValueError('month {} out of range'.format(first))
+    end_year, last = year + (last - 1) // 12, (last - 1) % 12 + 1
+    if end_year == 0:
+        end_year = 1
+    end_day = calendar.monthrange(abs(end_year), last)[1]
+    return DateRange((year, first, 1), (end_year, last, end_day), grain)
+
+
+def _week_range(year, week, wday):
+    monday = datetime.datetime.strptime('{:04d}-W{:02d}-1'.format(year, week), '%G-W%V-%u').date()
+    # strptime rolls weeks past the last of the year into the next year
+    if monday.isocalendar()[:2] != (year, week):
+        raise ValueError('week {}-W{:02d} out of range'.format(year, week))
+    if wday is None:
+        first, last, grain = 0, 6, 'week'
+    elif wday == 'WE':
+        first, last, grain = 5, 6, 'week'
+    else:
+        first = last = int(wday) - 1
+        grain = 'day'
+    start = monday + datetime.timedelta(days=first)
+    end = monday + datetime.timedelta(days=last)
+    return DateRange((start.year, start.month, start.day), (end.year, end.month, end.day), grain)
+
+
+def _check_day(year, month, day):
+    if not 1 <= month <= 12 or not 1 <= day <= calendar.monthrange(year or 1, month)[1]:
+        raise ValueError('day {}-{}-{} out of range'.format(year, month, day))
+
+
+def _days_in_range(drange):
+    start = datetime.date(*drange.start)
+    for offset in range((datetime.date(*drange.end) - start).days + 1):
+        day = start + datetime.timedelta(days=offset)
+        yield (day.year, day.month, day.day)
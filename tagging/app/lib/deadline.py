@@ -0,0 +1,72 @@
+"""
+deadline.py
+
+the deadline of the pipeline run a thread is working for. A run is enqueued
+with a budget of seconds and gets its deadline when its first stage starts,
+as a wall clock time in the meta of the extract since its stages run in
+different processes, and each stage runs within it so the requests it makes
+can be given what is left of it as their timeout.
+"""
+import contextlib
+import functools
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the deadline of the run has passed, or would pass before
+    an operation can complete."""
+
+
+def deadline_from_budget(secs):
+    """Returns the deadline of a run with a budget of secs from now."""
+    return time.time() + secs
+
+
+@contextlib.contextmanager
+def deadline_context(deadline):
+    """Sets the deadline, a time.time() value or None, of the current
+    thread."""
+    previous = current()
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def current():
+    return getattr(_local, 'deadline', None)
+
+
+def remaining():
+    """Returns the seconds left before the deadline of the current thread,
+    which may be negative, or None without a deadline."""
+    deadline = current()
+    return None if deadline is None else deadline - time.time()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check(what='operation'):
+    """Raises DeadlineExceeded if the deadline has passed."""
+    if expired():
+        raise DeadlineExceeded('Deadline passed before {}'.format(what))
+
+
+def bind(func):
+    """Returns func wrapped to run within the deadline of the current thread,
+    for handing work to a pool of threads."""
+    deadline = current()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with deadline_context(deadline):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,150 @@
+"""
+embeddings.py
+
+text embeddings from the spaCy model, and a cache of the embeddings of the
+wikipedia candidate events kept as a memory mapped matrix per page
+"""
+import contextlib
+import fcntl
+import functools as ft
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from app import app, lib, metrics, tracing
+
+
+DIGEST_SIZE = 16
+
+
+def model_name():
+    """Returns the name and version of the model the embeddings come from,
+    embeddings from different models are not comparable."""
+    meta = lib.get_nlp().meta
+    return '{}_{}-{}'.format(meta.get('lang'), meta.get('name'), meta.get('version'))
+
+
+def embed_texts(texts):
+    """Returns the embeddings of texts as the rows of a float32 matrix, scaled
+    to unit length so that their dot products are cosine similarities."""
+    nlp = lib.get_nlp()
+    with metrics.timer('spacy_seconds', stage=metrics.current_stage()), \
+            tracing.span('spacy pipe', texts=len(texts)):
+        vectors = [doc.vector for doc in nlp.pipe(texts, disable=['parser', 'ner'])]
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return normalize(np.vstack(vectors).astype(np.float32))
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+class EmbeddingCache(object):
+    """Embeddings of texts grouped under keys, e.g. the year page the texts
+    come from. The embeddings of a key are a matrix in <root>/<key>.npy,
+    which is memory mapped, and the digests of their texts, one per row, are
+    in <key>.keys.npy. Texts not in the cache are embedded and appended.
+
+    Writers hold a lock on <key>.lock and rows are only ever appended, the
+    matrix being replaced before its keys, so readers never see a key
+    without its row."""
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.loaded = {}
+        os.makedirs(root, exist_ok=True)
+
+    def embeddings(self, key, texts):
+        """Returns the embeddings of texts as the rows of a matrix."""
+        digests = [text_digest(t) for t in texts]
+        rows, matrix = self._load(key)
+        missing = dict((d, t) for (d, t) in zip(digests, texts) if d not in rows)
+        if missing:
+            metrics.inc('embedding_cache_misses_total', len(missing))
+            rows, matrix = self._append(key, missing)
+        metrics.inc('embedding_cache_lookups_total', len(digests))
+        if not digests:
+            return np.zeros((0, 0), np.float32)
+        return np.asarray(matrix[[rows[d] for d in digests]])
+
+    def _paths(self, key):
+        base = os.path.join(self.root, key)
+        return base + '.npy', base + '.keys.npy', base + '.lock'
+
+    def _load(self, key):
+        """Returns the rows of the digests and the memory mapped matrix of a
+        key, reloading them when another process has appended to them."""
+        matrix_path, keys_path, _ = self._paths(key)
+        try:
+            stat = os.stat(keys_path)
+        except FileNotFoundError:
+            return {}, None
+
+        version = (stat.st_ino, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.loaded.get(key)
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+            keys = np.load(keys_path)
+            matrix = np.load(matrix_path, mmap_mode='r')
+            rows = dict((d.tobytes(), i) for (i, d) in enumerate(keys))
+            self.loaded[key] = (version, rows, matrix)
+            return rows, matrix
+
+    def _append(self, key, missing):
+        """Embeds the missing texts, a dict of digest to text, and appends
+        them to the matrix of the key."""
+        matrix_path, keys_path, lock_path = self._paths(key)
+        with _locked(lock_path):
+            rows, matrix = self._load(key)
+            missing = dict((d, t) for (d, t) in missing.items() if d not in rows)
+            if missing:
+                digests = list(missing)
+                new = embed_texts([missing[d] for d in digests])
+                keys = np.frombuffer(b''.join(sorted(rows, key=rows.get) + digests),
+                                     dtype=np.uint8).reshape(-1, DIGEST_SIZE)
+                if matrix is not None:
+                    new = np.vstack([np.asarray(matrix), new])
+                _save_atomically(matrix_path, new)
+                _save_atomically(keys_path, keys)
+            return self._load(key)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    with open(path, 'a') as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+def _save_atomically(path, array):
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-', suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.save(fout, array)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+@ft.lru_cache(maxsize=None)
+def embedding_cache():
+    """Returns the cache of candidate embeddings at EMBEDDING_CACHE_PATH,
+    relative paths are from the tagging directory, with a directory for
+    each model."""
+    location = os.path.join(os.path.dirname(app.root_path), app.config['EMBEDDING_CACHE_PATH'])
+    return EmbeddingCache(os.path.join(location, model_name()))
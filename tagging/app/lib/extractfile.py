@@ -0,0 +1,166 @@
+"""
+extractfile.py
+
+reading and writing extracts as files, streamed so that an extract is never
+held in memory a second time as one string. The format follows the suffix:
+
+    .json        the extract as one compact JSON object
+    .ndjson      a header line with everything but the events, then the
+                 events of each sentence on a line of their own
+    .gz          either of these gzip compressed, e.g. .ndjson.gz
+
+NDJSON extracts can be read a sentence at a time, without loading them.
+"""
+import glob
+import gzip
+import json
+import os
+import tempfile
+
+from app import app
+
+
+SUFFIXES = ('.ndjson.gz', '.json.gz', '.ndjson', '.json')
+COMPRESS_LEVEL = 6
+# characters of JSON handed to the stream at once
+WRITE_CHUNK = 1 << 16
+
+
+def extract_suffix(filename):
+    """Returns the suffix of an extract file, raises ValueError for other
+    files."""
+    for suffix in SUFFIXES:
+        if filename.endswith(suffix):
+            return suffix
+    raise ValueError('Not an extract file: {}'.format(filename))
+
+
+def strip_suffix(filename):
+    return filename[:-len(extract_suffix(filename))]
+
+
+def open_extract(filename, mode='r'):
+    """Opens an extract file as text in mode 'r' or 'w', through gzip for
+    .gz files."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8', compresslevel=COMPRESS_LEVEL)
+    return open(filename, mode, encoding='utf-8')
+
+
+def write_extract(extract, fout, ndjson=False):
+    """Writes the extract to the text stream fout as compact JSON, or as
+    NDJSON, a chunk at a time."""
+    if not ndjson:
+        _write_chunked(json.JSONEncoder(separators=(',', ':')).iterencode(extract), fout)
+        return
+    header = dict((k, v) for (k, v) in extract.items() if k != 'events')
+    fout.write(json.dumps(header, separators=(',', ':')))
+    fout.write('\n')
+    for events in extract.get('events', []):
+        fout.write(json.dumps(events, separators=(',', ':')))
+        fout.write('\n')
+
+
+def _write_chunked(chunks, fout):
+    buf, size = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= WRITE_CHUNK:
+            fout.write(''.join(buf))
+            buf, size = [], 0
+    fout.write(''.join(buf))
+
+
+def save_extract(extract, filename):
+    """Saves the extract to filename in the format of its suffix, via a
+    temporary file in the same directory which is renamed over it, so readers
+    never see a partial extract. Returns the filename."""
+    suffix = extract_suffix(filename)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                   prefix='.tmp-', suffix=suffix)
+    os.close(fd)
+    try:
+        with open_extract(tmpname, 'w') as fout:
+            write_extract(extract, fout, ndjson='.ndjson' in suffix)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    return filename
+
+
+def save_to_tempfile(extract, suffix='.ndjson.gz', **kwargs):
+    """Saves the extract to a new file and returns the filename. kwargs are
+    passed to `tempfile.mkstemp`, without a dir the file is created in the
+    app root."""
+    kwargs.setdefault('dir', app.root_path)
+    fd, filename = tempfile.mkstemp(suffix=suffix, **kwargs)
+    os.close(fd)
+    return save_extract(extract, filename)
+
+
+def iter_extract(filename):
+    """Returns the header of the extract, everything but its events, and an
+    iterator over the events of each sentence. NDJSON extracts are read a
+    line at a time as the iterator is consumed, JSON ones are loaded."""
+    fin = open_extract(filename)
+    if '.ndjson' not in extract_suffix(filename):
+        with fin:
+            extract = json.load(fin)
+        return extract, iter(extract.pop('events', []))
+    header = json.loads(fin.readline())
+    return header, _iter_lines(fin)
+
+
+def _iter_lines(fin):
+    with fin:
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_extract(filename):
+    """Returns the extract in filename."""
+    header, events = iter_extract(filename)
+    header['events'] = list(events)
+    return header
+
+
+
+def stored_root():
+    """Returns the directory of the stored extracts, EXTRACTS_PATH, relative
+    paths are from the tagging directory."""
+    return os.path.join(os.path.dirname(app.root_path), app.config['EXTRACTS_PATH'])
+
+
+def stored_filename(video_id):
+    """Returns the newest stored extract of the video, either written by a
+    backfill as <video_id>.json or by a session as match-<video_id>-*.json,
+    in any of the formats. Returns None when there is none."""
+    root = stored_root()
+    candidates = []
+    for suffix in SUFFIXES:
+        candidates += glob.glob(os.path.join(root, glob.escape(video_id) + suffix))
+        candidates += glob.glob(os.path.join(
+            root, 'match-{}-*{}'.format(glob.escape(video_id), suffix)))
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def stored_video_ids():
+    """Returns the ids of the videos with a stored extract, sorted."""
+    video_ids = set()
+    for filename in os.listdir(stored_root()):
+        if filename.startswith('.'):
+            continue
+        try:
+            name = strip_suffix(filename)
+        except ValueError:
+            continue
+        if name.startswith('match-'):
+            # sessions add a random part to the name
+            name = name[len('match-'):].rsplit('-', 1)[0]
+        video_ids.add(name)
+    return sorted(video_ids)
@@ -0,0 +1,255 @@
+"""
+http.py
+
+outbound http requests of the pipeline, rate limited per host, retried with
+backoff and instrumented with metrics. Requests time out within the deadline
+of the run they are made for, and GETs slower than the usual latency of
+their host are hedged with a second request.
+"""
+import collections
+from concurrent import futures
+from email.utils import parsedate_to_datetime
+import functools as ft
+import random
+import threading
+import time
+from urllib import parse
+
+import requests
+
+from app import app, metrics, tracing
+from app.lib import deadline, ratelimit
+
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+# requests which are safe to send twice
+HEDGE_METHODS = frozenset(['GET'])
+
+
+def get(url, **kwargs):
+    """Sends a GET request, see requests.get."""
+    return request('GET', url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    """Sends a POST request, see requests.post."""
+    return request('POST', url, data=data, **kwargs)
+
+
+def request(method, url, retries=None, **kwargs):
+    """Sends a request once the rate limit of its host allows, retrying
+    connection errors and retryable statuses up to retries times (default
+    HTTP_MAX_RETRIES). Retries wait for the Retry-After of the response, which
+    also holds back the other requests to the host, or else back off
+    exponentially with jitter.
+
+    Without a timeout in kwargs, each attempt times out after
+    HTTP_CONNECT_TIMEOUT_SECS and HTTP_READ_TIMEOUT_SECS, or sooner at the
+    deadline of the run. DeadlineExceeded is raised once the deadline has
+    passed, or when the wait for the rate limit or for a retry would pass it.
+
+    Returns the last response, which may still have a retryable status."""
+    host = parse.urlsplit(url).netloc
+    retries = app.config.get('HTTP_MAX_RETRIES', 0) if retries is None else retries
+    limiter = ratelimit.buckets()
+    timeout = kwargs.pop('timeout', None)
+
+    for attempt in range(retries + 1):
+        deadline.check('{} {}'.format(method, url))
+        waited = limiter.acquire(host, deadline.remaining())
+        if waited is None:
+            metrics.inc('http_deadline_exceeded_total', host=host, stage=metrics.current_stage())
+            raise deadline.DeadlineExceeded(
+                'No time left to send {} {} within the rate limit'.format(method, url))
+        if waited:
+            metrics.observe('http_ratelimit_wait_seconds', waited, host=host)
+
+        try:
+            resp = _attempt(method, url, host, limiter, timeout=timeout or timeout_secs(),
+                            **kwargs)
+        except RETRY_EXCEPTIONS as e:
+            if deadline.expired():
+                metrics.inc('http_deadline_exceeded_total', host=host,
+                            stage=metrics.current_stage())
+                raise deadline.DeadlineExceeded(
+                    '{} {} timed out at the deadline'.format(method, url)) from e
+            if attempt == retries:
+                raise
+            delay, reason = backoff_secs(attempt), type(e).__name__
+            if _passes_deadline(delay):
+                raise deadline.DeadlineExceeded(
+                    'No time left to retry {} {}'.format(method, url)) from e
+        else:
+            if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                return resp
+            delay, reason = retry_after_secs(resp), resp.status_code
+            if delay is None:
+                delay = backoff_secs(attempt)
+            elif delay > app.config.get('HTTP_RETRY_AFTER_MAX', 60):
+                return resp
+            else:
+                limiter.penalize(host, delay)
+            if _passes_deadline(delay):
+                return resp
+
+        metrics.inc('http_retries_total', host=host, stage=metrics.current_stage(), reason=reason)
+        time.sleep(delay)
+
+
+def _passes_deadline(delay):
+    left = deadline.remaining()
+    return left is not None and delay >= left
+
+
+def timeout_secs():
+    """Returns the (connect, read) timeout of a request, no later than the
+    deadline of the run."""
+    connect = app.config.get('HTTP_CONNECT_TIMEOUT_SECS', 5)
+    read = app.config.get('HTTP_READ_TIMEOUT_SECS', 30)
+    left = deadline.remaining()
+    if left is not None:
+        connect, read = min(connect, left), min(read, left)
+    return connect, read
+
+
+def _attempt(method, url, host, limiter, **kwargs):
+    """Sends a request. A GET which takes longer than the HTTP_HEDGE_QUANTILE
+    of the recent latencies of its host is sent a second time, also within
+    the rate limit, and whichever response arrives first is returned; the
+    slower request runs to completion in the background. No hedge is sent
+    when the wait for the rate limit would pass the deadline of the run."""
+    delay = hedge_delay_secs(method, host)
+    if delay is None:
+        return _send(method, url, host, **kwargs)
+
+    pool = _hedge_pool()
+    send = in_context(_send)
+    first = pool.submit(send, method, url, host, **kwargs)
+    done, _ = futures.wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    if limiter.acquire(host, deadline.remaining()) is None:
+        return first.result()
+    metrics.inc('http_hedged_total', host=host, stage=metrics.current_stage())
+    hedge = pool.submit(send, method, url, host, **kwargs)
+    pending, error = set([first, hedge]), None
+    while pending:
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for job in done:
+            if job.exception() is None:
+                if job is hedge:
+                    metrics.inc('http_hedge_wins_total', host=host, stage=metrics.current_stage())
+                return job.result()
+            error = job.exception()
+    raise error
+
+
+def hedge_delay_secs(method, host):
+    """Returns the seconds after which a request is hedged, or None when it
+    is not hedged: it is not idempotent, hedging is off or too few latencies
+    of the host have been seen."""
+    quantile = app.config.get('HTTP_HEDGE_QUANTILE')
+    if method not in HEDGE_METHODS or not quantile:
+        return None
+    latencies = _latencies(host)
+    if len(latencies) < app.config.get('HTTP_HEDGE_MIN_SAMPLES', 20):
+        return None
+    return latencies.quantile(quantile)
+
+
+class LatencyWindow(object):
+    """The latencies of the last size requests to a host."""
+    def __init__(self, size=200):
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def observe(self, secs):
+        with self.lock:
+            self.samples.append(secs)
+
+    def quantile(self, q):
+        with self.lock:
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+_windows = collections.defaultdict(LatencyWindow)
+_windows_lock = threading.Lock()
+
+
+def _latencies(host):
+    with _windows_lock:
+        return _windows[host]
+
+
+@ft.lru_cache(maxsize=None)
+def _hedge_pool():
+    return futures.ThreadPoolExecutor(max_workers=app.config.get('HTTP_HEDGE_WORKERS', 64))
+
+
+def in_context(func):
+    """Returns func wrapped to run in the stage, deadline and trace of the
+    calling thread, for running it in a pool of threads, e.g. the hedge
+    pool."""
+    stage = metrics.current_stage()
+    func = tracing.bind(deadline.bind(func))
+
+    @ft.wraps(func)
+    def wrapper(*args, **kwargs):
+        with metrics.stage_context(stage):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def backoff_secs(attempt):
+    """Returns the seconds to wait before retry attempt, drawn uniformly up to
+    an exponentially growing cap so that retrying workers spread out."""
+    cap = min(app.config.get('HTTP_BACKOFF_MAX', 30),
+              app.config.get('HTTP_BACKOFF_BASE', 0.5) * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+def retry_after_secs(resp):
+    """Returns the seconds to wait given by the Retry-After header of a
+    response, as seconds or an HTTP date, or None without one."""
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _send(method, url, host, **kwargs):
+    """Sends a single request and records its count, duration and response
+    size against the host and the pipeline stage making it, and a span of
+    the trace of the run."""
+    stage = metrics.current_stage()
+    start = time.perf_counter()
+    with tracing.span('http ' + method.lower(), kind='CLIENT', **{
+            'http.method': method, 'http.host': host, 'http.url': url}) as span:
+        try:
+            resp = requests.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            metrics.inc('http_requests_total', host=host, stage=stage, status=type(e).__name__)
+            raise
+        span.tag('http.status_code', resp.status_code)
+        span.tag('http.response_size', len(resp.content))
+
+    elapsed = time.perf_counter() - start
+    _latencies(host).observe(elapsed)
+    metrics.observe('http_request_seconds', elapsed, host=host, stage=stage)
+    metrics.inc('http_requests_total', host=host, stage=stage, status=resp.status_code)
+    metrics.inc('http_response_bytes_total', len(resp.content), host=host, stage=stage)
+    metrics.observe('http_response_bytes', len(resp.content), metrics.BYTES_BUCKETS, host=host)
+    return resp
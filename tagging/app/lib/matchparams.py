@@ -0,0 +1,47 @@
+"""
+matchparams.py
+
+parameters of matching events to candidates by their entities, kept apart
+from the tasks so the web process can validate them without loading the
+task modules
+"""
+import collections
+import itertools
+
+
+ENTITY_TYPE_BLACKLIST = (
+    'CARDINAL', 'DATE', 'LANGUAGE', 'MONEY',
+    'ORDINAL', 'PERCENT', 'QUANTITY', 'TIME',
+)
+ITEM_MATCH_THRESHOLD = 0.25
+WINDOW_MATCH_THRESHOLD = 0.18
+
+# item_threshold - least jacquard score of the entities of the event and of
+#                  a candidate for the candidate to match
+# window_threshold - least score of the entities in the window around the
+#                    event and of a candidate
+# entity_blacklist - entity types which are not compared
+MatchParams = collections.namedtuple(
+    'MatchParams', ['item_threshold', 'window_threshold', 'entity_blacklist'])
+
+
+def match_params(params=None):
+    """Returns the MatchParams of a dict holding any of their fields, the
+    defaults for the others. Raises ValueError for other fields."""
+    params = params or {}
+    unknown = set(params) - set(MatchParams._fields)
+    if unknown:
+        raise ValueError('Don\'t understand match params %s' % (sorted(unknown)))
+    return MatchParams(
+        float(params.get('item_threshold', ITEM_MATCH_THRESHOLD)),
+        float(params.get('window_threshold', WINDOW_MATCH_THRESHOLD)),
+        tuple(sorted(params.get('entity_blacklist', ENTITY_TYPE_BLACKLIST))))
+
+
+def param_grid(item_thresholds=None, window_thresholds=None, entity_blacklists=None):
+    """Returns the MatchParams of every combination of the values given,
+    the defaults standing in for those not given."""
+    return [MatchParams(float(i), float(w), tuple(sorted(b))) for (i, w, b) in itertools.product(
+        item_thresholds or [ITEM_MATCH_THRESHOLD],
+        window_thresholds or [WINDOW_MATCH_THRESHOLD],
+        entity_blacklists or [ENTITY_TYPE_BLACKLIST])]
@@ -0,0 +1,137 @@
+"""
+ratelimit.py
+
+token buckets limiting the rate of requests to each upstream host, shared by
+all workers through redis or local to the process
+"""
+import functools as ft
+import logging
+import threading
+import time
+
+import redis
+
+from app import app
+from app.lib import redisconn
+
+
+# Takes a token from the bucket, or drains it for a penalty, and returns the
+# seconds the caller must wait for its token. Tokens may go negative, which
+# reserves the next tokens to refill for the callers already waiting. With a
+# max_wait, '' for none, no token is taken and nil is returned when the wait
+# would be longer. The time is that of redis, so that workers whose clocks
+# differ share one clock; the writes which follow reading it are replicated
+# as they are.
+TAKE_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local penalty = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if penalty > 0 then
+    tokens = math.min(tokens, -penalty * rate)
+else
+    tokens = tokens - 1
+    if tokens < 0 then wait = -tokens / rate end
+    if max_wait and wait > max_wait then return false end
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class TokenBuckets(object):
+    """A token bucket per host, refilled at rate tokens a second up to burst.
+    Hosts without a configured limit are not limited."""
+    def __init__(self, limits):
+        self.limits = limits
+
+    def acquire(self, host, max_wait=None):
+        """Blocks until a request may be sent to the host, returns the seconds
+        waited. With a max_wait, returns None at once, without taking a
+        token, when the wait would be longer, e.g. past a deadline."""
+        wait = self._take(host, 0, max_wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, host, secs):
+        """Holds back every request to the host for secs, e.g. when it asks
+        us to retry after a while."""
+        self._take(host, secs)
+
+    def _take(self, host, penalty, max_wait=None):
+        if host not in self.limits:
+            return 0.0
+        rate, burst = self.limits[host]
+        return self.take(host, rate, burst, time.time(), penalty, max_wait)
+
+    def take(self, host, rate, burst, now, penalty, max_wait=None):
+        raise NotImplementedError
+
+
+class LocalBuckets(TokenBuckets):
+    """Token buckets in the memory of the process, for tests and for running
+    a single worker."""
+    def __init__(self, limits):
+        super().__init__(limits)
+        self.lock = threading.Lock()
+        self.state = {}
+
+    def take(self, host, rate, burst, now, penalty, max_wait=None):
+        with self.lock:
+            tokens, ts = self.state.get(host, (burst, now))
+            tokens = min(burst, tokens + max(0, now - ts) * rate)
+            wait = 0.0
+            if penalty > 0:
+                tokens = min(tokens, -penalty * rate)
+            else:
+                tokens -= 1
+                if tokens < 0:
+                    wait = -tokens / rate
+                if max_wait is not None and wait > max_wait:
+                    return None
+            self.state[host] = (tokens, now)
+        return wait
+
+
+class RedisBuckets(TokenBuckets):
+    """Token buckets in redis, shared by every process using the same redis
+    and refilled by the clock of redis rather than that of each process. If
+    redis is unavailable requests fall back to the local buckets."""
+    def __init__(self, limits, client, prefix='timelines:ratelimit:'):
+        super().__init__(limits)
+        self.prefix = prefix
+        self.script = client.register_script(TAKE_SCRIPT)
+        self.fallback = LocalBuckets(limits)
+
+    def take(self, host, rate, burst, now, penalty, max_wait=None):
+        # the script reads the time of redis, now is for the local fallback
+        bound = '' if max_wait is None else max_wait
+        try:
+            wait = self.script(keys=[self.prefix + host], args=[rate, burst, penalty, bound])
+        except redis.RedisError as e:
+            logging.warn('Rate limiting %s locally, redis failed: %s', host, e)
+            return self.fallback.take(host, rate, burst, now, penalty, max_wait)
+        return None if wait is None else float(wait)
+
+
+@ft.lru_cache(maxsize=None)
+def buckets():
+    """Returns the token buckets configured by RATE_LIMIT_BACKEND and
+    RATE_LIMITS."""
+    limits = app.config.get('RATE_LIMITS', {})
+    backend = app.config.get('RATE_LIMIT_BACKEND', 'local')
+    if backend == 'redis':
+        return RedisBuckets(limits, redisconn.client())
+    elif backend == 'local':
+        return LocalBuckets(limits)
+    raise ValueError('Don\'t understand rate limit backend %s' % (backend))
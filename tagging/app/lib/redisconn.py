@@ -0,0 +1,17 @@
+"""
+redisconn.py
+
+redis connection used to coordinate the workers
+"""
+import functools as ft
+
+import redis
+
+from app import app
+
+
+@ft.lru_cache(maxsize=None)
+def client(url=None):
+    """Returns a redis client for url, defaulting to REDIS_URL. The client's
+    connection pool reconnects in processes forked after it was created."""
+    return redis.StrictRedis.from_url(url or app.config['REDIS_URL'])
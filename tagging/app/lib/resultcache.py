@@ -0,0 +1,106 @@
+"""
+resultcache.py
+
+serialized task results kept in memory by the web process, with their
+strong ETags and their compressed encodings, so polling a finished task
+neither fetches the result again nor serializes or compresses it again
+"""
+import collections
+import functools as ft
+import gzip
+import hashlib
+import threading
+
+import brotli
+
+from app import app
+
+
+# content codings in order of preference when a client accepts several
+ENCODINGS = ('br', 'gzip')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+Entry = collections.namedtuple('Entry', ['etag', 'mimetype', 'body'])
+
+
+def strong_etag(body):
+    """Returns the ETag of the serialized result, without its quotes."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def encoded_etag(etag, encoding):
+    """Returns the ETag of an encoding of the result, each representation
+    having its own strong validator."""
+    return etag if encoding == 'identity' else '{}-{}'.format(etag, encoding)
+
+
+def encode(body, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL)
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return body
+
+
+class ResultCache(object):
+    """A least recently used cache of serialized results, keyed by task id
+    and the mimetype asked for, holding up to max_bytes of bodies. Results of
+    finished tasks never change so entries need no invalidation."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, task_id, accept, encoding='identity'):
+        """Returns the Entry of the result in the encoding or None."""
+        key = (task_id, accept, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def etag(self, task_id, accept):
+        """Returns the ETag of the serialized result or None."""
+        entry = self.get(task_id, accept)
+        return entry.etag if entry else None
+
+    def put(self, task_id, accept, mimetype, body, encoding='identity', etag=None):
+        """Stores the body of the result, serialized as mimetype, in the
+        encoding. The ETag of the identity body is computed unless given.
+        Returns the Entry."""
+        entry = Entry(etag or strong_etag(body), mimetype, body)
+        if len(body) > self.max_bytes:
+            return entry
+        key = (task_id, accept, encoding)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+        return entry
+
+    def encoded(self, task_id, accept, encoding):
+        """Returns the Entry of the result in the encoding, compressing the
+        cached identity body the first time it is asked for, or None when the
+        result is not cached."""
+        entry = self.get(task_id, accept, encoding)
+        if entry is not None or encoding == 'identity':
+            return entry
+        identity = self.get(task_id, accept)
+        if identity is None:
+            return None
+        return self.put(task_id, accept, identity.mimetype,
+                        encode(identity.body, encoding), encoding, identity.etag)
+
+
+@ft.lru_cache(maxsize=None)
+def result_cache():
+    """Returns the cache of the web process, of RESULT_CACHE_MAX_BYTES."""
+    return ResultCache(app.config['RESULT_CACHE_MAX_BYTES'])
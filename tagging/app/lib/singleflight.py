@@ -0,0 +1,94 @@
+"""
+singleflight.py
+
+registry of the pipeline runs in flight, in redis, so that a video submitted
+again while its run is still going joins that run instead of starting another.
+Runs are registered per priority, a video submitted at a higher priority than
+its run in flight does not wait for it behind the queues of the lower one.
+"""
+import functools as ft
+import logging
+
+import redis
+
+from app import app, priorities
+from app.lib import redisconn
+
+
+# Deletes the key only if it still holds the token of the flight releasing
+# it, a flight which outlived its key must not release a newer one
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight(object):
+    """Flights are keyed by name and hold the token, e.g. the task id, of the
+    run which claimed them until it releases them or they expire."""
+    def __init__(self, client, prefix='timelines:inflight:'):
+        self.client = client
+        self.prefix = prefix
+        self.release_script = client.register_script(RELEASE_SCRIPT)
+
+    def claim(self, name, token, ttl):
+        """Claims the flight for token for up to ttl seconds. Returns the
+        token holding the flight and whether it is ours: (token, True) when
+        claimed, (token of the run in flight, False) otherwise."""
+        key = self.prefix + name
+        while True:
+            if self.client.set(key, token, nx=True, ex=int(ttl)):
+                return token, True
+            holder = self.client.get(key)
+            # the flight may have been released between set and get
+            if holder is not None:
+                return holder.decode('utf-8'), False
+
+    def release(self, name, token):
+        """Releases the flight if token still holds it. Returns whether it
+        was released."""
+        return bool(self.release_script(keys=[self.prefix + name], args=[token]))
+
+
+def flight_name(video_id, priority=priorities.DEFAULT_PRIORITY):
+    """Returns the name of the flight of a video at a priority, runs of
+    different versions of the pipeline do not join each other."""
+    return '{}:{}:{}'.format(app.config['PIPELINE_VERSION'], priority, video_id)
+
+
+def flight_token(task_id, trace_id=None):
+    """Returns the token a run holds its flight with, its task id and the id
+    of its trace, so that the runs joining it can be given both."""
+    return '{} {}'.format(task_id, trace_id) if trace_id else task_id
+
+
+def parse_flight_token(token):
+    """Returns the (task id, trace id) of a flight token, the trace id None
+    for a run without one."""
+    task_id, _, trace_id = token.partition(' ')
+    return task_id, trace_id or None
+
+
+def claim(video_id, token, ttl, priority=priorities.DEFAULT_PRIORITY):
+    """Claims the flight of the video at the priority, see SingleFlight.claim.
+    Without redis every run is its own flight."""
+    try:
+        return single_flight().claim(flight_name(video_id, priority), token, ttl)
+    except redis.RedisError as e:
+        logging.warn('Not deduplicating runs of %s, redis failed: %s', video_id, e)
+        return token, True
+
+
+def release(video_id, token, priority=priorities.DEFAULT_PRIORITY):
+    try:
+        return single_flight().release(flight_name(video_id, priority), token)
+    except redis.RedisError as e:
+        logging.warn('Could not release the flight of %s, it will expire: %s', video_id, e)
+        return False
+
+
+@ft.lru_cache(maxsize=None)
+def single_flight():
+    return SingleFlight(redisconn.client())
@@ -0,0 +1,98 @@
+"""
+timeline.py
+
+the timeline view of an extract: the sentences of the captions which have
+matched events, with their timestamps, the matched events and their topics,
+without the annotations, candidates and scores the explorer does not show
+"""
+import bisect
+import functools as ft
+import os
+
+from app.lib import extractfile
+
+
+TIMELINE_CACHE_SIZE = 64
+
+
+def timeline_from_extract(extract):
+    """Returns the timeline of an extract, its sentences with a match in
+    order of time."""
+    return timeline_from_parts(extract, extract['events'])
+
+
+def timeline_from_parts(header, events):
+    """Returns the timeline of an extract from its header and an iterable of
+    the events of each sentence, which is consumed once."""
+    captions = header['captions']
+    sentences = []
+    for (idx, sent_events) in enumerate(events):
+        matched = [timeline_event(e) for e in sent_events if e.get('match')]
+        if not matched:
+            continue
+        sentences.append({
+            'idx': idx,
+            'time': float(captions['timestamps'][idx]),
+            'text': captions['sents'][idx],
+            'events': matched,
+        })
+    sentences.sort(key=lambda s: s['time'])
+    return {'video_id': header['video_id'], 'sentences': sentences}
+
+
+def timeline_event(event):
+    """Returns the parts of a matched event shown on the timeline."""
+    match = event['match']
+    selected = match.get('wptopic_sel')
+    topic = None
+    if selected:
+        topic = dict((k, selected.get(k)) for k in ('title', 'article', 'start_time', 'end_time'))
+    return {
+        'date': event.get('date'),
+        'text': match.get('text'),
+        'score': match.get('score'),
+        'topic': topic,
+        'topics': [{'title': t.get('title'), 'wbid': t.get('wbid')}
+                   for t in match.get('wptopics') or []],
+    }
+
+
+def page(timeline, start=0, end=None, limit=None):
+    """Returns the page of the timeline with the sentences from start up to,
+    not including, end seconds, at most limit of them. A page cut short by
+    the limit has the time to start the next page from in 'next', sentences
+    at the same time are never split across pages."""
+    sentences = timeline['sentences']
+    times = [s['time'] for s in sentences]
+    first = bisect.bisect_left(times, start)
+    last = len(sentences) if end is None else bisect.bisect_left(times, end)
+
+    next_start = None
+    if limit is not None and last - first > limit:
+        cut = bisect.bisect_right(times, times[first + limit - 1])
+        if cut < last:
+            last, next_start = cut, times[cut]
+    return {
+        'video_id': timeline['video_id'],
+        'start': start,
+        'end': end,
+        'next': next_start,
+        'sentences': sentences[first:last],
+    }
+
+
+def stored_timeline(video_id):
+    """Returns the version of the stored extract of the video and its
+    timeline, or (None, None) without one. The version changes when the
+    extract is written again."""
+    filename = extractfile.stored_filename(video_id)
+    if filename is None:
+        return None, None
+    stat = os.stat(filename)
+    version = '{:x}-{:x}'.format(stat.st_ino, stat.st_mtime_ns)
+    return version, _timeline_of_file(filename, version)
+
+
+@ft.lru_cache(maxsize=TIMELINE_CACHE_SIZE)
+def _timeline_of_file(filename, version):
+    return timeline_from_parts(*extractfile.iter_extract(filename))
@@ -0,0 +1,98 @@
+"""
+timeml.py
+
+single pass parsing of the TimeML produced by HeidelTime
+"""
+import collections
+import logging
+import re
+
+
+Timex = collections.namedtuple('Timex', 'tid type value text sent start end')
+
+
+TML_REGEX = "<TimeML>(.*)</TimeML>"
+TML_MATCHER = re.compile(TML_REGEX, re.DOTALL)
+# Matches the opening and closing TIMEX3 and TIMEX3INTERVAL tags, and the
+# newlines which separate sentences in the HeidelTime output
+TOKEN_REGEX = '<(/?)(TIMEX3(?:INTERVAL)?)(\s[^<>]*)?>|\n'
+TOKEN_MATCH = re.compile(TOKEN_REGEX)
+ATTR_REGEX = '(\w+)="([^"]*)"'
+ATTR_MATCH = re.compile(ATTR_REGEX)
+
+
+def body_from_timeml(output):
+    """Given the complete HeidelTime output, returns the annotated text
+    between the TimeML tags or None if there isn't any."""
+    match = TML_MATCHER.search(output)
+    return match.group(1) if match else None
+
+
+def timexes_from_timeml(body):
+    """Scans annotated TimeML text in a single pass and returns a list of
+    Timex records in document order.
+
+    Sentences are separated by newlines, empty lines are not counted. The
+    start and end offsets of each record are character offsets of the timex
+    text in its sentence once all the tags are removed. Malformed tags
+    (unclosed, nested or stray closing tags) are logged and skipped.
+
+    Params:
+        body - string containing the annotated text
+
+    Returns:
+        A list of Timex(tid, type, value, text, sent, start, end)
+    """
+    timexes = []
+    # index of the sentence, offset where it begins and the number of tag
+    # characters seen in it so far
+    sent, line_start, stripped = 0, 0, 0
+    open_attrs, open_end, open_start = None, 0, 0
+
+    for match in TOKEN_MATCH.finditer(body):
+        pos, end = match.span()
+        closing, name = match.group(1), match.group(2)
+
+        if name is None:
+            # newline ends the sentence, an open tag is left unclosed
+            if open_attrs is not None:
+                logging.warn('Unclosed TIMEX3 in sentence %d', sent)
+                open_attrs = None
+            if pos > line_start:
+                sent += 1
+            line_start, stripped = end, 0
+            continue
+
+        stripped += end - pos
+        if name != 'TIMEX3':
+            continue
+
+        if not closing:
+            if open_attrs is not None:
+                logging.warn('Nested TIMEX3 in sentence %d', sent)
+            open_attrs = match.group(3) or ''
+            open_end, open_start = end, end - line_start - stripped
+        elif open_attrs is None:
+            logging.warn('Stray closing TIMEX3 in sentence %d', sent)
+        else:
+            attrs = dict(ATTR_MATCH.findall(open_attrs))
+            text = body[open_end:pos]
+            timexes.append(Timex(tid=attrs.get('tid', ''),
+                                 type=attrs.get('type', ''),
+                                 value=attrs.get('value', ''),
+                                 text=text,
+                                 sent=sent,
+                                 start=open_start,
+                                 end=open_start + len(text)))
+            open_attrs = None
+
+    return timexes
+
+
+def timexes_by_sentence(sents):
+    """Given a list of annotated sentences, returns a list with the Timex
+    records found in each of the sentences."""
+    by_sent = [[] for _ in sents]
+    for timex in timexes_from_timeml('\n'.join(sents)):
+        by_sent[timex.sent].append(timex)
+    return by_sent
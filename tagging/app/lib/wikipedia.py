@@ -2,24 +2,57 @@
 utilities for interacting with wikipedia
 """
 from bs4 import BeautifulSoup
+import collections
+import datetime
 import functools as ft
-import json
 import logging
 import os.path
-import requests
 import urllib
 
+from app import app
+from app.lib import articlestore, http
+
 
 EN_WIKIPEDIA_APIURL = 'https://en.wikipedia.org/w/api.php'
+WBID_KEY_PREFIX = 'wbid:'
 
 
 def wbid_from_titles(*titles):
     """Given one or more titles, fetches the wikibase id for each of  the titles.
+    Titles are queried in batches of WPQuery.MAX_TITLES. With the 'cache'
+    ARTICLE_FETCH_STRATEGY the ids are read from and saved to the article
+    store, under 'wbid:<title>'.
 
-    Returns a list of the form, [(title, wbid) ... ]
+    Returns a list of the form, [(title, wbid) ... ], where wbid is None for
+    titles without a wikibase id or missing from the response.
     """
-    result = WPQuery().by_titles(titles, prop='pageprops', ppprop='wikibase_item')
-
+    store = article_store() if app.config['ARTICLE_FETCH_STRATEGY'] == 'cache' else None
+    title_wbid_map = {}
+    if store is not None:
+        for title in set(titles):
+            wbid = store.get(WBID_KEY_PREFIX + title)
+            if wbid is not None:
+                title_wbid_map[title] = wbid or None
+
+    to_query = [t for t in collections.OrderedDict.fromkeys(titles) if t not in title_wbid_map]
+    for i in range(0, len(to_query), WPQuery.MAX_TITLES):
+        batch = to_query[i:i+WPQuery.MAX_TITLES]
+        queried = _wbid_map_from_query(
+            WPQuery().by_titles(batch, prop='pageprops', ppprop='wikibase_item'))
+        title_wbid_map.update(queried)
+        if store is not None:
+            for title, wbid in queried.items():
+                store.put(WBID_KEY_PREFIX + title, wbid or '')
+
+    missing = [t for t in titles if t not in title_wbid_map]
+    if missing:
+        logging.warn('No wikibase ids returned for %d titles: %s', len(missing), missing[:10])
+    return [(t, title_wbid_map.get(t)) for t in titles]
+
+
+def _wbid_map_from_query(result):
+    """Given a pageprops query result, returns a dict of the titles queried to
+    their wikibase ids."""
     deredir = dict((redir['to'], redir['from']) for redir in result['query'].get('redirects', []))
     denorm = dict((norm['to'], norm['from']) for norm in result['query'].get('normalized', []))
 
@@ -29,40 +62,44 @@ def wbid_from_titles(*titles):
         orig_title = denorm.get(deredir_title, deredir_title)
         return orig_title
 
-    pages = result['query']['pages'].values()
-    title_wbid_map = dict((orig_title(p['title']), # Backlink found title to the orig title
-                           p.get('pageprops', {}).get('wikibase_item')) # Wikibase id if found
-                          for p in pages)
-    try:
-        wbids = [(t, title_wbid_map[t]) for t in titles]
-    except KeyError as e:
-        logging.info(json.dumps(title_wbid_map, indent=2))
-        logging.info(titles)
-        import pdb; pdb.set_trace()
-
-    return wbids
+    pages = result['query'].get('pages', {}).values()
+    return dict((orig_title(p['title']), # Backlink found title to the orig title
+                 p.get('pageprops', {}).get('wikibase_item')) # Wikibase id if found
+                for p in pages)
 
 
-def article_by_title(title, fetch_strategy='url'):
+def article_by_title(title, fetch_strategy=None):
     """Given a Wikipedia page title, returns the introductory text for the
     title from the English wikipedia."""
     return article_by_url(_eng_url_from_title(title), fetch_strategy)
 
 
-def article_by_url(url, fetch_strategy='url'):
+def article_by_url(url, fetch_strategy=None):
     """Given a Wikipedia page URL, return the introductory text for the title
-    from the English wikipedia."""
+    from the English wikipedia.
+
+    The 'url' strategy always fetches the page, the 'cache' strategy reads it
+    from the article store and fetches and stores it when missing. Defaults to
+    ARTICLE_FETCH_STRATEGY."""
+    fetch_strategy = fetch_strategy or app.config['ARTICLE_FETCH_STRATEGY']
     if fetch_strategy == 'url':
         fetcher = _fetch_html_from_url
     elif fetch_strategy == 'cache':
-        fetcher = ft.partial(_fetch_html_from_cache,
-                             cache_root='/Users/kochhar/workspace/projects/timelines/tagging/data')
+        fetcher = ft.partial(_fetch_html_from_cache, store=article_store())
     else:
         raise ValueError('Don\'t understand fetch strategy %s' % (fetch_strategy))
 
     return fetcher(urllib.parse.unquote(url))
 
 
+@ft.lru_cache(maxsize=None)
+def article_store():
+    """Returns the article store configured by ARTICLE_STORE and
+    ARTICLE_STORE_PATH, relative paths are from the tagging directory."""
+    location = os.path.join(os.path.dirname(app.root_path), app.config['ARTICLE_STORE_PATH'])
+    return articlestore.store_from_config(app.config['ARTICLE_STORE'], location)
+
+
 def intro_from_article(html):
     """Given a wikipedia article HTML, will return the introduction of the article.
 
@@ -86,8 +123,14 @@ class WikipediaAction(object):
         self.api_base_url = api_base_url
 
 
+class WikipediaAPIError(Exception):
+    """The wikipedia API returned an error instead of a result."""
+
+
 class WPQuery(WikipediaAction):
     """A query action on the wikipedia API."""
+    # the API ignores titles beyond this many in a query
+    MAX_TITLES = 50
 
     def by_titles(self, titles, **kwargs):
         if isinstance(titles, str):
@@ -101,24 +144,42 @@ class WPQuery(WikipediaAction):
         }
         params.update(kwargs)
 
-        resp = requests.post(self.api_base_url, params=params)
-        return resp.json()
+        resp = http.post(self.api_base_url, params=params)
+        resp.raise_for_status()
+        result = resp.json()
+        if 'error' in result:
+            raise WikipediaAPIError('{code}: {info}'.format(**result['error']))
+        return result
 query = WPQuery()
 
 
 def _fetch_html_from_url(url):
-    """Given a wikipedia URL, fetches the HTML content for the URL."""
-    return requests.get(url).text
-
-
-def _fetch_html_from_cache(url, cache_root):
-    """Given a wikipedia URL, fetches the HTML content from the cache."""
-    if url.startswith('https://'):
-        url = url[8:]
-    elif url.startswith('http://'):
-        url = url[7:]
-
-    return ''.join(open(os.path.join(cache_root, url)).readlines())
+    """Given a wikipedia URL, fetches the HTML content for the URL. Raises
+    requests.HTTPError for an error response, e.g. a missing page or one
+    still throttled once the retries ran out."""
+    resp = http.get(url)
+    resp.raise_for_status()
+    return resp.text
+
+
+def _fetch_html_from_cache(url, store):
+    """Given a wikipedia URL, fetches the HTML content from the article store,
+    falling back to the URL and writing the content back to the store. Error
+    responses raise before they are stored. The year pages of the current
+    year still gain events and are always fetched."""
+    if _is_current_year_page(url):
+        return _fetch_html_from_url(url)
+
+    html = store.get(url)
+    if html is None:
+        html = _fetch_html_from_url(url)
+        store.put(url, html)
+    return html
+
+
+def _is_current_year_page(url):
+    title = url.rsplit('/wiki/', 1)[-1]
+    return title.isdigit() and int(title) >= datetime.date.today().year
 
 
 def _eng_url_from_title(title):
@@ -0,0 +1,175 @@
+"""
+metrics.py
+
+in-process counters and histograms for the pipeline, exposed in the
+prometheus text format and optionally sent to statsd
+"""
+import bisect
+import collections
+import contextlib
+import logging
+import re
+import socket
+import threading
+import time
+
+from flask import Response
+
+from app import app
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+MEMORY_BUCKETS = (1e6, 1e7, 1e8, 2.5e8, 5e8, 1e9, 2e9, 4e9)
+# characters of a label value which would split or break a statsd stat name
+STATSD_UNSAFE = re.compile(r'[^A-Za-z0-9_-]')
+# the part of a statsd stat name for an empty label value
+STATSD_EMPTY = 'none'
+
+
+class Histogram(object):
+    """Cumulative histogram of observations over fixed buckets."""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry(object):
+    """Holds the counters and histograms of the process, keyed by metric name
+    and labels."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=DEFAULT_BUCKETS):
+        with self.lock:
+            key = (name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def render(self):
+        """Returns all the metrics in the prometheus text exposition format."""
+        lines, typed = [], set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items(), key=_metric_name):
+                if name not in typed:
+                    lines.append('# TYPE {} counter'.format(name))
+                    typed.add(name)
+                lines.append('{}{} {}'.format(name, _label_str(labels), value))
+
+            for (name, labels), hist in sorted(self.histograms.items(), key=_metric_name):
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                    cumulative += count
+                    bucket_labels = labels + (('le', str(bound)),)
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _label_str(bucket_labels), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _label_str(labels), hist.sum))
+                lines.append('{}_count{} {}'.format(name, _label_str(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdClient(object):
+    """Sends metrics to statsd over UDP, errors are ignored. The label values
+    are appended to the name of a stat as one part each, e.g. the host
+    en.wikipedia.org as en_wikipedia_org."""
+    def __init__(self, host, port=8125, prefix='timelines'):
+        self.addr = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind, labels=()):
+        stat = '.'.join([self.prefix, name] + [_statsd_part(v) for (_, v) in labels])
+        try:
+            self.sock.sendto('{}:{}|{}'.format(stat, value, kind).encode('utf-8'), self.addr)
+        except OSError as e:
+            logging.debug('Could not send %s to statsd: %s', stat, e)
+
+
+def _statsd_part(value):
+    return STATSD_UNSAFE.sub('_', str(value)) or STATSD_EMPTY
+
+
+registry = Registry()
+statsd = None
+if app.config.get('METRICS_STATSD_HOST'):
+    statsd = StatsdClient(app.config['METRICS_STATSD_HOST'],
+                          app.config.get('METRICS_STATSD_PORT', 8125),
+                          app.config.get('METRICS_STATSD_PREFIX', 'timelines'))
+_local = threading.local()
+
+
+def inc(name, value=1, **labels):
+    """Increments a counter."""
+    labels = _labels(labels)
+    registry.inc(name, value, labels)
+    if statsd:
+        statsd.send(name, value, 'c', labels)
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Records an observation in a histogram."""
+    labels = _labels(labels)
+    registry.observe(name, value, labels, buckets)
+    if statsd:
+        statsd.send(name, value * 1000 if name.endswith('_seconds') else value,
+                    'ms' if name.endswith('_seconds') else 'h', labels)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Records the seconds taken by the block in a histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextlib.contextmanager
+def stage_context(stage):
+    """Sets the pipeline stage the current thread is running."""
+    previous = current_stage()
+    _local.stage = stage
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+
+def current_stage():
+    return getattr(_local, 'stage', '')
+
+
+def prometheus_view():
+    """Flask view exposing the metrics of the process for prometheus."""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _metric_name(item):
+    return item[0][0]
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for (k, v) in labels.items()))
+
+
+def _label_str(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('"', '\\"')) for (k, v) in labels) + '}'
@@ -0,0 +1,70 @@
+"""
+priorities.py
+
+priority classes of pipeline runs. Each class has its own queue of each kind
+of TASK_QUEUES, '<kind>.<priority>' e.g. 'cpu.interactive', so that workers
+can be reserved for a class, and runs are only admitted while the queues of
+their class are not too deep.
+"""
+import fnmatch
+import logging
+
+import redis
+
+from app import TASK_QUEUES, app
+from app.lib import redisconn
+
+
+PRIORITIES = ('interactive', 'normal', 'bulk')
+DEFAULT_PRIORITY = 'normal'
+
+
+def queue_name(kind, priority=DEFAULT_PRIORITY):
+    return '{}.{}'.format(kind, priority)
+
+
+def task_kind(task_name):
+    """Returns the kind of queue, 'io' or 'cpu', the task runs on. Tasks
+    not in TASK_QUEUES run on 'cpu'."""
+    for kind, patterns in TASK_QUEUES.items():
+        if any(fnmatch.fnmatchcase(task_name, p) for p in patterns):
+            return kind
+    return 'cpu'
+
+
+def task_queue(task_name, priority=DEFAULT_PRIORITY):
+    """Returns the queue the task runs on for a run of the priority."""
+    if priority not in PRIORITIES:
+        raise ValueError('Don\'t understand priority %s' % (priority))
+    return queue_name(task_kind(task_name), priority)
+
+
+def with_priority(signatures, priority):
+    """Returns the task signatures set to run on the queues of the
+    priority."""
+    return [sig.set(queue=task_queue(sig.task, priority)) for sig in signatures]
+
+
+def queue_depth(priority):
+    """Returns the number of tasks waiting on the queues of the priority, or
+    None when the broker cannot be asked."""
+    client = redisconn.client(app.config['CELERY_BROKER_URL'])
+    try:
+        return sum(client.llen(queue_name(kind, priority)) for kind in sorted(TASK_QUEUES))
+    except redis.RedisError as e:
+        logging.warn('Could not read the depth of the %s queues: %s', priority, e)
+        return None
+
+
+def admission_retry_after(priority):
+    """Returns None when a run of the priority may be enqueued, or the
+    seconds after which to try again when its queues are deeper than
+    ADMISSION_MAX_QUEUE_DEPTH. Runs are admitted when the depth cannot be
+    read, the broker itself is then the limit."""
+    limit = app.config['ADMISSION_MAX_QUEUE_DEPTH'].get(priority)
+    if limit is None:
+        return None
+    depth = queue_depth(priority)
+    if depth is None or depth < limit:
+        return None
+    return app.config['ADMISSION_RETRY_AFTER_SECS']
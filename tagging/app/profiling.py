@@ -0,0 +1,144 @@
+"""
+profiling.py
+
+sampling profiler for the stages of the pipeline, which records stacks in
+the collapsed format read by flame graph tools, and the tracker of the memory
+they allocate
+"""
+import collections
+import os
+import sys
+import threading
+import tracemalloc
+
+
+# the memory trackers open in the process, tracemalloc is stopped when the
+# last of them closes if one of them started it
+_trackers_lock = threading.Lock()
+_trackers_open = 0
+_trackers_started_tracing = False
+
+
+class SamplingProfiler(object):
+    """Samples the stack of a thread at a fixed interval from a background
+    thread and counts how often each stack is seen.
+
+    Usage:
+        with SamplingProfiler() as profiler:
+            work()
+        profiler.collapsed('work')
+    """
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample, name='sampling-profiler')
+        self._sampler.daemon = True
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def collapsed(self, root=None):
+        """Returns the sampled stacks in the collapsed format, one line per
+        stack with the frames from the outermost separated by ';' followed by
+        the number of samples. root is prepended to every stack when given."""
+        lines = []
+        for stack, count in self.stacks.most_common():
+            frames = (root,) + stack if root else stack
+            lines.append('{} {}'.format(';'.join(frames), count))
+        return '\n'.join(lines)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_stack_from_frame(frame)] += 1
+
+
+class MemoryTracker(object):
+    """Traces the memory allocated by Python with tracemalloc while it is
+    open and keeps the peak over what was allocated when it opened. Memory
+    allocated outside the interpreter, e.g. by the HeidelTime process, is not
+    seen, and in a process running several tasks at once, e.g. a pool of
+    green threads, the allocations of the others are. When memory was already
+    being traced the peak is the highest since then, so that the peak of
+    an enclosing tracker is left as it is. Tracing goes on until the last
+    tracker open in the process closes, trackers may close in any order.
+
+    Usage:
+        with MemoryTracker() as tracker:
+            work()
+        tracker.usage()
+    """
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.peak = None
+        self.allocated = None
+        self._base = 0
+
+    def start(self):
+        global _trackers_open, _trackers_started_tracing
+        with _trackers_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                _trackers_started_tracing = True
+            _trackers_open += 1
+            self._base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def stop(self):
+        global _trackers_open, _trackers_started_tracing
+        with _trackers_lock:
+            current, peak = tracemalloc.get_traced_memory()
+            _trackers_open -= 1
+            if _trackers_open == 0 and _trackers_started_tracing:
+                tracemalloc.stop()
+                _trackers_started_tracing = False
+        self.peak = max(0, peak - self._base)
+        self.allocated = current - self._base
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def usage(self):
+        """Returns the peak bytes allocated while open, and the bytes still
+        allocated when it closed."""
+        return {'peak_bytes': self.peak, 'allocated_bytes': self.allocated}
+
+
+def _stack_from_frame(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def collapsed_profiles(profiles):
+    """Given a dict of stage name to collapsed stacks, returns the stacks of
+    all the stages as a single collapsed profile rooted at each stage."""
+    lines = []
+    for stage, stacks in profiles.items():
+        lines.extend('{};{}'.format(stage, line) for line in stacks.split('\n') if line)
+    return '\n'.join(lines) + '\n'
@@ -3,13 +3,17 @@ tasks.py
 
 module to connect a celery instance to this flask application
 """
-from celery.contrib import rdb
-from app import celery
-from app.tasks import captions
-from app.tasks import requests
-from app.tasks import wikitext
+from app import celery, priorities
+from app.lib import singleflight
 
 
 @celery.task
 def add(x, y):
     return x + y
+
+
+@celery.task
+def release_video_flight(video_id, token, priority=priorities.DEFAULT_PRIORITY):
+    """Releases the flight of a video at a priority once the run holding it
+    has finished or failed, so the next submission starts a new run."""
+    singleflight.release(video_id, token, priority)
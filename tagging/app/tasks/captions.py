@@ -5,56 +5,100 @@ module containing tasks for captions
 """
 import html
 import logging
-import operator as op
 import os
 from os import path
-import re
 import subprocess
 from xml.etree import ElementTree as ET
 
-from app import app, celery, lib
+from app import app, celery, lib, metrics, tracing
+from app.lib import timeml
+from app.lib.context import EntityContext
 from app.tasks import requests as treq
+from app.tasks.stage import stage
 
 
 CAPTION_SERVICE_URL = 'http://video.google.com/timedtext'
 HEIDELTIME_WD = path.join(app.root_path, app.config['HEIDELTIME_LIB_DIR'])
-TML_REGEX = "<TimeML>(.*)</TimeML>"
-TML_MATCHER = re.compile(TML_REGEX, re.DOTALL)
-TIMX_REGEX = "<TIMEX3[^>]*>[^<]*</TIMEX3>"
-TIMX_MATCH = re.compile(TIMX_REGEX)
 
 
 @celery.task
-def youtube_captions_from_video(video_id):
-    """Given a video_id returns the captions of the video."""
+@stage
+def youtube_captions_from_video(video_id, meta=None):
+    """Given a video_id returns the captions of the video. meta holds the
+    options of the run, the captions are fetched within its deadline."""
     return treq.fetch_url_result(CAPTION_SERVICE_URL, {'lang': 'en', 'v': video_id})
 
 
 @celery.task
-def annotate_events_in_captions(caption_result, video_id, save_to_file=False):
-    """Given captions as string and a video_id, extracts events."""
+@stage
+def annotate_events_in_captions(caption_result, video_id, save_to_file=False, meta=None):
+    """Given captions as string and a video_id, extracts events. meta holds
+    the options of the run, e.g. {'profile': True}, and is carried in the
+    extract for the later stages."""
     # container for the result
     video_extract = {
         'video_id': video_id,
         'captions': {'sents':[], 'ents': []},
         'heidel': {'sents':[]}
     }
+    # the meta of the run, with what the caption fetch kept in the meta of
+    # its result, e.g. its profile
+    meta = dict(meta or {}, **(caption_result.get('meta') or {}))
+    if meta:
+        video_extract['meta'] = meta
     if not caption_result['text']: return video_extract
 
-    captions = ET.fromstring(caption_result['text'])
-    text_blobs = [html.unescape(tn.text).replace('\n', ' ') for tn in captions.findall('text')]
-    text_times = [tn.attrib.get('start') for tn in captions.findall('text')]
+    text_blobs, text_times = text_blobs_from_captions(caption_result['text'])
+
+    # captions too long to parse within the memory ceiling of a video are
+    # parsed, and annotated, a segment at a time
+    segments = caption_segments(text_blobs, text_times, segment_chars())
+    if len(segments) > 1:
+        logging.info('Annotating the captions of %s in %d segments to bound the memory of '
+                     'parsing them', video_id, len(segments))
+        video_extract.setdefault('meta', {})['segments'] = len(segments)
+        metrics.inc('caption_segmented_total')
+
+    entities, sents, timestamps = (), (), ()
+    heidel_sents, annotated_any = [], False
+    for blobs, times in segments:
+        seg_entities, seg_sents, seg_timestamps = sentences_from_captions(blobs, times)
+        entities += seg_entities
+        sents += seg_sents
+        timestamps += seg_timestamps
+        # a segment without TimeML keeps its sentences unannotated, so that
+        # the annotated sentences stay aligned with the caption sentences
+        annotated = heideltime_sentences(seg_sents, video_id)
+        annotated_any = annotated_any or annotated is not None
+        heidel_sents.extend(seg_sents if annotated is None else annotated)
+    video_extract['captions']['ents'] = entities
+    video_extract['captions']['sents'] = sents
+    video_extract['captions']['timestamps'] = timestamps
+    metrics.inc('caption_sentences_total', len(sents))
+
+    if not annotated_any:
+        logging.info('Did not find any TimeML in the HeidelTime output')
+        return video_extract
+    video_extract['heidel']['sents'] = heidel_sents
+
+    return video_extract
 
-    # parse the text blocks into entities and sentences
+
+def sentences_from_captions(text_blobs, text_times):
+    """Parses caption texts into sentences. Returns a tuple of the entities,
+    the text and the timestamp of each sentence."""
     entity_and_sent = lib.nlp_over_lines_as_blob(text_blobs, lib.entities_from_span, lib.str_from_span)
     entity_and_sent_pairs = list(entity_and_sent)
     # inside-out trick, converts a list of tuples into a tuple of lists, which get unpacked
     entities, sents = zip(*entity_and_sent_pairs)
     timestamps, sents = zip(*assign_timestamp_to_sentences(text_blobs, text_times, sents))
-    video_extract['captions']['ents'] = entities
-    video_extract['captions']['sents'] = sents
-    video_extract['captions']['timestamps'] = timestamps
+    return entities, sents, timestamps
 
+
+def heideltime_sentences(sents, video_id):
+    """Annotates sentences with TimeML by running HeidelTime over them.
+    Returns the annotated sentences or None when HeidelTime found no
+    TimeML."""
     infile = lib.save_to_tempfile_as_lines(sents, prefix='cap-'+video_id,
                                            dir=app.config['HEIDELTIME_TMPINPUT_DIR'])
     logging.debug('Wrote {} caption sentences for extraction'.format(len(sents)))
@@ -65,18 +109,54 @@ def annotate_events_in_captions(caption_result, video_id, save_to_file=False):
 
     # run the command and get the output
     logging.info('Invoking HeidelTime with {}'.format(' '.join(cmd_args)))
-    res = subprocess.run(cmd_args, cwd=HEIDELTIME_WD, stdout=subprocess.PIPE)
+    with metrics.timer('heideltime_seconds'), \
+            tracing.span('heideltime', sentences=len(sents)) as span:
+        res = subprocess.run(cmd_args, cwd=HEIDELTIME_WD, stdout=subprocess.PIPE)
+        span.tag('returncode', res.returncode)
     output = res.stdout.decode('utf-8')
-    match = TML_MATCHER.search(output)
-    if not match:
-        logging.info('Did not find any TimeML in the HeidelTime output')
-        return video_extract
-
-    body = match.group(1)
-    sents = [sent for sent in body.split('\n') if len(sent)]
-    video_extract['heidel']['sents'] = sents
-
-    return video_extract
+    body = timeml.body_from_timeml(output)
+    if body is None:
+        return None
+    return [sent for sent in body.split('\n') if len(sent)]
+
+
+def segment_chars():
+    """Returns the most characters of captions parsed at once for a video to
+    stay under VIDEO_MEMORY_CEILING_BYTES, and within the longest text the
+    spaCy model accepts, or None without either limit."""
+    limits = [getattr(lib.get_nlp(), 'max_length', None)]
+    ceiling = app.config.get('VIDEO_MEMORY_CEILING_BYTES')
+    if ceiling:
+        limits.append(max(1, ceiling // app.config.get('NLP_BYTES_PER_CHAR', 400)))
+    limits = [l for l in limits if l]
+    return min(limits) if limits else None
+
+
+def caption_segments(text_blobs, text_times, max_chars=None):
+    """Splits caption texts and their start times into consecutive segments
+    of at most max_chars characters of text, a longer text is a segment of
+    its own. Returns a list of (texts, times), a single segment without
+    max_chars."""
+    if not max_chars or sum(len(b) + 1 for b in text_blobs) <= max_chars:
+        return [(text_blobs, text_times)]
+    segments, start, chars = [], 0, 0
+    for idx, blob in enumerate(text_blobs):
+        if chars and chars + len(blob) + 1 > max_chars:
+            segments.append((text_blobs[start:idx], text_times[start:idx]))
+            start, chars = idx, 0
+        chars += len(blob) + 1
+    segments.append((text_blobs[start:], text_times[start:]))
+    return segments
+
+
+def text_blobs_from_captions(captions_xml):
+    """Given the timedtext XML of captions, returns a list of the caption
+    texts and a list of their start times."""
+    captions = ET.fromstring(captions_xml)
+    text_nodes = captions.findall('text')
+    text_blobs = [html.unescape(tn.text).replace('\n', ' ') for tn in text_nodes]
+    text_times = [tn.attrib.get('start') for tn in text_nodes]
+    return text_blobs, text_times
 
 
 def assign_timestamp_to_sentences(text_blobs, text_times, sentences):
@@ -120,39 +200,38 @@ def assign_timestamp_to_sentences(text_blobs, text_times, sentences):
 
 
 @celery.task
-def event_dates_from_timeml_annotated_captions(video_extract):
+@stage
+def event_dates_from_timeml_annotated_captions(video_extract, window_secs=None):
     """Extracts events their dates and the entities associated with the
     event from captions which have been annotated with TimeML.
 
     Params:
         - video_extract - {
             'video_id': '<video_id>',
-            'captions': { 'sents': [ plain text sentences ] },
+            'captions': { 'sents': [ plain text sentences ],
+                          'timestamps': [ start time of each sentence ] },
             'heidel': { 'sents': [ annotated sentences ] }
         }
-        - video_id - string with the video_id
+        - window_secs - seconds either side of a sentence from which context
+          entities are taken, defaults to CONTEXT_WINDOW_SECS. When None
+          the context is one sentence either side.
     """
     cap_ents = video_extract['captions']['ents']
     cap_timeann = video_extract['heidel']['sents']
     logging.debug('Entities: {}'.format(cap_ents))
     logging.debug('Annotated: {}'.format(cap_timeann))
 
-    events = []
-    ctx_ents = context_window(cap_ents, bef=1, aft=1)
-    for ann, entities in zip(cap_timeann, ctx_ents):
-        matches = TIMX_MATCH.finditer(ann)
-        if not matches:
-            events.append(())
-            continue
-
-        entities['before'] = [e for bl in entities['before'] for e in bl]
-        entities['after'] = [e for al in entities['after'] for e in al ]
+    if window_secs is None:
+        window_secs = app.config.get('CONTEXT_WINDOW_SECS')
+    entity_ctx = EntityContext(cap_ents, video_extract['captions'].get('timestamps'))
 
-        event_text, event_date = op.itemgetter(0), op.itemgetter(1)
-        ann_events = [_event_metadata(match) for match in matches]
+    events = []
+    ctx_ents = entity_ctx.windows(secs=window_secs, bef=1, aft=1)
+    ann_timexes = timeml.timexes_by_sentence(cap_timeann)
+    for timexes, entities in zip(ann_timexes, ctx_ents):
         ann_events = [
-            {'text': event_text(e), 'date': event_date(e), 'ents': entities}
-            for e in ann_events if (event_text(e) and event_date(e))
+            {'text': t.text, 'date': t.value, 'ents': entities}
+            for t in timexes if (t.type == 'DATE' and t.text and t.value)
         ]
         events.append(ann_events)
 
@@ -160,38 +239,4 @@ def event_dates_from_timeml_annotated_captions(video_extract):
     return video_extract
 
 
-def context_window(listy, bef=1, aft=1):
-    """Given a list-list object (supporting random access) yields context
-    windows before and after each item."""
-    for i in range(len(listy)):
-        idxb, idxaf = max(0, i-bef), min(i+aft+1, len(listy))
-        before, after = listy[idxb:i], listy[i:idxaf]
-        yield {'item': listy[i], 'before': before, 'after': after}
-
-
-def _event_metadata(re_match_object):
-    """Given a regex match object matching a TIMEX3 tag returns
-    title and date metadata about the event.
-
-    Params:
-        re_match_object - re.MAtchObject
-
-    Returns:
-        A tuple (desc, date_pattern)
-    """
-    match = re_match_object
-    start, end = (match.start(), match.end())
-    tag_str = match.string[start:end]
-    try:
-        event = ET.fromstring(tag_str)
-        if event.attrib.get('type') == 'DATE':
-            desc = event.text
-            date = event.attrib.get('value')
-            return (desc, date)
-        else:
-            return (None, None)
-    except ET.ParseError:
-        import pdb; pdb.set_trace()
-
-
 # testing
@@ -3,9 +3,8 @@ requests.py
 
 tasks to make http requests
 """
-import requests
-
 from app import celery
+from app.lib import http
 
 
 RESPONSE_SERIAL_FIELDS = [
@@ -32,13 +31,13 @@ def fetch_url_result(url, params):
         additionally, if the response is in JSON, result contains a json
         field.
     """
-    resp = requests.get(url, params=params)
+    resp = http.get(url, params=params)
     return serializable_requests_response(resp)
 
 
 @celery.task
 def send_url_payload(payload, url, headers=None):
-    resp = requests.post(url, payload, headers=headers)
+    resp = http.post(url, payload, headers=headers)
     return serializable_requests_response(resp)
 
 
@@ -0,0 +1,141 @@
+"""
+stage.py
+
+decorator for the tasks which make up the stages of the pipeline
+"""
+import contextlib
+import functools
+import logging
+import time
+
+from app import app, metrics, profiling, tracing
+from app.lib import deadline
+
+
+def stage(func):
+    """Wraps a pipeline task to record its duration, calls and failures,
+    labelled with the name of the task. Apply below @celery.task.
+
+    When the meta of the run asks for a profile, the task is run under the
+    sampling profiler and its collapsed stacks are kept in the meta of the
+    extract it returns, under meta['profiles'][<task name>]. Likewise when
+    it asks to 'trace_memory', the memory the task allocates is traced and
+    its peak kept under meta['memory'][<task name>].
+
+    When the meta has a 'budget' of seconds, the first stage of the run
+    sets its 'deadline' that far from when it starts, so time waiting in the
+    queues does not count, and passes it on in the meta of its result. The
+    task runs within the deadline, so its requests time out by then. A stage
+    given an extract with events once the deadline has passed is skipped,
+    the extract passed on as it is and the stage listed in meta['degraded'],
+    so a run out of time still completes with what it has.
+
+    The task is recorded as a span of the trace of its run, and the spans
+    of the process are exported when it returns."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        meta = meta_from_args(args, kwargs)
+        started = start_deadline(meta)
+        trace_id, parent_id = tracing.trace_of_task(meta)
+        try:
+            with tracing.trace_context(trace_id, parent_id), \
+                    tracing.span(name, video_id=video_id_from_args(args)) as span:
+                return run_stage(meta, started, span, args, kwargs)
+        finally:
+            tracing.flush()
+
+    def run_stage(meta, started, span, args, kwargs):
+        start = time.perf_counter()
+        if _out_of_time(meta, args):
+            logging.warn('Skipping stage %s, the deadline of the run has passed', name)
+            metrics.inc('pipeline_stage_skipped_total', stage=name)
+            span.tag('degraded', True)
+            return degraded(args[0], name)
+
+        profiler = None
+        if meta.get('profile'):
+            profiler = profiling.SamplingProfiler(app.config.get('PROFILE_INTERVAL_SECS', 0.005))
+
+        tracker = None
+        if meta.get('trace_memory'):
+            tracker = profiling.MemoryTracker()
+
+        with metrics.stage_context(name), deadline.deadline_context(meta.get('deadline')):
+            try:
+                with contextlib.ExitStack() as instruments:
+                    for instrument in (profiler, tracker):
+                        if instrument is not None:
+                            instruments.enter_context(instrument)
+                    result = func(*args, **kwargs)
+                if tracker is not None:
+                    metrics.observe('pipeline_stage_peak_bytes', tracker.peak,
+                                    metrics.MEMORY_BUCKETS, stage=name)
+                    span.tag('memory.peak_bytes', tracker.peak)
+                if (isinstance(result, dict) and (started or 'meta' in result)
+                        and meta.get('deadline')):
+                    # the deadline goes on with the result, even when the
+                    # stage built the meta of its result afresh
+                    result.setdefault('meta', meta).setdefault('deadline', meta['deadline'])
+                if isinstance(result, dict) and (profiler is not None or tracker is not None):
+                    result_meta = result.setdefault('meta', meta)
+                    if profiler is not None:
+                        result_meta.setdefault('profiles', {})[name] = profiler.collapsed()
+                    if tracker is not None:
+                        result_meta.setdefault('memory', {})[name] = tracker.usage()
+                return result
+            except Exception:
+                metrics.inc('pipeline_stage_failures_total', stage=name)
+                raise
+            finally:
+                metrics.observe('pipeline_stage_seconds', time.perf_counter() - start, stage=name)
+                metrics.inc('pipeline_stage_calls_total', stage=name)
+
+    return wrapper
+
+
+def _out_of_time(meta, args):
+    return (meta.get('deadline') is not None and meta['deadline'] <= time.time()
+            and args and isinstance(args[0], dict) and 'events' in args[0])
+
+
+def degraded(video_extract, name):
+    """Records in the meta of the extract that stage name did not complete
+    its work for lack of time. Returns the extract."""
+    stages = video_extract.setdefault('meta', {}).setdefault('degraded', [])
+    if name not in stages:
+        stages.append(name)
+    return video_extract
+
+
+def video_id_from_args(args):
+    """Returns the id of the video a task works on, from the extract or the
+    video id passed as its first argument."""
+    if args and isinstance(args[0], dict):
+        return args[0].get('video_id')
+    if args and isinstance(args[0], str):
+        return args[0]
+    return None
+
+
+def start_deadline(meta):
+    """Sets the deadline of a run with a 'budget' but no deadline yet to the
+    budget from now. Returns whether it was set."""
+    if meta.get('budget') is None or meta.get('deadline') is not None:
+        return False
+    meta['deadline'] = deadline.deadline_from_budget(meta['budget'])
+    return True
+
+
+def meta_from_args(args, kwargs):
+    """Returns the meta of a run from the arguments of a task: the meta
+    keyword, updated with the meta of the result of the previous stage passed
+    as the first argument, e.g. the deadline it started."""
+    meta = kwargs.get('meta')
+    passed = args[0].get('meta') if args and isinstance(args[0], dict) else None
+    if meta is None:
+        return passed or {}
+    if passed:
+        return dict(meta, **passed)
+    return meta
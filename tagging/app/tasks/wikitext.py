@@ -5,184 +5,457 @@ module containing tasks for wikitext processing
 """
 from bs4 import BeautifulSoup
 import collections
+from concurrent import futures
 import functools
 import logging
 import operator as op
 import re
 import requests
 
-import en_core_web_sm
+import numpy as np
 
-from app import app, celery, lib
+from app import app, celery, lib, metrics
+from app.lib import annindex
+from app.lib import datevalue as dv
+from app.lib import deadline
+from app.lib import embeddings, extractfile, http
+from app.lib import matchparams as mp
 from app.lib import wikipedia as wp
-
-
-DatePtn = collections.namedtuple('DatePtn', 'year month months day ssn')
+from app.tasks.stage import degraded, stage
 
 
 CITE_REGEX = '\[\d+\]'
 CITE_MATCH = re.compile(CITE_REGEX)
-DEFAULT_DATEPTN = DatePtn(year=None, month=None, months=None, day=None, ssn=None)
-ENTITY_TYPE_BLACKLIST = [
-    'CARDINAL', 'DATE', 'LANGUAGE', 'MONEY',
-    'ORDINAL', 'PERCENT', 'QUANTITY', 'TIME',
-]
-ITEM_MATCH_THRESHOLD = 0.25
-WINDOW_MATCH_THRESHOLD = 0.18
-MONTHS_BY_INDEX = {
-    '01': 'January', '02': 'February', '03': 'March',
-    '04': 'April', '05': 'May', '06': 'June',
-    '07': 'July', '08': 'August',  '09': 'September',
-    '10': 'October', '11': 'November', '12': 'December'
-}
 STOP_DATES = ['PRESENT_REF', 'XXXX-XX-XX']
-# Time parsing regular expressions
-YMD_REGEX = '(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
-YM_REGEX  = '(?P<year>\d{4})-(?P<month>\d{2})'
-YS_REGEX  = '(?P<year>\d{4})-(?P<season>\S+)'
-YR_REGEX  = '(?P<year>\d{4})'
-YMD_MATCH = re.compile(YMD_REGEX)
-YM_MATCH = re.compile(YM_REGEX)
-YS_MATCH = re.compile(YS_REGEX)
-YR_MATCH = re.compile(YR_REGEX)
+WIKIPEDIA_URL = 'https://en.wikipedia.org/wiki/'
 
 
 @celery.task
+@stage
 def wikipedia_events_from_dates(video_extract):
-    """Fetches wikipedia event descriptions given dates."""
+    """Fetches wikipedia event descriptions given dates.
+
+    Events are grouped by their fetch plan so each distinct wikipedia page is
+    fetched and parsed once, pages are fetched concurrently and the candidate
+    list of a plan is shared by all of its events. Pages which could not be
+    fetched before the deadline of the run add no candidates."""
     events = video_extract['events']
+    max_years = app.config['WIKI_PLAN_MAX_YEARS']
 
+    event_plans = []
     for i, sent in enumerate(events):
         for j, event in enumerate(sent):
-            date = date_from_pattern(event['date'])
-            if not date or not date.year:
+            plan = dv.fetch_plan(event['date'], max_years)
+            if not plan:
                 event['wiki'] = []
                 continue
 
-            logging.info('Sent {}, candidate event {} on date {}'.format(i, j, date))
-            event['wiki'] = wikitexts_from_date(date)
+            logging.info('Sent {}, candidate event {} on date {}'.format(i, j, event['date']))
+            event_plans.append((event, plan))
+
+    plans = set(plan for (_, plan) in event_plans)
+    urls = [url for plan in plans for url in page_urls_from_plan(plan)]
+    soups = soups_from_urls(urls, app.config['WIKI_FETCH_WORKERS'])
+    if len(soups) < len(set(urls)):
+        degraded(video_extract, 'wikipedia_events_from_dates')
+
+    sections = {}
+    plan_texts = dict((plan, wikitexts_from_plan(plan, soups, sections)) for plan in plans)
+    for event, plan in event_plans:
+        event['wiki'] = list(plan_texts[plan])
+    metrics.inc('wiki_candidates_total', sum(len(e['wiki']) for (e, _) in event_plans))
 
     return video_extract
 
 
-def wikitexts_from_date(date):
-    """Given a DatePtn, returns a list of wikitext for the events on those days."""
-    # get events from the year page
-    wiki_url = "https://en.wikipedia.org/wiki/" + date.year
-    html = requests.get(wiki_url).text
-    year_soup = BeautifulSoup(html, 'html.parser')
+@celery.task
+@stage
+def wikipedia_events_from_index(video_extract):
+    """Finds candidate wikipedia events for the events without a usable date,
+    as the ANN_TOP_K nearest neighbours of their caption sentence in the event
+    index. The candidates carry their year 'page' and similarity 'ann_score',
+    and the event is marked with 'wiki_source': 'ann' so the matchers score
+    it. Does nothing when the index has not been built."""
+    top_k = app.config['ANN_TOP_K']
+    index = annindex.event_index() if top_k else None
+    if index is None:
+        return video_extract
 
-    if date.month:
-        months = [MONTHS_BY_INDEX[date.month]]
-    elif date.ssn:
-        months = [MONTHS_BY_INDEX[m] for m in date.months]
-    else:
-        months = MONTHS_BY_INDEX.values()
+    events = video_extract['events']
+    sents = video_extract['captions']['sents']
+    max_years = app.config['WIKI_PLAN_MAX_YEARS']
+    undated = collections.OrderedDict()
+    for i, sent in enumerate(events):
+        for event in sent:
+            if not event.get('wiki') and not dv.fetch_plan(event['date'], max_years):
+                undated.setdefault(i, []).append(event)
+    if not undated:
+        return video_extract
+
+    queries = embeddings.embed_texts([sents[i] for i in undated])
+    results = index.search(queries, top_k, app.config['ANN_NPROBE'])
+    for sent_events, neighbours in zip(undated.values(), results):
+        candidates = [dict(index.event(idx), ann_score=score) for (idx, score) in neighbours]
+        for event in sent_events:
+            event['wiki'] = [dict(c) for c in candidates]
+            event['wiki_source'] = 'ann'
+    metrics.inc('ann_candidates_total', sum(len(r) for r in results))
 
-    wiki_texts = []
-    for month in months:
-        wiki_texts.extend(events_from_year_soup(year_soup, month))
+    return video_extract
+
+
+def year_page_events(years):
+    """Yields the events on the wikipedia year pages of years, with their
+    year page and month, for the event index."""
+    for year in years:
+        title = dv.year_title(year)
+        try:
+            soup = _soup_from_url(WIKIPEDIA_URL + title)
+        except Exception as e:
+            logging.warn('Could not fetch the year page %s: %s', title, e)
+            continue
+
+        for month in dv.MONTH_NAMES[1:]:
+            try:
+                month_events = events_from_year_soup(soup, month)
+            except AttributeError:
+                logging.info('No section for %s %s', month, title)
+                continue
+            for event in month_events:
+                event['text'] = CITE_MATCH.sub('', event['text'])
+                event.update({'page': title, 'month': month})
+                yield event
+
+
+def page_urls_from_plan(plan):
+    """Returns the urls of the wikipedia pages a FetchPlan needs."""
+    urls = [WIKIPEDIA_URL + year for (year, _) in plan.sections]
+    urls.extend(WIKIPEDIA_URL + month + '_' + day for (_, month, day) in plan.day_pages)
+    return urls
+
+
+def soups_from_urls(urls, max_workers=1):
+    """Fetches and parses each distinct url once, using up to max_workers
+    concurrent requests. Returns a dict of url to soup, without the urls
+    which could not be fetched before the deadline of the run or which
+    responded with an error."""
+    urls = list(collections.OrderedDict.fromkeys(urls))
+    if not urls:
+        return {}
 
-    # get events from the date page
-    if date.day and date.month:
-        wiki_url = "https://en.wikipedia.org/wiki/" + MONTHS_BY_INDEX[date.month] + "_" + date.day
-        html = requests.get(wiki_url).text
-        date_soup = BeautifulSoup(html, 'html.parser')
-        wiki_texts.extend(events_from_date_soup(date_soup, date.year))
+    with futures.ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as pool:
+        soups = pool.map(http.in_context(_soup_in_time), urls)
+        return dict((url, soup) for (url, soup) in zip(urls, soups) if soup is not None)
+
+
+def _soup_in_time(url):
+    try:
+        return _soup_from_url(url)
+    except deadline.DeadlineExceeded as e:
+        logging.warn('Could not fetch %s in time: %s', url, e)
+        return None
+    except requests.HTTPError as e:
+        logging.warn('Could not fetch %s: %s', url, e)
+        return None
+
+
+def _soup_from_url(url):
+    html = wp.article_by_url(url)
+    return BeautifulSoup(html, 'html.parser')
+
+
+def wikitexts_from_plan(plan, soups=None, sections=None):
+    """Given a FetchPlan, returns a list of wikitext for the events in the
+    planned year page sections and date pages.
+
+    Params:
+        plan - FetchPlan
+        soups - dict of url to soup for the pages of the plan, the pages are
+                fetched if not given, pages missing from it are skipped
+        sections - dict of (year, month) to events in the section, used to
+                   share parsed sections across plans
+    """
+    if soups is None:
+        soups = soups_from_urls(page_urls_from_plan(plan))
+    if sections is None:
+        sections = {}
+
+    # get events from the sections of the year pages
+    wiki_texts = []
+    for year, month in plan.sections:
+        if (year, month) not in sections:
+            year_soup = soups.get(WIKIPEDIA_URL + year)
+            if year_soup is None:
+                continue
+            sections[(year, month)] = events_from_year_soup(year_soup, month)
+        month_events = sections[(year, month)]
+        if plan.days is not None:
+            year_num = int(year)
+            month_events = [e for e in month_events
+                            if dv.bullet_in_days(year_num, e['text'], plan.days)]
+        wiki_texts.extend(month_events)
+
+    # get events from the date pages
+    for year, month, day in plan.day_pages:
+        date_soup = soups.get(WIKIPEDIA_URL + month + '_' + day)
+        if date_soup is None:
+            continue
+        wiki_texts.extend(events_from_date_soup(date_soup, year))
 
     return wiki_texts
 
 
 @celery.task
+@stage
 def event_entities_from_wikitext(video_extract):
     """Runs named entity extraction over the wiki text for each extracted event.
-    Extracted entities are saved in the wiki object for each event."""
+    Extracted entities are saved in the wiki object for each event.
+
+    Events with the same fetch plan, or plans sharing a section, have the
+    same candidates, so the entities of each distinct candidate text are
+    extracted once and given to every candidate with that text."""
     events = video_extract['events']
 
     text_cleaner = functools.partial(CITE_MATCH.sub, '')
     entity_extractor = lib.entities_from_span
     nlp_over_lines = lib.nlp_over_lines
 
-    for i, sent in enumerate(events):
-        for j, event in enumerate(sent):
-            if 'wiki' not in event: continue
-
-            wiki_blobs = event['wiki']
-            wiki_texts = [text_cleaner(b['text']) for b in wiki_blobs]
-            extracts = nlp_over_lines(wiki_texts, entity_extractor)
-            for blob, (entities,) in zip(wiki_blobs, extracts):
-                blob['ents'] = entities
+    wiki_blobs = [b for sent in events for event in sent for b in event.get('wiki', [])]
+    blob_texts = [text_cleaner(b['text']) for b in wiki_blobs]
+    distinct_texts = list(collections.OrderedDict.fromkeys(blob_texts))
+    text_entities = dict((text, entities) for (text, (entities,))
+                         in zip(distinct_texts, nlp_over_lines(distinct_texts, entity_extractor)))
+    metrics.inc('ner_candidates_deduplicated_total', len(blob_texts) - len(distinct_texts))
+    for blob, text in zip(wiki_blobs, blob_texts):
+        blob['ents'] = text_entities[text]
 
     return video_extract
 
 
 @celery.task
-def match_event_via_entities(video_extract):
+@stage
+def match_event_via_entities(video_extract, params=None):
     """Atempts to match an extracted event with the candidate wikipedia
-    events for the date."""
-    events = video_extract['events']
+    events for the date. params is a dict of MatchParams fields, see
+    lib/matchparams.py, defaulting to the module thresholds and blacklist."""
+    params = mp.match_params(params)
+    for date, [(match, scores)] in rematch_events(video_extract['events'], [params]):
+        date['match'] = match
+        date['scores'] = scores
+        metrics.inc('candidates_scored_total', len(scores))
 
-    def entity_filter(entity_pairs):
-        return [(e, etype) for (e, etype) in entity_pairs if etype not in ENTITY_TYPE_BLACKLIST]
+    return video_extract
 
+
+def rematch_events(events, params_list):
+    """Yields each event which can be matched by its entities, with its match
+    and scores under each MatchParams of params_list. events are the events
+    of each sentence of an extract, which are consumed a sentence at a time,
+    e.g. from extractfile.iter_extract. Uses the entities saved in the
+    events, and scores the candidates of an event once for each distinct
+    blacklist."""
+    filters = dict((p.entity_blacklist, _entity_filter(p.entity_blacklist)) for p in params_list)
     for candidate_list in events:
         if not candidate_list: continue
         for date in candidate_list:
-            if date['date'] in STOP_DATES: continue
+            if _skip_date(date): continue
+            if 'wiki' not in date:
+                logging.warn('No candidate events fetched for %s', date['date'])
+                continue
 
-            try:
-                match, scores = match_event_on_date(
-                    text=date['text'],
-                    date=date['date'],
-                    ents=date['ents'],
-                    candidate_events=date['wiki'],
-                    entity_filter=entity_filter)
-                date['match'] = match
-                date['scores'] = scores
-            except KeyError as ke:
-                import pdb; pdb.set_trace()
+            scored = dict((blacklist, entity_scores(date['ents'], date['wiki'], entity_filter))
+                          for (blacklist, entity_filter) in filters.items())
+            results = []
+            for p in params_list:
+                item_scores, window_scores = scored[p.entity_blacklist]
+                match = best_entity_match(date['wiki'], item_scores, window_scores,
+                                          p.item_threshold, p.window_threshold)
+                results.append((match, list(zip(item_scores, window_scores))))
+            yield date, results
+
+
+def rematch_stats(events, params_list):
+    """Returns, for each MatchParams of params_list, the number of the events
+    of an extract, see rematch_events, matched under it and how the matches
+    differ from those saved in the events: the events 'added' or 'removed' as
+    matches and those matched to a 'changed' candidate."""
+    stats = [dict(matched=0, added=0, removed=0, changed=0) for _ in params_list]
+    for date, results in rematch_events(events, params_list):
+        saved = date.get('match')
+        for counts, (match, _) in zip(stats, results):
+            if match is not None:
+                counts['matched'] += 1
+            if match is not None and saved is None:
+                counts['added'] += 1
+            elif match is None and saved is not None:
+                counts['removed'] += 1
+            elif match is not None and match['idx'] != saved.get('idx'):
+                counts['changed'] += 1
+    return stats
+
+
+def merge_stats(stats_lists):
+    """Returns the sums of the stats of several extracts, per params."""
+    totals = None
+    for stats in stats_lists:
+        if totals is None:
+            totals = [dict((k, 0) for k in counts) for counts in stats]
+        for total, counts in zip(totals, stats):
+            for k, v in counts.items():
+                total[k] += v
+    return totals or []
 
-    return video_extract
 
+@celery.task
+@stage
+def rematch_stored_extract(video_id, params_list):
+    """Evaluates params_list, dicts of MatchParams fields, over the stored
+    extract of the video using its saved entities. Returns the video id and
+    the rematch_stats of each params, None without a stored extract."""
+    filename = extractfile.stored_filename(video_id)
+    if filename is None:
+        logging.warn('No stored extract of %s to rematch', video_id)
+        return {'video_id': video_id, 'stats': None}
+    _, events = extractfile.iter_extract(filename)
+    return {'video_id': video_id,
+            'stats': rematch_stats(events, [mp.match_params(p) for p in params_list])}
 
-def match_event_on_date(text, date, ents, candidate_events, entity_filter):
-    """Given an event date and entities relevant to the event, tries to match
-    against candidate events fetched from wikipedia.
 
-    Params:
-        text - date text
-        date - date as a pattern
-        ents - Dict containing entity tuples for the event, and for windows
-               before and after the event
-        candidate_events - List of dicts containing: entities, text & links
-               for the candidate events
-        entity_filter - function which filters the relevant entities
-    """
+@celery.task
+def merge_rematch_results(results, params_list):
+    """Sums the results of rematch_stored_extract over the corpus."""
+    return {
+        'params': [mp.match_params(p)._asdict() for p in params_list],
+        'totals': merge_stats(r['stats'] for r in results if r['stats'] is not None),
+        'videos': results,
+    }
+
+
+def _entity_filter(blacklist):
+    blacklist = frozenset(blacklist)
+
+    def entity_filter(entity_pairs):
+        return [(e, etype) for (e, etype) in entity_pairs if etype not in blacklist]
+    return entity_filter
+
+
+def entity_scores(ents, candidate_events, entity_filter):
+    """Returns the jacquard scores of the entities of the event, and of the
+    window around it, against those of each candidate."""
     date_item_ents = entity_filter(ents['item'])
-    item_scores = [jacquard(date_item_ents, entity_filter(e['ents'])) for e in candidate_events]
-    item_matches = [(i, score) for (i, score) in enumerate(item_scores) if score >= ITEM_MATCH_THRESHOLD]
+    candidate_ents = [entity_filter(e.get('ents', [])) for e in candidate_events]
+    item_scores = [jacquard(date_item_ents, ents) for ents in candidate_ents]
 
     date_window_ents = entity_filter(ents['item'] + ents['before'] + ents['after'])
     # score the date ents against each candidate
-    window_scores = [jacquard(date_window_ents, entity_filter(e['ents'])) for e in candidate_events]
-    window_matches = [(i, score) for (i, score) in enumerate(window_scores) if score >= WINDOW_MATCH_THRESHOLD]
+    window_scores = [jacquard(date_window_ents, ents) for ents in candidate_ents]
+    return item_scores, window_scores
+
 
-    event_scores = [(isc, wsc) for (isc, wsc) in zip(item_scores, window_scores)]
+def best_entity_match(candidate_events, item_scores, window_scores, item_threshold,
+                      window_threshold):
+    """Returns a copy of the candidate with the best score above the
+    thresholds, with its 'idx' and 'score', or None."""
+    item_matches = [(i, score) for (i, score) in enumerate(item_scores) if score >= item_threshold]
+    window_matches = [(i, score) for (i, score) in enumerate(window_scores)
+                      if score >= window_threshold]
     matches = merge_item_window_matches(item_matches, window_matches)
     if not matches:
-        return None, event_scores
+        return None
 
     # get the best scoring event and return a copy of its dict
     best_idx, best_score = sorted(matches, key=op.itemgetter(1), reverse=True)[0]
     match_dict = dict(candidate_events[best_idx])
     match_dict.update({'idx': best_idx, 'score': best_score})
-    return match_dict, event_scores
+    return match_dict
 
 
 @celery.task
+@stage
+def match_event_via_vector_sim(video_extract, strategy=None):
+    """Matches extracted events with their candidate wikipedia events by the
+    cosine similarity of the embeddings of the caption sentence and of the
+    candidates, which is saved in 'vec_scores'. The 'vectors' strategy
+    matches on the similarity alone, 'blend' blends it with the entity scores
+    of match_event_via_entities. Defaults to MATCH_STRATEGY."""
+    strategy = strategy or app.config['MATCH_STRATEGY']
+    if strategy not in ('vectors', 'blend'):
+        raise ValueError('Don\'t understand vector match strategy %s' % (strategy))
+    events = video_extract['events']
+    sents = video_extract['captions']['sents']
+    max_years = app.config['WIKI_PLAN_MAX_YEARS']
+
+    # group the events by their candidates, the candidates of a page are then
+    # scored against every sentence referring to them with one matrix product
+    groups = collections.OrderedDict()
+    for i, sent in enumerate(events):
+        for event in sent:
+            if _skip_date(event) or not event.get('wiki'): continue
+            if event.get('wiki_source') == 'ann':
+                # candidates from the event index come with their similarity
+                event['vec_scores'] = [c['ann_score'] for c in event['wiki']]
+                event['match'] = match_event_on_vectors(event, event['vec_scores'], strategy)
+                continue
+            plan = dv.fetch_plan(event['date'], max_years)
+            if not plan: continue
+            texts = tuple(CITE_MATCH.sub('', c['text']) for c in event['wiki'])
+            groups.setdefault((embedding_key_from_plan(plan), texts), []).append((i, event))
+    if not groups:
+        return video_extract
+
+    sent_idxs = sorted(set(i for members in groups.values() for (i, _) in members))
+    sent_vecs = dict(zip(sent_idxs, embeddings.embed_texts([sents[i] for i in sent_idxs])))
+    cache = embeddings.embedding_cache()
+    for (key, texts), members in groups.items():
+        cand_vecs = cache.embeddings(key, list(texts))
+        sims = cand_vecs.dot(np.vstack([sent_vecs[i] for (i, _) in members]).T)
+        for col, (_, event) in enumerate(members):
+            event['vec_scores'] = sims[:, col].tolist()
+            event['match'] = match_event_on_vectors(event, event['vec_scores'], strategy)
+        metrics.inc('candidates_scored_total', sims.size)
+
+    return video_extract
+
+
+def _skip_date(event):
+    """Events with stop dates are not matched, unless they have candidates
+    from the event index."""
+    return event['date'] in STOP_DATES and event.get('wiki_source') != 'ann'
+
+
+def embedding_key_from_plan(plan):
+    """Returns the key the candidate embeddings of a plan are cached under,
+    the title of its first year page."""
+    pages = plan.sections or plan.day_pages
+    return pages[0][0]
+
+
+def match_event_on_vectors(event, vec_scores, strategy):
+    """Returns the candidate of an event with the best vector similarity, or
+    the best blend of it with the entity scores of the event for the 'blend'
+    strategy, when it is above the threshold of the strategy."""
+    if strategy == 'blend' and event.get('scores'):
+        weight = app.config['BLEND_VECTOR_WEIGHT']
+        scores = [(1 - weight) * max(ent_scores) + weight * vec_score
+                  for (ent_scores, vec_score) in zip(event['scores'], vec_scores)]
+        threshold = app.config['BLEND_MATCH_THRESHOLD']
+    else:
+        scores, threshold = vec_scores, app.config['VECTOR_MATCH_THRESHOLD']
+
+    best_idx = max(range(len(scores)), key=scores.__getitem__)
+    if scores[best_idx] < threshold:
+        return None
+    match_dict = dict(event['wiki'][best_idx])
+    match_dict.update({'idx': best_idx, 'score': scores[best_idx]})
+    return match_dict
+
+
+@celery.task
+@stage
 def resolve_match_link_topics(video_extract):
     """Given a video extract, processes all the matched events to augment
-    their links with wikibase_ids."""
+    their links with wikibase_ids. Matches are left without wptopics once the
+    deadline of the run has passed."""
     events = video_extract['events']
 
     for candidate_list in events:
@@ -190,7 +463,12 @@ def resolve_match_link_topics(video_extract):
         for date in candidate_list:
             match = date.get('match')
             if not match: continue
-            match['wptopics'] = resolve_links_to_topics(match['links'])
+            try:
+                match['wptopics'] = resolve_links_to_topics(match['links'])
+            except deadline.DeadlineExceeded as e:
+                logging.warn('Could not resolve the topics of %s in time: %s',
+                             video_extract['video_id'], e)
+                return degraded(video_extract, 'resolve_match_link_topics')
 
     return video_extract
 
@@ -203,12 +481,15 @@ def resolve_links_to_topics(links):
                                 filter(lambda m: m is not None,
                                        map(wp_title_matcher.match, wp_links))))
 
+    if not links_and_titles:
+        return []
     title_wbid_map = dict(wp.wbid_from_titles(*[t for (l, t) in links_and_titles]))
     # Xform (l, title) -> (l, title, id) via (title -> id)
     return [{'href': l, 'title': t, 'wbid': title_wbid_map[t]} for (l, t) in links_and_titles]
 
 
 @celery.task
+@stage
 def score_related_events(video_extract):
     """Scores the related events from a video's matched events for relevance.
 
@@ -241,7 +522,6 @@ def score_related_events(video_extract):
 
             all_wprelated.append((topic, related))
 
-    import pdb; pdb.set_trace()
     related_scores = score_events_in_relation(to=transcript, events=all_wprelated)
     video_extract['wptopics_rel'] = related_scores
 
@@ -255,7 +535,7 @@ def score_events_in_relation(to, events):
         to: iterable of sentences
         events: iterable of ((topic, wptopics_rel))
     """
-    nlp = en_core_web_sm.load()
+    nlp = lib.get_nlp()
 
     scores = []
     to_nlp = nlp(''.join(to))
@@ -318,49 +598,6 @@ def merge_item_window_matches(item_matches, window_matches):
     return unified_matches
 
 
-def date_from_pattern(date_ptn):
-    """Given a date pattern, attempts to parse it and return a DatePtn tuple.
-
-    The following date patterns will be recognised and parsed.
-    YYYY-MM-DD -> (year=YYYY, month=MM, day=DD)
-    YYYY-MM    -> (year=YYYY, month=MM)
-    YYYY-SN    -> (year=YYYY, season=SN, months=<list based on season>)
-    YYYY       -> (year=YYYY)
-    """
-    match1 = YMD_MATCH.match(date_ptn)
-    if match1:
-        m = match1.groupdict()
-        return DEFAULT_DATEPTN._replace(**m)
-
-    match2 = YM_MATCH.match(date_ptn)
-    if match2:
-        m = match2.groupdict()
-        return DEFAULT_DATEPTN._replace(**m)
-
-    match3 = YS_MATCH.match(date_ptn)
-    if match3:
-        m = match3.groupdict()
-        return DEFAULT_DATEPTN._replace(year=m['year'],
-                                        ssn=m['season'],
-                                        months=months_from_season(m['season']))
-
-    match4 = YR_MATCH.match(date_ptn)
-    if match4:
-        m = match4.groupdict()
-        return DEFAULT_DATEPTN._replace(**m)
-
-    return None
-
-
-def months_from_season(season):
-    return {
-        'SP': ['03', '04', '05'],
-        'SU': ['06', '07', '08'],
-        'AU': ['09', '10', '11'],
-        'WI': ['12', '01', '02']
-    }[season]
-
-
 def events_from_year_soup(soup, month):
     """Returns list of events: [{'text': '', 'links': ['']}] which occurred
     in a given month."""
@@ -439,11 +676,11 @@ def test2():
     return events_from_date_soup(soup, year)
 
 
-def test_date_from_pattern():
-    patterns = ["2001-03-26", "1995-09", "2011-SU", "2001"]
-    return [date_from_pattern(p) for p in patterns]
+def test_fetch_plan():
+    patterns = ["2001-03-26", "1995-09", "2011-SU", "2001", "2011-W10", "194X"]
+    return [dv.fetch_plan(p) for p in patterns]
 
 
-def test_wikitexts_from_date():
-    date = date_from_pattern("2011-AU")
-    return wikitexts_from_date(date)
+def test_wikitexts_from_plan():
+    plan = dv.fetch_plan("2011-AU")
+    return wikitexts_from_plan(plan)
@@ -0,0 +1,295 @@
+"""
+tracing.py
+
+spans of the work done for each pipeline run, across the workers its stages
+run in. A run gets a trace id when it is enqueued, which travels in the
+headers of its tasks and, for stages run outside celery, in the meta of its
+extract. Spans are exported in the zipkin v2 json format, to a file or to a
+zipkin collector, and log lines carry the trace id they were written in.
+"""
+import binascii
+import collections
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from celery import current_task
+import requests
+
+from app import app
+
+
+# headers of the tasks of a traced run
+TRACE_ID_HEADER = 'trace_id'
+PARENT_ID_HEADER = 'trace_parent_id'
+
+# trace_id - id of the run the thread is working for
+# span_id - id of the innermost span open in the thread, the parent of the
+#           spans opened in it
+Context = collections.namedtuple('Context', ['trace_id', 'span_id'])
+
+_local = threading.local()
+_lock = threading.Lock()
+_finished = []
+
+
+def new_id(nbytes=8):
+    return binascii.hexlify(os.urandom(nbytes)).decode('ascii')
+
+
+def new_trace_id():
+    return new_id(16)
+
+
+def enabled():
+    return app.config.get('TRACE_EXPORT') in ('file', 'zipkin')
+
+
+def current():
+    return getattr(_local, 'context', None)
+
+
+def current_trace_id():
+    context = current()
+    return context.trace_id if context else None
+
+
+@contextlib.contextmanager
+def trace_context(trace_id, parent_id=None):
+    """Sets the trace, and the span the spans opened in it are children of,
+    of the current thread. A None trace_id leaves the thread untraced."""
+    previous = current()
+    _local.context = Context(trace_id, parent_id) if trace_id else None
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+class Span(object):
+    """A named, timed piece of work of a trace. Tags are strings, those only
+    known within the span can be added with tag()."""
+    def __init__(self, name, trace_id, parent_id, kind=None, tags=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = new_id()
+        self.kind = kind
+        self.tags = {}
+        self.start = time.time()
+        self.duration = None
+        for key, value in (tags or {}).items():
+            self.tag(key, value)
+
+    def tag(self, key, value):
+        if value is not None:
+            self.tags[key] = str(value)
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def as_zipkin(self):
+        span = {
+            'traceId': self.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.start * 1e6),
+            'duration': max(1, int(self.duration * 1e6)),
+            'localEndpoint': {'serviceName': app.config.get('TRACE_SERVICE_NAME', 'timelines')},
+            'tags': self.tags,
+        }
+        if self.parent_id:
+            span['parentId'] = self.parent_id
+        if self.kind:
+            span['kind'] = self.kind
+        return span
+
+
+@contextlib.contextmanager
+def span(name, kind=None, **tags):
+    """Records the block as a span of the current trace, the child of the
+    span the block is opened in. Yields the Span, which is only recorded in a
+    traced thread while an exporter is configured. A span left by an
+    exception is tagged with the error."""
+    context = current()
+    if context is None:
+        yield Span(name, None, None, kind, tags)
+        return
+
+    opened = Span(name, context.trace_id, context.span_id, kind, tags)
+    _local.context = Context(context.trace_id, opened.span_id)
+    try:
+        yield opened
+    except Exception as e:
+        opened.tag('error', type(e).__name__)
+        raise
+    finally:
+        _local.context = context
+        opened.finish()
+        if enabled():
+            record(opened)
+
+
+def record(finished):
+    """Buffers a finished span for export, exporting the buffer once it
+    holds TRACE_MAX_BUFFERED_SPANS."""
+    with _lock:
+        _finished.append(finished.as_zipkin())
+        full = len(_finished) >= app.config.get('TRACE_MAX_BUFFERED_SPANS', 1000)
+    if full:
+        flush()
+
+
+def flush():
+    """Exports the spans buffered by the process. Export failures are logged
+    and the spans dropped, tracing never fails the work it traces."""
+    global _finished
+    with _lock:
+        spans, _finished = _finished, []
+    if not spans:
+        return
+    try:
+        if app.config['TRACE_EXPORT'] == 'zipkin':
+            export_to_zipkin(spans)
+        else:
+            export_to_file(spans)
+    except (OSError, requests.RequestException) as e:
+        logging.warn('Dropped %d spans, could not export them: %s', len(spans), e)
+
+
+def export_to_file(spans):
+    """Appends the spans to TRACE_FILE, one json object per line, in a single
+    write so that the lines of processes sharing the file do not mix."""
+    lines = ''.join(json.dumps(s, separators=(',', ':')) + '\n' for s in spans)
+    with open(trace_filename(), 'a', encoding='utf-8') as fout:
+        fout.write(lines)
+
+
+def export_to_zipkin(spans):
+    resp = requests.post(app.config['TRACE_ZIPKIN_URL'], json=spans,
+                         timeout=app.config.get('TRACE_EXPORT_TIMEOUT_SECS', 2))
+    resp.raise_for_status()
+
+
+def trace_filename():
+    """Returns TRACE_FILE, relative paths are from the tagging directory."""
+    return os.path.join(os.path.dirname(app.root_path), app.config['TRACE_FILE'])
+
+
+def bind(func):
+    """Returns func wrapped to run within the trace and span of the current
+    thread, for handing work to a pool of threads."""
+    context = current()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.context = context
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.context = previous
+    return wrapper
+
+
+def headers(trace):
+    """Returns the task headers carrying a trace, a dict of 'trace_id' and
+    'parent_id' as kept in the meta of a run."""
+    return {TRACE_ID_HEADER: trace['trace_id'], PARENT_ID_HEADER: trace.get('parent_id')}
+
+
+def with_trace(signatures, trace):
+    """Returns the task signatures set to carry the trace in their headers,
+    or as they are without a trace."""
+    if not trace:
+        return signatures
+    return [sig.set(headers=headers(trace)) for sig in signatures]
+
+
+def trace_of_task(meta=None):
+    """Returns the (trace id, parent span id) of the task running in the
+    current thread, from its headers or else the meta of its run, or (None,
+    None) for an untraced run."""
+    request = getattr(current_task, 'request', None)
+    task_headers = getattr(request, 'headers', None) or {}
+    trace_id = task_headers.get(TRACE_ID_HEADER) or getattr(request, TRACE_ID_HEADER, None)
+    if trace_id:
+        return trace_id, (task_headers.get(PARENT_ID_HEADER)
+                          or getattr(request, PARENT_ID_HEADER, None))
+    trace = (meta or {}).get('trace') or {}
+    return trace.get('trace_id'), trace.get('parent_id')
+
+
+def _record_factory(factory):
+    @functools.wraps(factory)
+    def make_record(*args, **kwargs):
+        log_record = factory(*args, **kwargs)
+        log_record.trace_id = current_trace_id() or '-'
+        return log_record
+    return make_record
+
+
+# every log record carries the trace id of its thread, for log formats
+# with %(trace_id)s
+logging.setLogRecordFactory(_record_factory(logging.getLogRecordFactory()))
+
+
+def read_spans(filename, trace_id):
+    """Returns the spans of a trace from a file written by export_to_file."""
+    with open(filename, encoding='utf-8') as fin:
+        spans = [json.loads(line) for line in fin if trace_id in line]
+    return [s for s in spans if s['traceId'] == trace_id]
+
+
+def critical_path(spans):
+    """Returns the spans of a trace on its critical path, in the order they
+    ran: under each span, walking back from its end, the child which
+    finished last, then the one which finished last before that child
+    started, and so on, each followed down the same way. The tasks of a run
+    outlive the span enqueueing them, a span ends here when the last of its
+    children does."""
+    children = collections.defaultdict(list)
+    ids = set(s['id'] for s in spans)
+    for s in spans:
+        children[s.get('parentId') if s.get('parentId') in ids else None].append(s)
+    path = []
+    for root in sorted(children[None], key=lambda s: s['timestamp']):
+        _follow_critical_path(root, children, path)
+    return path
+
+
+def _follow_critical_path(span, children, path):
+    path.append(span)
+    kids = sorted(children[span['id']], key=_span_end, reverse=True)
+    bound = max([_span_end(span)] + [_span_end(k) for k in kids])
+    on_path = []
+    for kid in kids:
+        if _span_end(kid) <= bound:
+            on_path.append(kid)
+            bound = kid['timestamp']
+    for kid in reversed(on_path):
+        _follow_critical_path(kid, children, path)
+
+
+def time_by(spans, key):
+    """Returns the total seconds of the spans by key(span), e.g. their name
+    or the http host they requested, spans with a None key are left out."""
+    totals = collections.Counter()
+    for s in spans:
+        value = key(s)
+        if value is not None:
+            totals[value] += s['duration'] / 1e6
+    return totals
+
+
+def tag_of(tag):
+    """Returns the key of a span by the value of one of its tags."""
+    return lambda s: s.get('tags', {}).get(tag)
+
+
+def _span_end(span):
+    return span['timestamp'] + span['duration']
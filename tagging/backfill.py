@@ -0,0 +1,208 @@
+"""
+backfill.py
+
+runs the pipeline over a corpus of videos in a pool of processes on one
+machine, without a broker. Each extract is written to <out_dir>/<video_id>
+with the EXTRACT_SUFFIX, e.g. .ndjson.gz, as soon as it is done and failures
+are appended to <out_dir>/failures.jsonl, so an interrupted backfill resumes
+where it stopped. A process killed while running a video, e.g. for its
+memory, fails the videos running in the pool, which is started again for
+the rest.
+"""
+import collections
+import concurrent.futures as cf
+from concurrent.futures.process import BrokenProcessPool
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from app import app, lib
+from app.lib import extractfile
+import session
+
+
+FAILURES_FILE = 'failures.jsonl'
+PROGRESS_SECS = 10
+
+
+def video_ids_from_lines(lines):
+    """Yields the video ids in lines, one per line, ignoring blank lines and
+    comments starting with #."""
+    for line in lines:
+        video_id = line.split('#', 1)[0].strip()
+        if video_id:
+            yield video_id
+
+
+def extract_filename(out_dir, video_id, suffix=None):
+    return os.path.join(out_dir, video_id + (suffix or app.config['EXTRACT_SUFFIX']))
+
+
+def has_extract(out_dir, video_id):
+    """Whether the video has an extract in out_dir, in any format."""
+    return any(os.path.exists(extract_filename(out_dir, video_id, suffix))
+               for suffix in extractfile.SUFFIXES)
+
+
+def failed_video_ids(out_dir):
+    """Returns the ids of the videos which failed in earlier runs."""
+    try:
+        with open(os.path.join(out_dir, FAILURES_FILE)) as fin:
+            return set(json.loads(line)['video_id'] for line in fin if line.strip())
+    except FileNotFoundError:
+        return set()
+
+
+def pending_video_ids(video_ids, out_dir, retry_failed=False):
+    """Returns the video ids, in order and without duplicates, which have no
+    extract yet. Ids which failed before are skipped unless retry_failed."""
+    skip = set() if retry_failed else failed_video_ids(out_dir)
+    pending, seen = [], set()
+    for video_id in video_ids:
+        if video_id in seen or video_id in skip:
+            continue
+        seen.add(video_id)
+        if not has_extract(out_dir, video_id):
+            pending.append(video_id)
+    return pending
+
+
+def backfill(video_ids, out_dir, jobs=None, retry_failed=False, max_tasks_per_child=100,
+             rate_limit_backend='local'):
+    """Runs the pipeline for each video id which is not done yet in a pool of
+    jobs processes, default one per core, and writes the extracts to out_dir.
+    The rate limits are kept in each process with the 'local' backend, which
+    needs no redis, or shared through 'redis'. The pool is started again
+    after max_tasks_per_child videos per process, to return the memory of
+    the processes, and whenever one of its processes dies.
+
+    Returns a tuple of the counts of videos done and failed."""
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = jobs or os.cpu_count()
+    pending = pending_video_ids(video_ids, out_dir, retry_failed)
+    logging.info('Backfilling %d videos into %s with %d processes', len(pending), out_dir, jobs)
+    if not pending:
+        return 0, 0
+
+    _configure_for_pool(jobs, rate_limit_backend)
+    _preload_models()
+
+    done, failed = 0, 0
+    progress = Progress(len(pending))
+    todo = collections.deque(pending)
+    with open(os.path.join(out_dir, FAILURES_FILE), 'a') as failures:
+        while todo:
+            for video_id, err in _run_in_pool(todo, out_dir, jobs, jobs * max_tasks_per_child):
+                if err is None:
+                    done += 1
+                else:
+                    failed += 1
+                    failures.write(json.dumps({'video_id': video_id, 'err': err}) + '\n')
+                    failures.flush()
+                progress.update(done + failed, failed)
+
+    progress.report(done + failed, failed)
+    return done, failed
+
+
+def _run_in_pool(todo, out_dir, jobs, max_tasks):
+    """Runs at most max_tasks of the videos in todo, a deque which is
+    consumed, in a new pool of jobs processes. Yields the video id and the
+    error, or None, of each. When a process of the pool dies the pool is
+    broken, the videos running in it fail and the rest are left in todo."""
+    pool = cf.ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork'))
+    running, submitted, broken = {}, 0, False
+    try:
+        while True:
+            while todo and not broken and submitted < max_tasks and len(running) < 2 * jobs:
+                video_id = todo.popleft()
+                try:
+                    running[pool.submit(_run_one, (video_id, out_dir))] = video_id
+                except BrokenProcessPool:
+                    todo.appendleft(video_id)
+                    broken = True
+                submitted += 1
+            if not running:
+                return
+
+            finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in finished:
+                video_id = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    logging.warn('Backfill process died running %s: %s', video_id, e)
+                    yield video_id, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        pool.shutdown()
+
+
+class Progress(object):
+    """Logs the throughput and the estimated time remaining of a backfill at
+    most every PROGRESS_SECS."""
+    def __init__(self, total):
+        self.total = total
+        self.start = self.last = time.time()
+
+    def update(self, finished, failed):
+        if time.time() - self.last >= PROGRESS_SECS or finished == self.total:
+            self.report(finished, failed)
+
+    def report(self, finished, failed):
+        self.last = time.time()
+        elapsed = self.last - self.start
+        rate = finished / elapsed if elapsed else 0.0
+        eta = (self.total - finished) / rate if rate else float('inf')
+        logging.info('%d/%d videos (%d failed), %.2f videos/sec, ETA %s',
+                     finished, self.total, failed, rate, _format_secs(eta))
+
+
+def _configure_for_pool(jobs, rate_limit_backend):
+    """Without redis the rate limits are kept per process, so each process
+    gets its share of the limit of each host."""
+    app.config['RATE_LIMIT_BACKEND'] = rate_limit_backend
+    if rate_limit_backend != 'local':
+        return
+    app.config['RATE_LIMITS'] = dict(
+        (host, (rate / jobs, max(1, burst // jobs)))
+        for (host, (rate, burst)) in app.config.get('RATE_LIMITS', {}).items())
+
+
+def _preload_models():
+    """Loads the models before forking, so the processes share them."""
+    lib.get_nlp()
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def _run_one(args):
+    """Runs the pipeline for one video in a pool process, returns the video
+    id and the error if it failed."""
+    video_id, out_dir = args
+    try:
+        extract = session.run_pipeline(video_id, save_as_json=False)
+        extractfile.save_extract(extract, extract_filename(out_dir, video_id))
+    except Exception as e:
+        logging.exception('Failed to backfill %s', video_id)
+        return video_id, '{}: {}'.format(type(e).__name__, e)
+    return video_id, None
+
+
+def _format_secs(secs):
+    if secs == float('inf'):
+        return '-'
+    mins, secs = divmod(int(secs), 60)
+    hours, mins = divmod(mins, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, mins, secs)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    done, failed = backfill(video_ids_from_lines(sys.stdin), sys.argv[1])
+    sys.exit(1 if failed else 0)
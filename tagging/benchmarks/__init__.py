@@ -0,0 +1,6 @@
+"""
+benchmarks
+
+benchmarks for the tagging pipeline, run from the tagging directory as
+`python -m benchmarks.<name>`
+"""
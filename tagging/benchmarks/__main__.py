@@ -0,0 +1,91 @@
+"""
+benchmarks for each stage of the tagging pipeline, run offline from recorded
+http responses.
+
+Usage:
+    python -m benchmarks [--stage NAME ...] [--repeat N] [--save-baseline]
+    python -m benchmarks --record    # record the http responses once, online
+
+The recordings go in benchmarks/cassettes and the baseline in
+benchmarks/baseline.json, record them once with --record --save-baseline
+where wikipedia and the spacy model are reachable and commit them. The
+baseline keeps the latency and a digest of the output of each stage. The run
+fails when a stage needs a response which was not recorded, when there is no
+baseline to compare with, when the output of a stage differs from its
+baseline or when a stage is slower than its baseline by more than the
+tolerance.
+"""
+import argparse
+import os
+from os import path
+import sys
+
+os.environ.setdefault('TIMELINES_CONFIG', 'app.config_dev')
+
+from app import app
+from benchmarks import harness
+from benchmarks.httpreplay import HttpReplay
+from benchmarks.stages import STAGES, load_fixtures
+
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+CASSETTE_DIR = path.join(BENCH_DIR, 'cassettes')
+BASELINE_FILE = path.join(BENCH_DIR, 'baseline.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stage', action='append', choices=[s.name for s in STAGES],
+                        help='stages to run, all by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--record', action='store_true',
+                        help='fetch over the network and record the responses')
+    parser.add_argument('--cassettes', default=CASSETTE_DIR)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown of the median against the baseline reported as a regression')
+    args = parser.parse_args()
+
+    # pages must come over http to be replayed rather than from the article store
+    app.config['ARTICLE_FETCH_STRATEGY'] = 'url'
+    # replayed requests are not rate limited, recording is limited in process
+    app.config['RATE_LIMIT_BACKEND'] = 'local'
+    if not args.record:
+        app.config['RATE_LIMITS'] = {}
+    stages = [s for s in STAGES if not args.stage or s.name in args.stage]
+    fixtures = load_fixtures()
+    repeat = 1 if args.record else args.repeat
+
+    with HttpReplay(args.cassettes, 'record' if args.record else 'replay'):
+        results = [harness.run_stage(stage, fixtures, repeat) for stage in stages]
+
+    baseline = harness.load_baseline(args.baseline)
+    regressed = harness.report(results, baseline, args.tolerance)
+    changed = harness.changed_outputs(results, baseline)
+    if args.save_baseline:
+        harness.save_baseline(args.baseline, results)
+
+    failed = False
+    missing = harness.missing_recordings(results)
+    if missing and not args.record:
+        print('Not recorded: {}, record them with --record and commit {}'.format(
+            ', '.join(missing), args.cassettes))
+        failed = True
+    if not baseline and not args.save_baseline:
+        print('No baseline in {}, save one with --save-baseline and commit it'.format(
+            args.baseline))
+        failed = True
+    if changed and not args.save_baseline:
+        print('Output changed: {}'.format(', '.join(changed)))
+        failed = True
+    if regressed:
+        print('Regressed: {}'.format(', '.join(regressed)))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
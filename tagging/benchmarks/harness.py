@@ -0,0 +1,141 @@
+"""
+harness.py
+
+times benchmark stages and compares the results against a stored baseline
+"""
+import collections
+import hashlib
+import json
+import math
+import time
+
+from benchmarks.httpreplay import MissingRecording
+
+
+# setup(fixture) returns the state for one run and is not timed, or None when
+# the stage does not apply to the fixture
+# run(state) is the timed work, count(state) the number of items it processed
+# output(result) is the part of what run returned which is compared with the
+#                baseline, json serializable, or None for a stage whose output
+#                is not checked
+Stage = collections.namedtuple('Stage', 'name setup run count output')
+StageResult = collections.namedtuple('StageResult',
+                                     'name runs items p50 p90 p99 throughput digest skipped')
+# reason a stage is skipped for a request which was never recorded
+MISSING_RECORDING = 'missing recording'
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest rank percentile of a sorted list."""
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def run_stage(stage, fixtures, repeat=5):
+    """Runs a stage repeat times over each fixture and returns a StageResult
+    with latency percentiles in milliseconds, throughput in items/sec and
+    the digest of the output of the stage over the fixtures.
+
+    A stage is skipped when a recording needed to replay it is missing, any
+    other failure is raised."""
+    timings, items, total_secs, outputs = [], 0, 0.0, []
+    for fixture in fixtures:
+        for i in range(repeat):
+            try:
+                state = stage.setup(fixture)
+                if state is None:
+                    break
+                start = time.perf_counter()
+                result = stage.run(state)
+                elapsed = time.perf_counter() - start
+            except MissingRecording as e:
+                skipped = '{}: {}'.format(MISSING_RECORDING, e)
+                return StageResult(stage.name, 0, 0, None, None, None, None, None, skipped)
+            if i == 0 and stage.output:
+                outputs.append([fixture['name'], stage.output(result)])
+            timings.append(elapsed * 1000)
+            total_secs += elapsed
+            items += stage.count(state)
+
+    if not timings:
+        return StageResult(stage.name, 0, 0, None, None, None, None, None, 'no fixtures')
+
+    timings.sort()
+    return StageResult(name=stage.name,
+                       runs=len(timings),
+                       items=items,
+                       p50=percentile(timings, 50),
+                       p90=percentile(timings, 90),
+                       p99=percentile(timings, 99),
+                       throughput=items / total_secs if total_secs else float('inf'),
+                       digest=digest(outputs) if stage.output else None,
+                       skipped=None)
+
+
+def digest(outputs):
+    """Returns the sha1 of the json of the outputs of a stage."""
+    body = json.dumps(outputs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def missing_recordings(results):
+    """Returns the names of the stages skipped for a missing recording."""
+    return [r.name for r in results if r.skipped and r.skipped.startswith(MISSING_RECORDING)]
+
+
+def load_baseline(filename):
+    try:
+        with open(filename) as fin:
+            return json.load(fin)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(filename, results):
+    baseline = dict((r.name, {'p50': r.p50, 'p90': r.p90, 'throughput': r.throughput,
+                              'digest': r.digest})
+                    for r in results if not r.skipped)
+    with open(filename, 'w') as fout:
+        json.dump(baseline, fout, indent=2, sort_keys=True)
+
+
+def changed_outputs(results, baseline):
+    """Returns the names of the stages whose output differs from the one in
+    the baseline."""
+    return [r.name for r in results
+            if r.digest and baseline.get(r.name, {}).get('digest') not in (None, r.digest)]
+
+
+def report(results, baseline, tolerance=0.2):
+    """Prints a table of the results, comparing the median latency and the
+    output of each stage to the baseline. Returns the names of the stages
+    which regressed by more than the tolerance."""
+    regressed = []
+    changed = changed_outputs(results, baseline)
+    print('{:22s} {:>5s} {:>7s} {:>10s} {:>10s} {:>10s} {:>12s} {:>9s} {:>8s}'.format(
+        'stage', 'runs', 'items', 'p50 ms', 'p90 ms', 'p99 ms', 'items/s', 'vs base', 'output'))
+    for r in results:
+        if r.skipped:
+            print('{:22s} skipped ({})'.format(r.name, r.skipped))
+            continue
+
+        base = baseline.get(r.name)
+        if base and base.get('p50'):
+            ratio = r.p50 / base['p50']
+            change = '{:+.0%}'.format(ratio - 1)
+            if ratio > 1 + tolerance:
+                regressed.append(r.name)
+                change += ' !'
+        else:
+            change = '-'
+        if r.name in changed:
+            output = 'changed'
+        elif r.digest and base and base.get('digest'):
+            output = 'same'
+        else:
+            output = '-'
+        print('{:22s} {:5d} {:7d} {:10.2f} {:10.2f} {:10.2f} {:12.1f} {:>9s} {:>8s}'.format(
+            r.name, r.runs, r.items, r.p50, r.p90, r.p99, r.throughput, change, output))
+    return regressed
@@ -0,0 +1,95 @@
+"""
+httpreplay.py
+
+records http responses made through requests to a cassette directory and
+replays them, so the benchmarks run without a network
+"""
+import base64
+import gzip
+import hashlib
+import json
+import os
+from os import path
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class MissingRecording(Exception):
+    """Raised when replaying a request which was never recorded."""
+
+
+class HttpReplay(object):
+    """Context manager which intercepts every request sent through requests.
+
+    In 'replay' mode responses are read from the cassette directory and a
+    request which was not recorded raises MissingRecording. In 'record' mode
+    requests go to the network and their responses are saved.
+    """
+    def __init__(self, cassette_dir, mode='replay'):
+        if mode not in ('replay', 'record'):
+            raise ValueError('Don\'t understand replay mode %s' % (mode))
+        self.cassette_dir = cassette_dir
+        self.mode = mode
+        self.hits = self.misses = 0
+
+    def __enter__(self):
+        self._send = HTTPAdapter.send
+        replay = self
+
+        def send(adapter, request, **kwargs):
+            return replay.send(adapter, request, **kwargs)
+
+        HTTPAdapter.send = send
+        return self
+
+    def __exit__(self, *exc):
+        HTTPAdapter.send = self._send
+
+    def send(self, adapter, request, **kwargs):
+        filename = self._path(request)
+        if self.mode == 'replay':
+            if not path.exists(filename):
+                self.misses += 1
+                raise MissingRecording('{} {}'.format(request.method, request.url))
+            self.hits += 1
+            with gzip.open(filename, 'rt', encoding='utf-8') as fin:
+                return _response_from_record(json.load(fin), request)
+
+        resp = self._send(adapter, request, **kwargs)
+        os.makedirs(self.cassette_dir, exist_ok=True)
+        with gzip.open(filename, 'wt', encoding='utf-8') as fout:
+            json.dump(_record_from_response(resp), fout)
+        return resp
+
+    def _path(self, request):
+        key = hashlib.sha1()
+        key.update(request.method.encode('utf-8'))
+        key.update(request.url.encode('utf-8'))
+        body = request.body or b''
+        key.update(body if isinstance(body, bytes) else body.encode('utf-8'))
+        return path.join(self.cassette_dir, key.hexdigest() + '.json.gz')
+
+
+def _record_from_response(resp):
+    return {
+        'url': resp.url,
+        'status_code': resp.status_code,
+        'reason': resp.reason,
+        'headers': dict(resp.headers),
+        'encoding': resp.encoding,
+        'content': base64.b64encode(resp.content).decode('ascii'),
+    }
+
+
+def _response_from_record(record, request):
+    resp = requests.Response()
+    resp.url = record['url']
+    resp.status_code = record['status_code']
+    resp.reason = record['reason']
+    resp.headers = CaseInsensitiveDict(record['headers'])
+    resp.encoding = record['encoding']
+    resp._content = base64.b64decode(record['content'])
+    resp.request = request
+    return resp
@@ -0,0 +1,250 @@
+"""
+stages.py
+
+fixtures and the benchmark stages of the tagging pipeline
+"""
+import copy
+import glob
+import json
+from os import path
+import re
+import subprocess
+import sys
+from xml.sax.saxutils import escape
+
+from app import lib
+from app.lib import compact, resultcache, timeml
+from app.tasks import captions, wikitext
+from benchmarks.harness import Stage
+
+
+TAGGING_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+DATA_DIR = path.join(TAGGING_DIR, 'data')
+WORDS_PER_CAPTION = 6
+WORD_MATCH = re.compile('\s*\S+\s*')
+# characters of captions parsed at once by the segmented nlp stage
+SEGMENT_CHARS = 2000
+
+
+def load_fixtures(data_dir=DATA_DIR):
+    """Loads the benchmark fixtures from the data directory: each non-empty
+    match-*.json extract and the syrias war transcript with its TimeML.
+
+    Each fixture is a dict with a name, the timedtext captions_xml, the
+    heidel_sents and, for the extracts, the extract itself."""
+    fixtures = []
+    for filename in sorted(glob.glob(path.join(data_dir, 'match-*.json'))):
+        with open(filename, encoding='utf-8') as fin:
+            extract = json.load(fin)
+        if not extract['events']:
+            continue
+        cap = extract['captions']
+        fixtures.append({
+            'name': path.basename(filename),
+            'captions_xml': captions_xml_from_sents(cap['sents'], cap['timestamps']),
+            'heidel_sents': extract['heidel']['sents'],
+            'extract': extract,
+        })
+
+    with open(path.join(data_dir, 'syrias war.txt'), encoding='utf-8') as fin:
+        text = fin.read()
+    with open(path.join(data_dir, 'syrias war.hd.timeml'), encoding='utf-8') as fin:
+        body = timeml.body_from_timeml(fin.read())
+    fixtures.append({
+        'name': 'syrias war',
+        'captions_xml': captions_xml_from_sents([text.strip()], ['0.0']),
+        'heidel_sents': [sent for sent in body.split('\n') if len(sent)],
+        'extract': None,
+    })
+    return fixtures
+
+
+def captions_xml_from_sents(sents, timestamps):
+    """Builds timedtext XML from sentences, splitting each sentence into
+    captions of a few words with start times spread over the sentence. The
+    captions keep the spacing of the sentence so they align with it."""
+    times = [float(ts) for ts in timestamps]
+    texts = []
+    for i, sent in enumerate(sents):
+        words = WORD_MATCH.findall(sent)
+        chunks = [''.join(words[j:j+WORDS_PER_CAPTION])
+                  for j in range(0, len(words), WORDS_PER_CAPTION)]
+        dur = (times[i+1] - times[i]) if i+1 < len(times) else 2.0
+        for k, chunk in enumerate(chunks):
+            start = times[i] + dur * k / len(chunks)
+            texts.append('<text start="{:.3f}" dur="{:.3f}">{}</text>'.format(
+                start, dur / len(chunks), escape(chunk)))
+    return '<transcript>{}</transcript>'.format(''.join(texts))
+
+
+def _events_copy(fixture, *drop):
+    """Returns a copy of the extract of a fixture with the keys in drop
+    removed from every event and candidate."""
+    extract = fixture['extract']
+    if extract is None:
+        return None
+
+    events = copy.deepcopy(extract['events'])
+    for sent in events:
+        for event in sent:
+            for key in drop:
+                event.pop(key, None)
+                for blob in event.get('wiki', []):
+                    blob.pop(key, None)
+    copied = dict(extract)
+    copied['events'] = events
+    return copied
+
+
+def _events(video_extract):
+    return video_extract['events']
+
+
+def _match_idxs(video_extract):
+    """Returns the idx of the candidate matched by each event, or None."""
+    return [[(e.get('match') or {}).get('idx') for e in sent] for sent in video_extract['events']]
+
+
+def _num_events(video_extract):
+    return sum(len(sent) for sent in video_extract['events'])
+
+
+def _num_candidates(video_extract):
+    return sum(len(e.get('wiki', [])) for sent in video_extract['events'] for e in sent)
+
+
+def _caption_state(fixture):
+    blobs, times = captions.text_blobs_from_captions(fixture['captions_xml'])
+    return {'xml': fixture['captions_xml'], 'blobs': blobs, 'times': times}
+
+
+def _alignment_state(fixture):
+    if fixture['extract'] is None:
+        return None
+    state = _caption_state(fixture)
+    state['sents'] = fixture['extract']['captions']['sents']
+    return state
+
+
+def _event_dates_state(fixture):
+    extract = fixture['extract']
+    if extract is None:
+        return None
+    return {
+        'video_id': extract['video_id'],
+        'captions': dict(extract['captions']),
+        'heidel': dict(extract['heidel']),
+    }
+
+
+def _matched_events_copy(fixture):
+    extract = _events_copy(fixture, 'wptopics')
+    if extract and any(e.get('match') for s in extract['events'] for e in s):
+        return extract
+    return None
+
+
+def _startup_state(fixture):
+    # startup does not depend on the fixtures, time it once per repeat
+    return {} if fixture['name'] == 'syrias war' else None
+
+
+def _time_import(code):
+    """Runs code in a fresh interpreter, as a process starting up would."""
+    subprocess.run([sys.executable, '-c', code], cwd=TAGGING_DIR, check=True)
+
+
+def _extract(fixture):
+    return fixture['extract']
+
+
+STAGES = [
+    Stage('startup_web',
+          setup=_startup_state,
+          run=lambda s: _time_import('import app'),
+          count=lambda s: 1,
+          output=None),
+    Stage('startup_worker',
+          setup=_startup_state,
+          run=lambda s: _time_import('import app.tasks.captions, app.tasks.wikitext; '
+                                     'from app import lib; lib.get_nlp()'),
+          count=lambda s: 1,
+          output=None),
+    Stage('caption_parse',
+          setup=_caption_state,
+          run=lambda s: captions.text_blobs_from_captions(s['xml']),
+          count=lambda s: len(s['blobs']),
+          output=list),
+    Stage('nlp',
+          setup=_caption_state,
+          run=lambda s: list(lib.nlp_over_lines_as_blob(s['blobs'], lib.entities_from_span,
+                                                        lib.str_from_span)),
+          count=lambda s: len(s['blobs']),
+          output=list),
+    Stage('nlp_segmented',
+          setup=_caption_state,
+          run=lambda s: [captions.sentences_from_captions(blobs, times) for (blobs, times)
+                         in captions.caption_segments(s['blobs'], s['times'], SEGMENT_CHARS)],
+          count=lambda s: len(s['blobs']),
+          output=list),
+    Stage('timestamp_alignment',
+          setup=_alignment_state,
+          run=lambda s: captions.assign_timestamp_to_sentences(s['blobs'], s['times'], s['sents']),
+          count=lambda s: len(s['sents']),
+          output=list),
+    Stage('timeml_parse',
+          setup=lambda f: f['heidel_sents'],
+          run=timeml.timexes_by_sentence,
+          count=len,
+          output=list),
+    Stage('event_dates',
+          setup=_event_dates_state,
+          run=captions.event_dates_from_timeml_annotated_captions,
+          count=lambda s: len(s['heidel']['sents']),
+          output=_events),
+    Stage('candidate_fetch',
+          setup=lambda f: _events_copy(f, 'wiki', 'match', 'scores'),
+          run=wikitext.wikipedia_events_from_dates,
+          count=_num_events,
+          output=_events),
+    Stage('ner',
+          setup=lambda f: _events_copy(f, 'ents', 'match', 'scores'),
+          run=wikitext.event_entities_from_wikitext,
+          count=_num_candidates,
+          output=_events),
+    Stage('matching',
+          setup=lambda f: _events_copy(f, 'match', 'scores'),
+          run=wikitext.match_event_via_entities,
+          count=_num_candidates,
+          output=_match_idxs),
+    Stage('vector_matching',
+          setup=lambda f: _events_copy(f, 'match', 'scores'),
+          run=lambda e: wikitext.match_event_via_vector_sim(e, 'vectors'),
+          count=_num_candidates,
+          output=_match_idxs),
+    Stage('link_resolution',
+          setup=_matched_events_copy,
+          run=wikitext.resolve_match_link_topics,
+          count=_num_events,
+          output=_events),
+    Stage('extract_json',
+          setup=_extract,
+          run=lambda e: json.loads(json.dumps(e)),
+          count=_num_events,
+          output=_events),
+    Stage('extract_compact',
+          setup=_extract,
+          run=lambda e: compact.unpack(compact.loads(compact.dumps(compact.pack(e)))),
+          count=_num_events,
+          output=_events),
+    Stage('result_gzip',
+          setup=lambda f: json.dumps(f['extract']).encode('utf-8'),
+          run=lambda body: resultcache.encode(body, 'gzip'),
+          count=lambda body: 1,
+          output=None),
+    Stage('result_brotli',
+          setup=lambda f: json.dumps(f['extract']).encode('utf-8'),
+          run=lambda body: resultcache.encode(body, 'br'),
+          count=lambda body: 1,
+          output=None),
+]
@@ -0,0 +1,76 @@
+"""
+timeml.py
+
+benchmarks the single pass TimeML parser against the per-sentence regex and
+ElementTree approach it replaced.
+
+Usage:
+    python -m benchmarks.timeml [--repeat N] [--scale N]
+"""
+import argparse
+import os
+import re
+import timeit
+from xml.etree import ElementTree as ET
+
+from app.lib import timeml
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+TIMEML_FIXTURE = os.path.join(DATA_DIR, 'syrias war.hd.timeml')
+TIMX_MATCH = re.compile("<TIMEX3[^>]*>[^<]*</TIMEX3>")
+
+
+def legacy_events(sents):
+    """Extracts (text, value) for DATE timexes the way the captions task did,
+    running a regex over each sentence and parsing each tag with ElementTree."""
+    events, malformed = [], 0
+    for ann in sents:
+        ann_events = []
+        for match in TIMX_MATCH.finditer(ann):
+            try:
+                tag = ET.fromstring(match.group(0))
+            except ET.ParseError:
+                malformed += 1
+                continue
+            if tag.attrib.get('type') == 'DATE' and tag.text and tag.attrib.get('value'):
+                ann_events.append((tag.text, tag.attrib['value']))
+        events.append(ann_events)
+    return events, malformed
+
+
+def single_pass_events(sents):
+    """Extracts (text, value) for DATE timexes with the single pass parser."""
+    return [[(t.text, t.value) for t in timexes if t.type == 'DATE' and t.text and t.value]
+            for timexes in timeml.timexes_by_sentence(sents)]
+
+
+def load_sents(path, scale=1):
+    """Loads the annotated sentences from a HeidelTime output file, repeating
+    them scale times to simulate a longer transcript."""
+    with open(path, encoding='utf-8') as fin:
+        body = timeml.body_from_timeml(fin.read())
+    sents = [sent for sent in body.split('\n') if len(sent)]
+    return sents * scale
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--scale', type=int, default=1)
+    args = parser.parse_args()
+
+    sents = load_sents(TIMEML_FIXTURE, args.scale)
+    legacy, malformed = legacy_events(sents)
+    if legacy != single_pass_events(sents):
+        raise SystemExit('Parsers disagree on {}'.format(TIMEML_FIXTURE))
+
+    print('{} sentences, {} date timexes, {} malformed tags'.format(
+        len(sents), sum(len(e) for e in legacy), malformed))
+    for name, func in [('legacy', legacy_events), ('single_pass', single_pass_events)]:
+        secs = min(timeit.repeat(lambda: func(sents), number=args.repeat, repeat=3))
+        print('{:12s} {:8.1f} us/run'.format(name, secs / args.repeat * 1e6))
+
+
+if __name__ == '__main__':
+    main()
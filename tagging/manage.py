@@ -27,6 +27,108 @@ def dropdb():
         print(colored('The SQL database has been deleted', 'green'))
 
 
+@manager.option('-i', '--input', dest='input_file', default='-',
+                help='file of video ids, one per line, or - for stdin')
+@manager.option('-o', '--out-dir', dest='out_dir', default='data/backfill',
+                help='directory the extracts are written to')
+@manager.option('-j', '--jobs', dest='jobs', type=int, default=None,
+                help='number of processes, defaults to the number of cores')
+@manager.option('--retry-failed', dest='retry_failed', action='store_true',
+                help='run the videos which failed in earlier runs again')
+@manager.option('--rate-limit-backend', dest='rate_limit_backend', default='local',
+                choices=['local', 'redis'], help='where the rate limits are kept')
+def backfill(input_file, out_dir, jobs, retry_failed, rate_limit_backend):
+    ''' Run the pipeline over a list of videos, resuming where it stopped. '''
+    import logging
+    import sys
+    import backfill as bf
+    logging.getLogger().setLevel(logging.INFO)
+
+    fin = sys.stdin if input_file == '-' else open(input_file)
+    with fin:
+        video_ids = list(bf.video_ids_from_lines(fin))
+    done, failed = bf.backfill(video_ids, out_dir, jobs, retry_failed,
+                               rate_limit_backend=rate_limit_backend)
+    print(colored('Backfilled {} videos, {} failed'.format(done, failed),
+                  'red' if failed else 'green'))
+
+
+@manager.option('--first-year', dest='first_year', type=int, default=1)
+@manager.option('--last-year', dest='last_year', type=int, default=None)
+@manager.option('--nlist', dest='nlist', type=int, default=None,
+                help='number of clusters, defaults to 4 * sqrt(number of events)')
+def build_event_index(first_year, last_year, nlist):
+    ''' Build the nearest neighbour index over the wikipedia year page events. '''
+    import datetime
+    import logging
+    from app.lib import annindex
+    from app.tasks import wikitext
+    logging.getLogger().setLevel(logging.INFO)
+
+    last_year = last_year or datetime.date.today().year
+    path = os.path.join(os.path.dirname(app.root_path), app.config['EVENT_INDEX_PATH'])
+    count = annindex.build_index(path, wikitext.year_page_events(range(first_year, last_year + 1)),
+                                 nlist=nlist)
+    print(colored('Indexed {} events into {}'.format(count, path), 'green'))
+
+
+@manager.option('extracts', nargs='*', help='extract files, defaults to every stored extract')
+@manager.option('--item', dest='item_thresholds', action='append',
+                help='item match thresholds, comma separated or repeated')
+@manager.option('--window', dest='window_thresholds', action='append',
+                help='window match thresholds, comma separated or repeated')
+@manager.option('--blacklist', dest='blacklists', action='append',
+                help='entity types not compared, comma separated, repeated for each blacklist')
+@manager.option('-o', '--out-dir', dest='out_dir', default=None,
+                help='write the rematched extracts here, with a single set of params')
+@manager.option('-j', '--jobs', dest='jobs', type=int, default=None,
+                help='number of processes, defaults to the number of cores')
+def rematch(extracts, item_thresholds, window_thresholds, blacklists, out_dir, jobs):
+    ''' Match stored extracts again with each combination of match params. '''
+    import logging
+    import rematch as rm
+    logging.getLogger().setLevel(logging.INFO)
+
+    filenames = extracts or rm.stored_filenames()
+    params_list = rm.params_from_options(item_thresholds, window_thresholds, blacklists)
+    if out_dir:
+        if len(params_list) != 1:
+            print(colored('Give a single set of params to write rematched extracts', 'red'))
+            return 1
+        written = rm.write_rematched(filenames, params_list[0], out_dir, jobs)
+        print(colored('Rematched {} extracts into {}'.format(len(written), out_dir), 'green'))
+        return 0
+
+    totals, _ = rm.rematch_corpus(filenames, params_list, jobs)
+    print('Rematched {} extracts with {} sets of params'.format(len(filenames), len(params_list)))
+    for line in rm.format_stats(params_list, totals):
+        print(line)
+
+
+@manager.option('trace_id', help='id of the trace, as returned when the video was enqueued')
+@manager.option('-f', '--file', dest='filename', default=None,
+                help='file of spans, defaults to TRACE_FILE')
+def trace(trace_id, filename):
+    ''' Show the critical path of a traced run and where its time went. '''
+    from app import tracing
+
+    spans = tracing.read_spans(filename or tracing.trace_filename(), trace_id)
+    if not spans:
+        print(colored('No spans of trace {}'.format(trace_id), 'red'))
+        return 1
+    start = min(s['timestamp'] for s in spans)
+    print('Critical path of trace {}:'.format(trace_id))
+    for s in tracing.critical_path(spans):
+        print('{:>9.3f}s {:>9.3f}s  {} {}'.format(
+            (s['timestamp'] - start) / 1e6, s['duration'] / 1e6, s['name'],
+            s.get('tags', {}).get('http.host', '')))
+    for title, totals in [('span', tracing.time_by(spans, lambda s: s['name'])),
+                          ('http host', tracing.time_by(spans, tracing.tag_of('http.host')))]:
+        print('Seconds by {}:'.format(title))
+        for value, secs in totals.most_common():
+            print('{:>10.3f}  {}'.format(secs, value))
+
+
 manager.add_command('runserver', Server(port=os.environ.get('PORT')))
 manager.add_command('shell', Shell(make_context=make_shell_context))
 
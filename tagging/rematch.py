@@ -0,0 +1,106 @@
+"""
+rematch.py
+
+matches stored extracts again with other match parameters, from the entities
+saved in them, so the thresholds and the entity blacklist can be tuned
+without fetching captions, running HeidelTime, scraping or NER again. Many
+parameter sets are evaluated over a corpus in one pass in a pool of
+processes, and with a single set the re-matched extracts, after the stages
+which follow matching, can be written out.
+
+Parameters are evaluated over the events of an extract a sentence at a
+time, NDJSON extracts are never loaded whole. Writing re-matched extracts
+loads each of them.
+"""
+import logging
+import multiprocessing
+import os
+
+from app import app
+from app.lib import extractfile
+from app.lib import matchparams as mp
+from app.tasks import wikitext
+
+
+# options of the run which saved an extract, the stages run again over it
+# must not skip past its deadline, profile it or trace into its trace
+RUN_OPTIONS = ('budget', 'deadline', 'profile', 'trace_memory', 'trace')
+
+
+def rematch_corpus(filenames, params_list, jobs=None):
+    """Evaluates each MatchParams of params_list over the extracts in
+    filenames in a pool of jobs processes, default one per core. Returns the
+    stats summed over the corpus, see wikitext.rematch_stats, and a dict of
+    filename to the stats of the extract."""
+    with _pool(jobs) as pool:
+        per_file = dict(pool.imap_unordered(_stats_of_file, [(f, params_list) for f in filenames]))
+    return wikitext.merge_stats(per_file[f] for f in filenames), per_file
+
+
+def write_rematched(filenames, params, out_dir, jobs=None):
+    """Matches the extracts in filenames with params, resolves the topics of
+    the new matches and writes them to out_dir. Returns the filenames
+    written."""
+    os.makedirs(out_dir, exist_ok=True)
+    with _pool(jobs) as pool:
+        return list(pool.imap_unordered(_rematch_file, [(f, params, out_dir) for f in filenames]))
+
+
+def _pool(jobs):
+    return multiprocessing.get_context('fork').Pool(jobs or os.cpu_count())
+
+
+def _stats_of_file(args):
+    filename, params_list = args
+    _, events = extractfile.iter_extract(filename)
+    return filename, wikitext.rematch_stats(events, params_list)
+
+
+def _rematch_file(args):
+    # the topics of the new matches are resolved over the whole extract, which
+    # is loaded
+    filename, params, out_dir = args
+    extract = without_run_options(extractfile.load_extract(filename))
+    extract = wikitext.match_event_via_entities(extract, params._asdict())
+    if app.config['MATCH_STRATEGY'] == 'blend':
+        extract = wikitext.match_event_via_vector_sim(extract, 'blend')
+    extract = wikitext.resolve_match_link_topics(extract)
+    out_file = os.path.join(out_dir, extract['video_id'] + app.config['EXTRACT_SUFFIX'])
+    logging.info('Rematched %s into %s', filename, out_file)
+    return extractfile.save_extract(extract, out_file)
+
+
+def without_run_options(extract):
+    """Returns the extract with the RUN_OPTIONS removed from its meta."""
+    meta = extract.get('meta')
+    if meta:
+        extract['meta'] = dict((k, v) for (k, v) in meta.items() if k not in RUN_OPTIONS)
+    return extract
+
+
+def format_stats(params_list, totals):
+    """Returns the totals of each params as the lines of a table."""
+    lines = ['{:>6} {:>6} {:>8} {:>6} {:>8} {:>8}  {}'.format(
+        'item', 'window', 'matched', 'added', 'removed', 'changed', 'blacklist')]
+    row = '{:>6.3f} {:>6.3f} {matched:>8d} {added:>6d} {removed:>8d} {changed:>8d}  {}'
+    for params, counts in zip(params_list, totals):
+        lines.append(row.format(params.item_threshold, params.window_threshold,
+                                ','.join(params.entity_blacklist), **counts))
+    return lines
+
+
+def stored_filenames():
+    """Returns the newest stored extract of each video."""
+    return [extractfile.stored_filename(v) for v in extractfile.stored_video_ids()]
+
+
+def split_values(values, convert=str):
+    """Returns the values of comma separated options, e.g. ['0.2,0.25']."""
+    return [convert(v) for value in values or [] for v in value.split(',') if v]
+
+
+def params_from_options(item_thresholds, window_thresholds, blacklists):
+    """Returns the grid of MatchParams of the command line options."""
+    return mp.param_grid(split_values(item_thresholds, float),
+                         split_values(window_thresholds, float),
+                         [split_values([b]) for b in blacklists or []])
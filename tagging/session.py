@@ -1,7 +1,8 @@
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
-from app import lib
+from app import app, profiling, tracing
+from app.lib import extractfile
 from app.tasks import captions
 from app.tasks import wikitext
 from importlib import reload
@@ -16,25 +17,53 @@ def run_annotations(video_id):
     return annotations
 
 
-def run_pipeline(video_id, save_as_json=True):
-    """Runs the pipeline for a video id."""
-    caps = captions.youtube_captions_from_video(video_id)
-    annotations = captions.annotate_events_in_captions(caps, video_id)
+def run_pipeline(video_id, save_as_json=True, profile=False, budget_secs=None, trace_memory=False):
+    """Runs the pipeline for a video id. With profile each stage is sampled
+    and the collapsed stacks are saved next to the extract. With trace_memory
+    the peak memory of each stage is kept in the meta of the extract. With
+    budget_secs the run has a deadline, as runs enqueued through the API do.
+    The run is traced, its spans exported as configured by TRACE_EXPORT."""
+    meta = {'trace': {'trace_id': tracing.new_trace_id()}}
+    if profile:
+        meta['profile'] = True
+    if trace_memory:
+        meta['trace_memory'] = True
+    if budget_secs:
+        meta['budget'] = budget_secs
+    caps = captions.youtube_captions_from_video(video_id, meta=meta)
+    annotations = captions.annotate_events_in_captions(caps, video_id, meta=meta)
     event_dates = captions.event_dates_from_timeml_annotated_captions(annotations)
     wikipedia_events = wikitext.wikipedia_events_from_dates(event_dates)
+    if app.config['ANN_TOP_K']:
+        wikipedia_events = wikitext.wikipedia_events_from_index(wikipedia_events)
 
-    # matching via entities
-    wikipedia_entities = wikitext.event_entities_from_wikitext(wikipedia_events)
-    matched_events = wikitext.match_event_via_entities(wikipedia_entities)
-    # matching via vector similarity
-    # vector_matches = wikitext.match_event_via_vector_sim(wikipedia_events)
+    strategy = app.config['MATCH_STRATEGY']
+    matched_events = wikipedia_events
+    if strategy in ('entities', 'blend'):
+        # matching via entities
+        wikipedia_entities = wikitext.event_entities_from_wikitext(matched_events)
+        matched_events = wikitext.match_event_via_entities(wikipedia_entities)
+    if strategy in ('vectors', 'blend'):
+        # matching via vector similarity
+        matched_events = wikitext.match_event_via_vector_sim(matched_events, strategy)
 
     linked_topics = wikitext.resolve_match_link_topics(matched_events)
+    for stage, usage in linked_topics.get('meta', {}).get('memory', {}).items():
+        logging.info('Stage %s peaked at %d bytes', stage, usage['peak_bytes'])
 
     if save_as_json:
         video_id = linked_topics['video_id']
-        filename = lib.save_to_tempfile_as_json(linked_topics, prefix='match-{}-'.format(video_id))
-        logging.info('Saved extracted events to %s', filename)
+        filename = extractfile.save_to_tempfile(linked_topics, app.config['EXTRACT_SUFFIX'],
+                                                prefix='match-{}-'.format(video_id))
+        logging.info('Saved extracted events to %s of trace %s', filename,
+                     meta['trace']['trace_id'])
+
+        profiles = linked_topics.get('meta', {}).get('profiles')
+        if profiles:
+            profile_file = extractfile.strip_suffix(filename) + '.profile.collapsed'
+            with open(profile_file, 'w') as fout:
+                fout.write(profiling.collapsed_profiles(profiles))
+            logging.info('Saved profile to %s', profile_file)
 
     return linked_topics
 
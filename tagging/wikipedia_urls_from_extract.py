@@ -1,11 +1,40 @@
-import json
+"""
+wikipedia_urls_from_extract.py
+
+warms the local caches from extracts, or from years and dates: fetches the
+wikipedia articles the extracts refer to, the year and date pages of their
+events and the wikibase ids of their matched links into the article store,
+with a bounded number of requests in flight.
+
+    python wikipedia_urls_from_extract.py extract.json ...
+    python wikipedia_urls_from_extract.py --dates 2011 2012-03 1999-12-31
+    python wikipedia_urls_from_extract.py --print wikidata_extract.json
+"""
+import argparse
+from concurrent import futures
+import logging
+import os
+import re
+import sys
+
+os.environ.setdefault('TIMELINES_CONFIG', 'app.config_dev')
+
+from app import app
+from app.lib import datevalue as dv
+from app.lib import extractfile
+from app.lib import wikipedia as wp
+from app.tasks import wikitext
+
+
+WP_TITLE_MATCH = re.compile('/wiki/(.*)$')
+
 
 def article_url_from_event(event):
     return event.get('article')
 
-def get_wikipedia_urls(extract):
+def get_wikipedia_urls(events):
     urls = []
-    for event in extract['events']:
+    for event in events:
         for candidate in event:
             match = candidate.get('match')
             if not match: continue
@@ -18,7 +47,7 @@ def get_wikipedia_urls(extract):
             for part_of_event in part_of:
                 urls.append(article_url_from_event(part_of_event))
 
-            wptopic_rel = match.get('wptopic_rel', [])
+            wptopic_rel = match.get('wptopic_rel', {})
             part_of_sets = wptopic_rel.get('part_of', [])
             for sib_event_set in part_of_sets:
                 for sib_event in sib_event_set:
@@ -26,10 +55,89 @@ def get_wikipedia_urls(extract):
 
     return urls
 
-if __name__ == '__main__':
-    extract = json.loads(''.join(open('wikidata_extract.json').readlines()))
-    url_set = set(url for url in get_wikipedia_urls(extract) if url)
 
-    for url in url_set:
-        print(url)
+def page_urls_from_dates(values):
+    """Returns the urls of the year and date pages holding the events of the
+    HeidelTime date values."""
+    urls = []
+    for value in values:
+        plan = dv.fetch_plan(value, app.config['WIKI_PLAN_MAX_YEARS'])
+        if plan:
+            urls.extend(wikitext.page_urls_from_plan(plan))
+    return urls
+
 
+def link_titles_from_events(events):
+    """Returns the titles of the wikipedia links of the matched events, whose
+    wikibase ids resolve_match_link_topics looks up."""
+    titles = []
+    for event in events:
+        for candidate in event:
+            match = candidate.get('match')
+            if not match: continue
+            for link in match.get('links', []):
+                title_match = WP_TITLE_MATCH.match(link)
+                if title_match:
+                    titles.append(title_match.group(1))
+    return titles
+
+
+def warm(urls, titles, workers=8):
+    """Fetches the urls and the wikibase ids of the titles into the article
+    store, running up to workers requests at once. Returns the number of
+    urls and titles which failed."""
+    urls = [u for u in dict.fromkeys(urls) if u]
+    titles = list(dict.fromkeys(titles))
+    batches = [titles[i:i+wp.WPQuery.MAX_TITLES]
+               for i in range(0, len(titles), wp.WPQuery.MAX_TITLES)]
+    logging.info('Warming %d pages and %d wikibase ids', len(urls), len(titles))
+
+    failed = 0
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = dict((pool.submit(wp.article_by_url, url, 'cache'), url) for url in urls)
+        jobs.update((pool.submit(wp.wbid_from_titles, *batch), batch) for batch in batches)
+        for i, job in enumerate(futures.as_completed(jobs), 1):
+            if job.exception() is not None:
+                failed += 1
+                logging.warn('Could not warm %s: %s', jobs[job], job.exception())
+            if i % 100 == 0:
+                logging.info('Warmed %d of %d', i, len(jobs))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('extracts', nargs='*',
+                        help='extract files, .json or .ndjson, maybe gzipped')
+    parser.add_argument('--dates', nargs='*', default=[],
+                        help='HeidelTime date values, e.g. 2011, 2011-03 or 2011-03-15')
+    parser.add_argument('--workers', type=int, default=app.config['WIKI_FETCH_WORKERS'],
+                        help='requests in flight at once')
+    parser.add_argument('--print', dest='print_urls', action='store_true',
+                        help='only print the article urls of the extracts')
+    args = parser.parse_args()
+    # wikibase ids are only stored with the cache strategy
+    app.config['ARTICLE_FETCH_STRATEGY'] = 'cache'
+
+    urls, titles, dates = [], [], list(args.dates)
+    for filename in args.extracts:
+        # a sentence at a time, extracts may not fit in memory
+        _, events = extractfile.iter_extract(filename)
+        for sent_events in events:
+            urls.extend(get_wikipedia_urls([sent_events]))
+            titles.extend(link_titles_from_events([sent_events]))
+            dates.extend(e['date'] for e in sent_events if 'date' in e)
+
+    if args.print_urls:
+        for url in dict.fromkeys(u for u in urls if u):
+            print(url)
+        return 0
+
+    urls.extend(page_urls_from_dates(dict.fromkeys(dates)))
+    return 1 if warm(urls, titles, args.workers) else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())